@@ -1,6 +1,5 @@
 from copy import deepcopy
 
-import librosa
 import numpy as np
 import torch
 
@@ -8,7 +7,8 @@ from basics.base_augmentation import BaseAugmentation, require_same_keys
 from basics.base_pe import BasePE
 from modules.fastspeech.param_adaptor import VARIANCE_CHECKLIST
 from modules.fastspeech.tts_modules import LengthRegulator
-from utils.binarizer_utils import get_mel_torch, get_mel2ph_torch
+from modules.pe import get_pitch_extractor
+from utils.binarizer_utils import get_mel_torch, get_mel2ph_torch, load_waveform
 from utils.hparams import hparams
 from utils.infer_utils import resample_align_curve
 
@@ -22,12 +22,19 @@ class SpectrogramStretchAugmentation(BaseAugmentation):
         super().__init__(data_dirs, augmentation_args)
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.lr = LengthRegulator().to(self.device)
+        # If not given, the pitch extractor is lazily initialized inside the process that runs
+        # the augmentation, so that instances of this class are cheap to send to the workers.
         self.pe = pe
 
+    def get_pe(self) -> BasePE:
+        if self.pe is not None:
+            return self.pe
+        return get_pitch_extractor()
+
     @require_same_keys
     def process_item(self, item: dict, key_shift=0., speed=1., replace_spk_id=None) -> dict:
         aug_item = deepcopy(item)
-        waveform, _ = librosa.load(aug_item['wav_fn'], sr=hparams['audio_sample_rate'], mono=True)
+        waveform = load_waveform(aug_item['wav_fn'], hparams['audio_sample_rate'])
         mel = get_mel_torch(
             waveform, hparams['audio_sample_rate'], num_mel_bins=hparams['audio_num_mel_bins'],
             hop_size=hparams['hop_size'], win_size=hparams['win_size'], fft_size=hparams['fft_size'],
@@ -46,10 +53,10 @@ class SpectrogramStretchAugmentation(BaseAugmentation):
                 self.lr, torch.from_numpy(aug_item['ph_dur']), aug_item['length'], self.timestep, device=self.device
             ).cpu().numpy()
 
-            f0, _ = self.pe.get_pitch(
+            f0, _ = self.get_pe().get_pitch(
                 waveform, samplerate=hparams['audio_sample_rate'], length=aug_item['length'],
                 hop_size=hparams['hop_size'], f0_min=hparams['f0_min'], f0_max=hparams['f0_max'],
-                speed=speed, interp_uv=True
+                speed=speed, interp_uv=True, key=aug_item['name']
             )
             aug_item['f0'] = f0.astype(np.float32)
 
@@ -3,6 +3,8 @@ import pathlib
 import pickle
 import random
 import shutil
+import time
+import traceback
 import warnings
 from copy import deepcopy
 
@@ -10,9 +12,10 @@ import numpy as np
 import torch
 from tqdm import tqdm
 
+from utils.binarizer_utils import pop_stage_timings, timed_stage
 from utils.hparams import hparams
 from utils.indexed_datasets import IndexedDatasetBuilder
-from utils.multiprocess_utils import chunked_multiprocess_run
+from utils.multiprocess_utils import chunked_multiprocess_run, is_main_process, ordered_results
 from utils.phoneme_utils import build_phoneme_list, locate_dictionary
 from utils.plot import distribution_to_figure
 from utils.text_encoder import TokenTextEncoder
@@ -248,63 +251,81 @@ class BaseBinarizer:
 
     def process_dataset(self, prefix, num_workers=0, apply_augmentation=False):
         args = []
-        builder = IndexedDatasetBuilder(self.binary_data_dir, prefix=prefix, allowed_attr=self.data_attrs)
+        builder = IndexedDatasetBuilder(
+            self.binary_data_dir, prefix=prefix, allowed_attr=self.data_attrs,
+            data_format=self.binarization_args.get('data_format', 'hdf5')
+        )
         total_sec = {k: 0.0 for k in self.spk_map}
         total_raw_sec = {k: 0.0 for k in self.spk_map}
         extra_info = {'names': {}, 'spk_ids': {}, 'spk_names': {}, 'lengths': {}}
         max_no = -1
-
-        for item_name, meta_data in self.meta_data_iterator(prefix):
-            args.append([item_name, meta_data, self.binarization_args])
+        # seconds spent on (or saved from) each stage, as reported by the items in 'timings'
+        total_timings = {}
+        num_timed_items = 0
 
         aug_map = self.arrange_data_augmentation(self.meta_data_iterator(prefix)) if apply_augmentation else {}
 
-        def postprocess(_item):
-            nonlocal total_sec, total_raw_sec, extra_info, max_no
-            if _item is None:
+        for item_name, meta_data in self.meta_data_iterator(prefix):
+            args.append([item_name, meta_data, self.binarization_args, aug_map.get(item_name, [])])
+
+        def postprocess(_items):
+            nonlocal total_sec, total_raw_sec, extra_info, max_no, num_timed_items
+            if _items is None:
                 return
-            item_no = builder.add_item(_item)
-            max_no = max(max_no, item_no)
-            for k, v in _item.items():
-                if isinstance(v, np.ndarray):
-                    if k not in extra_info:
-                        extra_info[k] = {}
-                    extra_info[k][item_no] = v.shape[0]
-            extra_info['names'][item_no] = _item['name'].split(':', 1)[-1]
-            extra_info['spk_ids'][item_no] = _item['spk_id']
-            extra_info['spk_names'][item_no] = _item['spk_name']
-            extra_info['lengths'][item_no] = _item['length']
-            total_raw_sec[_item['spk_name']] += _item['seconds']
-            total_sec[_item['spk_name']] += _item['seconds']
-
-            for task in aug_map.get(_item['name'], []):
-                aug_item = task['func'](_item, **task['kwargs'])
-                aug_item_no = builder.add_item(aug_item)
-                max_no = max(max_no, aug_item_no)
-                for k, v in aug_item.items():
+            for i, _item in enumerate(_items):
+                start = time.perf_counter()
+                item_no = builder.add_item(_item)
+                total_timings['write'] = total_timings.get('write', 0.) + time.perf_counter() - start
+                max_no = max(max_no, item_no)
+                for k, v in _item.items():
                     if isinstance(v, np.ndarray):
                         if k not in extra_info:
                             extra_info[k] = {}
-                        extra_info[k][aug_item_no] = v.shape[0]
-                extra_info['names'][aug_item_no] = aug_item['name'].split(':', 1)[-1]
-                extra_info['spk_ids'][aug_item_no] = aug_item['spk_id']
-                extra_info['spk_names'][aug_item_no] = aug_item['spk_name']
-                extra_info['lengths'][aug_item_no] = aug_item['length']
-                total_sec[aug_item['spk_name']] += aug_item['seconds']
+                        extra_info[k][item_no] = v.shape[0]
+                extra_info['names'][item_no] = _item['name'].split(':', 1)[-1]
+                extra_info['spk_ids'][item_no] = _item['spk_id']
+                extra_info['spk_names'][item_no] = _item['spk_name']
+                extra_info['lengths'][item_no] = _item['length']
+                if i == 0:
+                    # the first one is the original item, and the rest are augmented ones
+                    total_raw_sec[_item['spk_name']] += _item['seconds']
+                    if 'timings' in _item:
+                        num_timed_items += 1
+                        for k, v in _item['timings'].items():
+                            total_timings[k] = total_timings.get(k, 0.) + v
+                total_sec[_item['spk_name']] += _item['seconds']
+
+        pe_batch_size = int(self.binarization_args.get('pe_batch_size', 1))
+        if pe_batch_size > 1:
+            # process items in buckets so that the pitch extractor can run on them in batches
+            map_func = self.process_items_with_augmentation
+            map_args = [[args[i: i + pe_batch_size]] for i in range(0, len(args), pe_batch_size)]
+        else:
+            map_func = self.process_item_with_augmentation
+            map_args = args
 
+        start_time = time.perf_counter()
         try:
             if num_workers > 0:
                 # code for parallel processing
-                for item in tqdm(
-                        chunked_multiprocess_run(self.process_item, args, num_workers=num_workers),
-                        total=len(list(self.meta_data_iterator(prefix)))
-                ):
-                    postprocess(item)
+                results = ordered_results(chunked_multiprocess_run(
+                    map_func, map_args, num_workers=num_workers,
+                    task_order=self.arrange_tasks(map_args, bucketed=pe_batch_size > 1),
+                    init_func=self.initialize_worker,
+                    shared_memory=self.binarization_args.get('shared_memory_results', False)
+                ), range(len(map_args)))
             else:
                 # code for single cpu processing
-                for a in tqdm(args):
-                    item = self.process_item(*a)
-                    postprocess(item)
+                results = (map_func(*a) for a in map_args)
+            with tqdm(total=len(args)) as pbar:
+                for res in results:
+                    if pe_batch_size > 1:
+                        for items in res or []:
+                            postprocess(items)
+                        pbar.update(len(res) if res is not None else 0)
+                    else:
+                        postprocess(res)
+                        pbar.update()
             for k in extra_info:
                 assert set(extra_info[k]) == set(range(max_no + 1)), f'Item numbering is not consecutive.'
                 extra_info[k] = list(map(lambda x: x[1], sorted(extra_info[k].items(), key=lambda x: x[0])))
@@ -313,6 +334,7 @@ class BaseBinarizer:
             raise
 
         builder.finalize()
+        wall_time = time.perf_counter() - start_time
         if prefix == "train":
             extra_info.pop("names")
             extra_info.pop("spk_names")
@@ -336,6 +358,19 @@ class BaseBinarizer:
         else:
             print(f"| {prefix} total duration: {sum(total_raw_sec.values()):.2f}s")
             print(f"| {prefix} respective duration: " + ', '.join(f'{k}={v:.2f}s' for k, v in total_raw_sec.items()))
+        if num_timed_items > 0:
+            print(
+                f"| {prefix} average time per item: "
+                + ', '.join(f'{k}={v / num_timed_items:.3f}s' for k, v in total_timings.items())
+            )
+        return {
+            'num_items': len(args),
+            'num_processed_items': num_timed_items,
+            'num_written_items': max_no + 1,
+            'num_workers': num_workers,
+            'wall_time': wall_time,
+            'timings': total_timings,
+        }
 
     def arrange_data_augmentation(self, data_iterator):
         """
@@ -343,5 +378,81 @@ class BaseBinarizer:
         """
         raise NotImplementedError()
 
+    def arrange_tasks(self, map_args, bucketed=False, window=1000):
+        """
+        Arrange the order in which the tasks are dispatched to the workers. Longest items go first
+        within each window of consecutive tasks, so that no worker is left alone with a long item
+        at the end. This only affects scheduling: results are always written in the original order,
+        and the window bounds the number of results buffered until their turn comes.
+        :param map_args: arguments of process_item_with_augmentation(), or lists of them if bucketed
+        :param window: number of consecutive tasks sorted together
+        :return: list of indices of map_args
+        """
+        def wav_size(meta_data):
+            wav_fn = pathlib.Path(meta_data['wav_fn'])
+            return wav_fn.stat().st_size if wav_fn.exists() else 0
+
+        if bucketed:
+            costs = [sum(wav_size(a[1]) for a in bucket) for bucket, in map_args]
+        else:
+            costs = [wav_size(a[1]) for a in map_args]
+        return [
+            i
+            for start in range(0, len(map_args), window)
+            for i in sorted(range(start, min(start + window, len(map_args))), key=lambda j: -costs[j])
+        ]
+
+    def initialize_worker(self):
+        """
+        Called once in each worker process before it processes any item, e.g. to load models.
+        """
+        pass
+
     def process_item(self, item_name, meta_data, binarization_args):
         raise NotImplementedError()
+
+    def process_item_with_augmentation(self, item_name, meta_data, binarization_args, aug_tasks):
+        """
+        Process one piece of data and apply all augmentation tasks arranged for it.
+        This runs inside the worker processes so that only writing is left to the main process.
+        :return: list of the original item followed by its augmented items, or None if the item is skipped
+        """
+        start = time.perf_counter()
+        item = self.process_item(item_name, meta_data, binarization_args)
+        if item is None:
+            return None
+        items = [item] + [task['func'](item, **task['kwargs']) for task in aug_tasks]
+        # stage timings of this item (and anything done since the last item, e.g. prefetching)
+        timings = pop_stage_timings()
+        timings['item'] = time.perf_counter() - start
+        item['timings'] = {**item.get('timings', {}), **timings}
+        return items
+
+    def prefetch_items(self, items):
+        """
+        Called before processing a bucket of items (see binarization_args.pe_batch_size).
+        Subclasses may pass the waveforms of the bucket to the pitch extractor here.
+        :param items: list of (item_name, meta_data)
+        """
+        pass
+
+    def process_items_with_augmentation(self, bucket):
+        """
+        Process a bucket of items and their augmentation tasks after prefetching them.
+        :param bucket: list of arguments of process_item_with_augmentation()
+        :return: list of the results of process_item_with_augmentation()
+        """
+        with timed_stage('prefetch'):
+            self.prefetch_items([(item_name, meta_data) for item_name, meta_data, *_ in bucket])
+        results = []
+        for a in bucket:
+            # noinspection PyBroadException
+            try:
+                results.append(self.process_item_with_augmentation(*a))
+            except Exception:
+                if is_main_process:
+                    raise
+                # only skip this item, as chunked_worker_run() does when buckets are not used
+                traceback.print_exc()
+                results.append(None)
+        return results
@@ -5,7 +5,7 @@ import torch
 from torch.utils.data import Dataset
 
 from utils.hparams import hparams
-from utils.indexed_datasets import IndexedDataset
+from utils.indexed_datasets import IndexedDataset, MemmapIndexedDataset, SharedPreloadedDataset
 
 
 class BaseDataset(Dataset):
@@ -16,12 +16,21 @@ class BaseDataset(Dataset):
         2. *num_frames*:
             unclipped length.
 
+        If *preload* is True, all items are loaded into the memory of each process;
+        if *preload* is 'shared', all items are loaded once into shared memory and
+        mapped by all DataLoader workers and DDP ranks on the same machine.
+
         Subclasses should define:
         1. *collate*:
             take the longest data, pad other data to the same length;
         2. *__getitem__*:
             the index function.
+
+        Subclasses whose collater concatenates several items in each row when *packing_frames* > 0
+        should set *supports_packing* to True. The sampler then yields each row as a tuple of indices,
+        and the collater gets a list of rows (see *unpack_rows*).
     """
+    supports_packing = False
 
     def __init__(self, prefix, size_key='lengths', preload=False):
         super().__init__()
@@ -30,14 +39,31 @@ class BaseDataset(Dataset):
         with open(os.path.join(self.data_dir, f'{self.prefix}.meta'), 'rb') as f:
             self.metadata = pickle.load(f)
         self.sizes = self.metadata[size_key]
-        self._indexed_ds = IndexedDataset(self.data_dir, self.prefix)
-        if preload:
+        # only the training set is packed (see DsBatchSampler), and only by datasets whose collater supports it
+        self.packing_frames = hparams.get('packing_frames', 0) if prefix == 'train' and self.supports_packing else 0
+        num_cache = hparams.get('dataset_cache_size', 0)
+        cache_bytes = hparams.get('dataset_cache_bytes', 0)
+        if os.path.exists(os.path.join(self.data_dir, f'{self.prefix}.idx')):
+            self._indexed_ds = MemmapIndexedDataset(
+                self.data_dir, self.prefix, num_cache=num_cache, cache_bytes=cache_bytes
+            )
+        else:
+            self._indexed_ds = IndexedDataset(
+                self.data_dir, self.prefix, num_cache=num_cache, cache_bytes=cache_bytes
+            )
+        if preload == 'shared':
+            self.indexed_ds = SharedPreloadedDataset(self._indexed_ds, self.prefix)
+            del self._indexed_ds
+        elif preload:
             self.indexed_ds = [self._indexed_ds[i] for i in range(len(self._indexed_ds))]
             del self._indexed_ds
         else:
             self.indexed_ds = self._indexed_ds
 
     def __getitem__(self, index):
+        if isinstance(index, tuple):
+            # a packed row
+            return [self[i] for i in index]
         return {'_idx': index, **self.indexed_ds[index]}
 
     def __len__(self):
@@ -51,8 +77,27 @@ class BaseDataset(Dataset):
         filtering a dataset with ``--max-positions``."""
         return self.sizes[index]
 
-    def collater(self, samples):
-        return {
+    def unpack_rows(self, rows):
+        """
+        Flatten the packed rows made by the sampler.
+        :return: the samples, and the rows as lists of positions in the samples
+        """
+        samples = []
+        positions = []
+        for row in rows:
+            assert isinstance(row, list), 'Packed rows are expected, got a single sample.'
+            assert len(row) == 1 or sum(self.sizes[s['_idx']] for s in row) <= self.packing_frames, \
+                f'A packed row exceeds packing_frames ({self.packing_frames}).'
+            positions.append(list(range(len(samples), len(samples) + len(row))))
+            samples.extend(row)
+        return samples, positions
+
+    def collater(self, samples, rows=None):
+        batch = {
             'size': len(samples),
             'indices': torch.LongTensor([s['_idx'] for s in samples])
         }
+        if rows is not None:
+            # start of each row in indices, and the end of the last row
+            batch['row_bounds'] = torch.LongTensor([row[0] for row in rows] + [len(samples)])
+        return batch
@@ -2,6 +2,38 @@ class BasePE:
     def get_pitch(
             self, waveform, samplerate, length,
             *, hop_size, f0_min=65, f0_max=1100,
-            speed=1, interp_uv=False
+            speed=1, interp_uv=False, key=None
     ):
         raise NotImplementedError()
+
+    def get_pitch_batch(
+            self, waveforms, samplerate, lengths,
+            *, hop_size, f0_min=65, f0_max=1100,
+            speeds=None, interp_uv=False, keys=None
+    ):
+        """
+        Batched version of get_pitch(). Extractors that can run on many waveforms at once
+        should override this; by default get_pitch() is called on each waveform.
+        :param keys: names of the waveforms (e.g. item names) under which extractors may cache the results
+        :return: list of (f0, uv) tuples
+        """
+        if speeds is None:
+            speeds = [1] * len(waveforms)
+        if keys is None:
+            keys = [None] * len(waveforms)
+        return [
+            self.get_pitch(
+                waveform, samplerate, length,
+                hop_size=hop_size, f0_min=f0_min, f0_max=f0_max,
+                speed=speed, interp_uv=interp_uv, key=key
+            )
+            for waveform, length, speed, key in zip(waveforms, lengths, speeds, keys)
+        ]
+
+    def prefetch_pitch(self, waveforms, samplerate, keys):
+        """
+        Extract the pitch of these waveforms at once before get_pitch() is called on each of them
+        with the same key, so that extractors supporting batched inference can process them together.
+        Does nothing by default.
+        """
+        pass
@@ -21,7 +21,7 @@ from basics.base_module import CategorizedModule
 from utils.hparams import hparams
 from utils.training_utils import (
     DsModelCheckpoint, DsTQDMProgressBar,
-    DsBatchSampler, DsTensorBoardLogger,
+    DsBatchSampler, DsTensorBoardLogger, DsThroughputMonitor, DsTrainingProfiler,
     get_latest_checkpoint_path, get_strategy
 )
 from utils.phoneme_utils import locate_dictionary, build_phoneme_list
@@ -85,8 +85,8 @@ class BaseTask(pl.LightningModule):
     # Training, validation and testing
     ###########
     def setup(self, stage):
-        self.train_dataset = self.dataset_cls('train')
-        self.valid_dataset = self.dataset_cls('valid')
+        self.train_dataset = self.dataset_cls('train', preload=hparams.get('dataset_preload', False))
+        self.valid_dataset = self.dataset_cls('valid', preload=hparams.get('dataset_preload', False))
         self.num_replicas = (self.trainer.distributed_sampler_kwargs or {}).get('num_replicas', 1)
 
     def get_need_freeze_state_dict_key(self, model_state_dict) -> list:
@@ -208,6 +208,17 @@ class BaseTask(pl.LightningModule):
     def on_train_epoch_start(self):
         if self.training_sampler is not None:
             self.training_sampler.set_epoch(self.current_epoch)
+            rank_zero_info(
+                f'| epoch {self.current_epoch}: {len(self.training_sampler)} batches, '
+                f'padding ratio {self.training_sampler.padding_ratio:.2%}, '
+                f'frame imbalance across ranks {self.training_sampler.frame_imbalance:.3f} '
+                f'(per step {self.training_sampler.step_frame_imbalance:.3f})'
+            )
+            self.logger.log_metrics({
+                'training/padding_ratio': self.training_sampler.padding_ratio,
+                'training/frame_imbalance': self.training_sampler.frame_imbalance,
+                'training/step_frame_imbalance': self.training_sampler.step_frame_imbalance
+            }, step=self.global_step)
 
     def _training_step(self, sample):
         """
@@ -227,6 +238,8 @@ class BaseTask(pl.LightningModule):
         if self.global_step % hparams['log_interval'] == 0:
             tb_log = {f'training/{k}': v for k, v in log_outputs.items()}
             tb_log['training/lr'] = self.lr_schedulers().get_last_lr()[0]
+            if 'collate_time' in sample:
+                tb_log['training/collate_time'] = sample['collate_time']
             self.logger.log_metrics(tb_log, step=self.global_step)
 
         return total_loss
@@ -342,7 +355,10 @@ class BaseTask(pl.LightningModule):
             size_reversed=True,
             required_batch_count_multiple=hparams['accumulate_grad_batches'],
             shuffle_sample=True,
-            shuffle_batch=True
+            shuffle_batch=True,
+            min_padding_efficiency=hparams.get('sampler_min_padding_efficiency', 0.),
+            rank_assignment=hparams.get('sampler_rank_assignment', 'ordered'),
+            packing_frames=self.train_dataset.packing_frames
         )
         return torch.utils.data.DataLoader(
             self.train_dataset,
@@ -400,6 +416,31 @@ class BaseTask(pl.LightningModule):
         #     print("load success-------------------------------------------------------------------")
 
         work_dir = pathlib.Path(hparams['work_dir'])
+        callbacks = [
+            DsModelCheckpoint(
+                dirpath=work_dir,
+                filename='model_ckpt_steps_{step}',
+                auto_insert_metric_name=False,
+                monitor='step',
+                mode='max',
+                save_last=False,
+                # every_n_train_steps=hparams['val_check_interval'],
+                save_top_k=hparams['num_ckpt_keep'],
+                permanent_ckpt_start=hparams['permanent_ckpt_start'],
+                permanent_ckpt_interval=hparams['permanent_ckpt_interval'],
+                verbose=True
+            ),
+            # LearningRateMonitor(logging_interval='step'),
+            DsTQDMProgressBar(),
+        ]
+        if hparams.get('monitor_throughput', False):
+            callbacks.append(DsThroughputMonitor(log_interval=hparams['log_interval']))
+        if hparams.get('profile_steps', 0) > 0:
+            callbacks.append(DsTrainingProfiler(
+                work_dir / 'profiler',
+                wait_steps=hparams.get('profile_wait_steps', 0),
+                active_steps=hparams['profile_steps']
+            ))
         trainer = pl.Trainer(
             accelerator=hparams['pl_trainer_accelerator'],
             devices=hparams['pl_trainer_devices'],
@@ -412,23 +453,7 @@ class BaseTask(pl.LightningModule):
                 hparams['pl_trainer_precision'],
             ),
             precision=hparams['pl_trainer_precision'],
-            callbacks=[
-                DsModelCheckpoint(
-                    dirpath=work_dir,
-                    filename='model_ckpt_steps_{step}',
-                    auto_insert_metric_name=False,
-                    monitor='step',
-                    mode='max',
-                    save_last=False,
-                    # every_n_train_steps=hparams['val_check_interval'],
-                    save_top_k=hparams['num_ckpt_keep'],
-                    permanent_ckpt_start=hparams['permanent_ckpt_start'],
-                    permanent_ckpt_interval=hparams['permanent_ckpt_interval'],
-                    verbose=True
-                ),
-                # LearningRateMonitor(logging_interval='step'),
-                DsTQDMProgressBar(),
-            ],
+            callbacks=callbacks,
             logger=DsTensorBoardLogger(
                 save_dir=str(work_dir),
                 name='lightning_logs',
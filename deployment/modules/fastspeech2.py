@@ -7,6 +7,7 @@ import torch.nn.functional as F
 
 from modules.commons.common_layers import NormalInitEmbedding as Embedding
 from modules.fastspeech.acoustic_encoder import FastSpeech2Acoustic
+from modules.fastspeech.tts_modules import LengthRegulator
 from modules.fastspeech.variance_encoder import FastSpeech2Variance
 from utils.hparams import hparams
 from utils.text_encoder import PAD_INDEX
@@ -28,18 +29,6 @@ def f0_to_coarse(f0):
     return f0_coarse
 
 
-class LengthRegulator(nn.Module):
-    # noinspection PyMethodMayBeStatic
-    def forward(self, dur):
-        token_idx = torch.arange(1, dur.shape[1] + 1, device=dur.device)[None, :, None]
-        dur_cumsum = torch.cumsum(dur, dim=1)
-        dur_cumsum_prev = F.pad(dur_cumsum, (1, -1), mode='constant', value=0)
-        pos_idx = torch.arange(dur.sum(dim=1).max(), device=dur.device)[None, None]
-        token_mask = (pos_idx >= dur_cumsum_prev[:, :, None]) & (pos_idx < dur_cumsum[:, :, None])
-        mel2ph = (token_idx * token_mask).sum(dim=1)
-        return mel2ph
-
-
 class FastSpeech2AcousticONNX(FastSpeech2Acoustic):
     def __init__(self, vocab_size):
         super().__init__(vocab_size=vocab_size)
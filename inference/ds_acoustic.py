@@ -1,4 +1,5 @@
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 import tqdm
 import json
@@ -6,6 +7,7 @@ import pathlib
 
 import numpy as np
 import torch
+from torch.profiler import record_function
 from typing import Dict
 
 from basics.base_svs_infer import BaseSVSInfer
@@ -13,9 +15,9 @@ from modules.fastspeech.param_adaptor import VARIANCE_CHECKLIST
 from modules.fastspeech.tts_modules import LengthRegulator
 from modules.toplevel import DiffSingerAcoustic, ShallowDiffusionOutput
 from modules.vocoders.registry import VOCODERS
-from utils import load_ckpt
+from utils import load_ckpt, collate_nd
 from utils.hparams import hparams
-from utils.infer_utils import cross_fade, resample_align_curve, save_wav
+from utils.infer_utils import WaveformAssembler, resample_align_curve, save_wav
 from utils.phoneme_utils import build_phoneme_list
 from utils.text_encoder import TokenTextEncoder
 
@@ -79,7 +81,8 @@ class DiffSingerAcousticInfer(BaseSVSInfer):
         ph_dur = torch.from_numpy(np.array(param['ph_dur'].split(), np.float32)).to(self.device)
         ph_acc = torch.round(torch.cumsum(ph_dur, dim=0) / self.timestep + 0.5).long()
         durations = torch.diff(ph_acc, dim=0, prepend=torch.LongTensor([0]).to(self.device))[None]  # => [B=1, T_txt]
-        mel2ph = self.lr(durations, txt_tokens == 0)  # => [B=1, T]
+        with record_function('length_regulation'):
+            mel2ph = self.lr(durations, txt_tokens == 0)  # => [B=1, T]
         batch['mel2ph'] = mel2ph
         length = mel2ph.size(1)  # => T
 
@@ -158,34 +161,201 @@ class DiffSingerAcousticInfer(BaseSVSInfer):
         return batch
 
     @torch.no_grad()
-    def forward_model(self, sample):
+    def mix_speaker_embed(self, sample):
+        spk_mix_id = sample['spk_mix_id']
+        spk_mix_value = sample['spk_mix_value']
+        # perform mixing on spk embed
+        spk_mix_embed = torch.sum(
+            self.model.fs2.spk_embed(spk_mix_id) * spk_mix_value.unsqueeze(3),  # => [B, T, N, H]
+            dim=2, keepdim=False
+        )  # => [B, T, H]
+        return spk_mix_embed
+
+    @staticmethod
+    def build_buckets(batches, batch_frames):
+        """
+        Group segments of similar lengths into buckets whose padded size
+        (number of segments * longest frame count) fits in the frame budget.
+        A segment longer than the budget forms a bucket on its own.
+        :param batches: preprocessed segments
+        :param batch_frames: maximum padded frames per bucket
+        :return: list of buckets, each being a list of segment indices
+        """
+        lengths = [batch['mel2ph'].shape[1] for batch in batches]
+        buckets = []
+        bucket = []
+        for idx in sorted(range(len(batches)), key=lambda i: lengths[i]):
+            # segments are visited in ascending order, so the current one is the longest in its bucket
+            if len(bucket) > 0 and (len(bucket) + 1) * lengths[idx] > batch_frames:
+                buckets.append(bucket)
+                bucket = []
+            bucket.append(idx)
+        if len(bucket) > 0:
+            buckets.append(bucket)
+        return buckets
+
+    @torch.no_grad()
+    def collate_segments(self, batches):
+        """
+        Pad a list of preprocessed segments (each with B=1) into a single batch.
+        Static values (key shift, speed) are expanded to frame level, and the
+        speaker mix is resolved to frame-level embeddings in advance because
+        different segments may mix different numbers of speakers.
+        """
+        lengths = [batch['mel2ph'].shape[1] for batch in batches]
+
+        def collate_frames(values):
+            # [B=1, T, ...] or [B=1, T=1, ...] => [B, T_max, ...]
+            return collate_nd([v[0].expand(n, *v.shape[2:]) for v, n in zip(values, lengths)], pad_value=0)
+
+        sample = {
+            'tokens': collate_nd([batch['tokens'][0] for batch in batches], pad_value=0),
+            'mel2ph': collate_frames([batch['mel2ph'] for batch in batches]),
+            'f0': collate_frames([batch['f0'] for batch in batches])
+        }
+        for v_name in self.variances_to_embed:
+            sample[v_name] = collate_frames([batch[v_name] for batch in batches])
+        for key in ['key_shift', 'speed']:
+            if key in batches[0]:
+                sample[key] = collate_frames([batch[key] for batch in batches])
+        if hparams['use_spk_id']:
+            sample['spk_mix_embed'] = collate_frames([self.mix_speaker_embed(batch) for batch in batches])
+        return sample
+
+    def build_noise_fn(self, lengths, seeds):
+        """
+        Build the function that draws the noise of a bucket of segments, which is used for both
+        the initial noise and the noise added at each sampling step. Each seeded segment draws
+        from its own generator, so it gets exactly the noise it would get when being inferred
+        on its own, no matter which other segments share its bucket.
+        :param lengths: frame counts of the segments
+        :param seeds: seed of each segment, or None to use the global RNG
+        :return: function returning noise [B, F, M, T], zero on padding frames
+        """
+        diffusion = self.model.diffusion
+        generators = [
+            None if seed is None else torch.Generator(device=self.device).manual_seed(seed & 0xffff_ffff)
+            for seed in seeds
+        ]
+
+        def noise_fn():
+            noise = torch.zeros(
+                len(lengths), diffusion.num_feats, diffusion.out_dims, max(lengths), device=self.device
+            )
+            for i, (length, generator) in enumerate(zip(lengths, generators)):
+                noise[i, :, :, :length] = torch.randn(
+                    (1, diffusion.num_feats, diffusion.out_dims, length),
+                    generator=generator, device=self.device
+                )
+            return noise
+
+        return noise_fn
+
+    @torch.no_grad()
+    def forward_model(self, sample, noise_fn=None):
         txt_tokens = sample['tokens']
         variances = {
             v_name: sample.get(v_name)
             for v_name in self.variances_to_embed
         }
         if hparams['use_spk_id']:
-            spk_mix_id = sample['spk_mix_id']
-            spk_mix_value = sample['spk_mix_value']
-            # perform mixing on spk embed
-            spk_mix_embed = torch.sum(
-                self.model.fs2.spk_embed(spk_mix_id) * spk_mix_value.unsqueeze(3),  # => [B, T, N, H]
-                dim=2, keepdim=False
-            )  # => [B, T, H]
+            spk_mix_embed = sample.get('spk_mix_embed')
+            if spk_mix_embed is None:
+                spk_mix_embed = self.mix_speaker_embed(sample)
         else:
             spk_mix_embed = None
         mel_pred: ShallowDiffusionOutput = self.model(
             txt_tokens, mel2ph=sample['mel2ph'], f0=sample['f0'], **variances,
             key_shift=sample.get('key_shift'), speed=sample.get('speed'),
-            spk_mix_embed=spk_mix_embed, infer=True
+            spk_mix_embed=spk_mix_embed, infer=True, noise_fn=noise_fn
         )
         return mel_pred.diff_out
 
+    @torch.no_grad()
+    def forward_buckets(self, params, batches, buckets, seed: int = -1):
+        """
+        Run one sampling loop per bucket and split the results back to segments.
+        :return: list of mel-spectrograms [B=1, T, M] in the original segment order
+        """
+        mel_preds = [None] * len(batches)
+        for bucket in tqdm.tqdm(buckets, desc='infer batches'):
+            sample = self.collate_segments([batches[idx] for idx in bucket])
+            lengths = [batches[idx]['mel2ph'].shape[1] for idx in bucket]
+            seeds = [
+                params[idx]['seed'] if 'seed' in params[idx] else (seed if seed >= 0 else None)
+                for idx in bucket
+            ]
+            mel_pred = self.forward_model(sample, noise_fn=self.build_noise_fn(lengths, seeds))
+            for i, idx in enumerate(bucket):
+                mel_preds[idx] = mel_pred[i: i + 1, :lengths[i]]
+        return mel_preds
+
     @torch.no_grad()
     def run_vocoder(self, spec, **kwargs):
-        y = self.vocoder.spec2wav_torch(spec, **kwargs)
+        with record_function('vocoder'):
+            y = self.vocoder.spec2wav_torch(spec, **kwargs)
         return y[None]
 
+    def iter_mel_preds(self, params, batches, mel_preds=None, seed: int = -1, seeded_noise: bool = False):
+        """
+        Yield (param, batch, mel_pred) of each segment in order, reseeding the global RNG
+        before each segment so that the vocoder following it is reproducible.
+        :param mel_preds: results of batched inference, if any
+        :param seeded_noise: draw the noise of the sampler from a per-segment generator instead of the
+        global RNG, which may be shared with concurrently running stages
+        """
+        for idx, (param, batch) in enumerate(tqdm.tqdm(
+                zip(params, batches), desc='infer segments', total=len(params)
+        )):
+            segment_seed = param['seed'] if 'seed' in param else (seed if seed >= 0 else None)
+            if segment_seed is not None:
+                torch.manual_seed(segment_seed & 0xffff_ffff)
+                torch.cuda.manual_seed_all(segment_seed & 0xffff_ffff)
+
+            if mel_preds is not None:
+                mel_pred = mel_preds[idx]
+            elif seeded_noise:
+                mel_pred = self.forward_model(
+                    batch, noise_fn=self.build_noise_fn([batch['mel2ph'].shape[1]], [segment_seed])
+                )
+            else:
+                mel_pred = self.forward_model(batch)
+            yield param, batch, mel_pred
+
+    def run_pipeline(self, segments, assembler: WaveformAssembler, queue_size: int = 2):
+        """
+        Overlap the stages of waveform generation: while the caller computes the mel of
+        segment i+1 (by iterating over `segments`), segment i is being vocoded and segment
+        i-1 is being cross-faded and written. Each stage runs on its own thread; PyTorch
+        and NumPy release the GIL in their kernels, so the stages run concurrently.
+        :param segments: iterable of (param, batch, mel_pred)
+        :param assembler: destination of the waveforms
+        :param queue_size: maximum number of segments waiting between the stages
+        """
+
+        def vocode(mel_pred, f0):
+            return self.run_vocoder(mel_pred, f0=f0)[0].cpu().numpy()
+
+        def assemble(offset, vocoder_future):
+            assembler.add(offset, vocoder_future.result())
+
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='vocoder') as vocoder_pool, \
+                ThreadPoolExecutor(max_workers=1, thread_name_prefix='assembler') as assembler_pool:
+            try:
+                for param, batch, mel_pred in segments:
+                    vocoder_future = vocoder_pool.submit(vocode, mel_pred, batch['f0'])
+                    pending.append(assembler_pool.submit(assemble, param.get('offset', 0.), vocoder_future))
+                    # bound the number of segments in flight; also raises errors from the stages early
+                    while len(pending) > queue_size:
+                        pending.popleft().result()
+                while len(pending) > 0:
+                    pending.popleft().result()
+            except BaseException:
+                vocoder_pool.shutdown(wait=True, cancel_futures=True)
+                assembler_pool.shutdown(wait=True, cancel_futures=True)
+                raise
+
     def run_inference(
             self, params,
             out_dir: pathlib.Path = None,
@@ -193,54 +363,60 @@ class DiffSingerAcousticInfer(BaseSVSInfer):
             num_runs: int = 1,
             spk_mix: Dict[str, float] = None,
             seed: int = -1,
-            save_mel: bool = False
+            save_mel: bool = False,
+            batch_frames: int = 0,
+            pipeline: bool = False
     ):
         batches = [self.preprocess_input(param, idx=i) for i, param in enumerate(params)]
+        if batch_frames > 0:
+            buckets = self.build_buckets(batches, batch_frames)
+            print(f'| batched inference: {len(batches)} segments in {len(buckets)} batches')
+        else:
+            buckets = None
+        pipeline = pipeline and not save_mel
 
         out_dir.mkdir(parents=True, exist_ok=True)
         suffix = '.wav' if not save_mel else '.mel.pt'
+        # audio can be streamed to the file only if no segment goes back before a previous one
+        offsets = [param.get('offset', 0.) for param in params]
+        stream_audio = all(a <= b for a, b in zip(offsets[:-1], offsets[1:]))
         for i in range(num_runs):
+            if num_runs > 1:
+                filename = f'{title}-{str(i).zfill(3)}{suffix}'
+            else:
+                filename = title + suffix
+            save_path = out_dir / filename
             if save_mel:
                 result = []
             else:
-                result = np.zeros(0)
-            current_length = 0
-
-            for param, batch in tqdm.tqdm(
-                    zip(params, batches), desc='infer segments', total=len(params)
-            ):
-                if 'seed' in param:
-                    torch.manual_seed(param["seed"] & 0xffff_ffff)
-                    torch.cuda.manual_seed_all(param["seed"] & 0xffff_ffff)
-                elif seed >= 0:
-                    torch.manual_seed(seed & 0xffff_ffff)
-                    torch.cuda.manual_seed_all(seed & 0xffff_ffff)
+                result = WaveformAssembler(
+                    hparams['audio_sample_rate'], path=save_path if stream_audio else None
+                )
+            if buckets is not None:
+                mel_preds = self.forward_buckets(params, batches, buckets, seed=seed)
+            else:
+                mel_preds = None
 
-                mel_pred = self.forward_model(batch)
-                if save_mel:
-                    result.append({
-                        'offset': param.get('offset', 0.),
-                        'mel': mel_pred.cpu(),
-                        'f0': batch['f0'].cpu()
-                    })
-                else:
-                    waveform_pred = self.run_vocoder(mel_pred, f0=batch['f0'])[0].cpu().numpy()
-                    silent_length = round(param.get('offset', 0) * hparams['audio_sample_rate']) - current_length
-                    if silent_length >= 0:
-                        result = np.append(result, np.zeros(silent_length))
-                        result = np.append(result, waveform_pred)
+            segments = self.iter_mel_preds(params, batches, mel_preds=mel_preds, seed=seed, seeded_noise=pipeline)
+            if pipeline:
+                self.run_pipeline(segments, result)
+            else:
+                for param, batch, mel_pred in segments:
+                    if save_mel:
+                        result.append({
+                            'offset': param.get('offset', 0.),
+                            'mel': mel_pred.cpu(),
+                            'f0': batch['f0'].cpu()
+                        })
                     else:
-                        result = cross_fade(result, waveform_pred, current_length + silent_length)
-                    current_length = current_length + silent_length + waveform_pred.shape[0]
+                        waveform_pred = self.run_vocoder(mel_pred, f0=batch['f0'])[0].cpu().numpy()
+                        result.add(param.get('offset', 0.), waveform_pred)
 
-            if num_runs > 1:
-                filename = f'{title}-{str(i).zfill(3)}{suffix}'
-            else:
-                filename = title + suffix
-            save_path = out_dir / filename
             if save_mel:
                 print(f'| save mel: {save_path}')
                 torch.save(result, save_path)
             else:
                 print(f'| save audio: {save_path}')
-                save_wav(result, save_path, hparams['audio_sample_rate'])
+                waveform = result.finish()
+                if waveform is not None:
+                    save_wav(waveform, save_path, hparams['audio_sample_rate'])
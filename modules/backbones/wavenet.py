@@ -1,4 +1,5 @@
 import math
+from contextlib import contextmanager
 from math import sqrt
 
 import torch
@@ -44,9 +45,12 @@ class ResidualBlock(nn.Module):
         self.conditioner_projection = nn.Conv1d(encoder_hidden, 2 * residual_channels, 1)
         self.output_projection = nn.Conv1d(residual_channels, 2 * residual_channels, 1)
 
-    def forward(self, x, conditioner, diffusion_step):
+    def forward(self, x, conditioner, diffusion_step, projected_conditioner=None):
         diffusion_step = self.diffusion_projection(diffusion_step).unsqueeze(-1)
-        conditioner = self.conditioner_projection(conditioner)
+        if projected_conditioner is None:
+            conditioner = self.conditioner_projection(conditioner)
+        else:
+            conditioner = projected_conditioner
         y = x + diffusion_step
 
         y = self.dilated_conv(y) + conditioner
@@ -85,6 +89,31 @@ class WaveNet(nn.Module):
         self.skip_projection = Conv1d(n_chans, n_chans, 1)
         self.output_projection = Conv1d(n_chans, in_dims * n_feats, 1)
         nn.init.zeros_(self.output_projection.weight)
+        # inference caches, see cache_conditioner()
+        self._cached_cond = None
+        self._cached_projections = None
+        self._step_table = None
+
+    @contextmanager
+    def cache_conditioner(self, cond, num_steps=None):
+        """
+        Within this context, the conditioner projections of all layers are computed only once for `cond`,
+        which stays the same across all sampling steps of one utterance. If `num_steps` is given, the
+        embeddings of integer diffusion steps in [0, num_steps) are also precomputed as a lookup table.
+        :param cond: [B, H, T]
+        :param num_steps: number of discrete diffusion steps
+        """
+        with torch.no_grad():
+            self._cached_projections = [layer.conditioner_projection(cond) for layer in self.residual_layers]
+            if num_steps is not None:
+                self._step_table = self.mlp(self.diffusion_embedding(torch.arange(num_steps, device=cond.device)))
+        self._cached_cond = cond
+        try:
+            yield
+        finally:
+            self._cached_cond = None
+            self._cached_projections = None
+            self._step_table = None
 
     def forward(self, spec, diffusion_step, cond):
         """
@@ -100,11 +129,18 @@ class WaveNet(nn.Module):
         x = self.input_projection(x)  # [B, C, T]
 
         x = F.relu(x)
-        diffusion_step = self.diffusion_embedding(diffusion_step)
-        diffusion_step = self.mlp(diffusion_step)
+        if self._step_table is not None and not torch.is_floating_point(diffusion_step):
+            diffusion_step = self._step_table[diffusion_step]
+        else:
+            diffusion_step = self.diffusion_embedding(diffusion_step)
+            diffusion_step = self.mlp(diffusion_step)
+        if self._cached_cond is not None and cond is self._cached_cond:
+            projected_conditioners = self._cached_projections
+        else:
+            projected_conditioners = [None] * len(self.residual_layers)
         skip = []
-        for layer in self.residual_layers:
-            x, skip_connection = layer(x, cond, diffusion_step)
+        for layer, projected_conditioner in zip(self.residual_layers, projected_conditioners):
+            x, skip_connection = layer(x, cond, diffusion_step, projected_conditioner=projected_conditioner)
             skip.append(skip_connection)
 
         x = torch.sum(torch.stack(skip), dim=0) / sqrt(len(self.residual_layers))
@@ -119,9 +119,12 @@ class TransformerFFNLayer(nn.Module):
             self.act_fn = SiLU()
         self.ffn_2 = XavierUniformInitLinear(filter_size, hidden_size)
 
-    def forward(self, x):
+    def forward(self, x, segment_ids=None):
         # x: T x B x C
-        x = self.ffn_1(x.permute(1, 2, 0)).permute(2, 0, 1)
+        if segment_ids is not None and self.kernel_size > 1:
+            x = self.forward_segment_conv(x.permute(1, 2, 0), segment_ids).permute(2, 0, 1)
+        else:
+            x = self.ffn_1(x.permute(1, 2, 0)).permute(2, 0, 1)
         x = x * self.kernel_size ** -0.5
 
         x = self.act_fn(x)
@@ -129,6 +132,20 @@ class TransformerFFNLayer(nn.Module):
         x = self.ffn_2(x)
         return x
 
+    def forward_segment_conv(self, x, segment_ids):
+        """
+        ffn_1 on packed rows, where each position only sees the positions of its own segment
+        (like zero padding at the boundaries of the segments).
+        :param x: [B, C, T]
+        :param segment_ids: [B, T], 1-based index of the segment at each position, 0 for padding
+        """
+        pad = self.kernel_size // 2
+        windows = F.pad(x, [pad, pad]).unfold(2, self.kernel_size, 1)  # [B, C, T, K]
+        same_segment = F.pad(segment_ids, [pad, pad]).unfold(1, self.kernel_size, 1) == segment_ids[:, :, None]
+        windows = windows * same_segment[:, None, :, :]
+        x = torch.einsum('bctk,fck->bft', windows, self.ffn_1.weight)
+        return x + self.ffn_1.bias[None, :, None]
+
 
 class EncSALayer(nn.Module):
     def __init__(self, c, num_heads, dropout, attention_dropout=0.1,
@@ -149,13 +166,19 @@ class EncSALayer(nn.Module):
         if layer_norm_training is not None:
             self.layer_norm1.training = layer_norm_training
             self.layer_norm2.training = layer_norm_training
+        attn_mask = kwargs.get('attn_mask', None)
+        segment_ids = kwargs.get('segment_ids', None)
+        if attn_mask is not None and attn_mask.dim() == 3:
+            # [B, T, T] => [B x num_heads, T, T]
+            attn_mask = attn_mask.repeat_interleave(self.self_attn.num_heads, dim=0)
         residual = x
         x = self.layer_norm1(x)
         x, _, = self.self_attn(
             query=x,
             key=x,
             value=x,
-            key_padding_mask=encoder_padding_mask
+            key_padding_mask=encoder_padding_mask,
+            attn_mask=attn_mask
         )
         x = F.dropout(x, self.dropout, training=self.training)
         x = residual + x
@@ -163,7 +186,7 @@ class EncSALayer(nn.Module):
 
         residual = x
         x = self.layer_norm2(x)
-        x = self.ffn(x)
+        x = self.ffn(x, segment_ids=segment_ids)
         x = F.dropout(x, self.dropout, training=self.training)
         x = residual + x
         x = x * (1 - encoder_padding_mask.float()).transpose(0, 1)[..., None]
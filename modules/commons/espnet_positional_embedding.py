@@ -99,15 +99,20 @@ class RelPositionalEncoding(PositionalEncoding):
         """Initialize class."""
         super().__init__(d_model, dropout_rate, max_len, reverse=True)
 
-    def forward(self, x):
+    def forward(self, x, positions=None):
         """Compute positional encoding.
         Args:
             x (torch.Tensor): Input tensor (batch, time, `*`).
+            positions (torch.Tensor, optional): Index of each element in its sequence (batch, time),
+                e.g. in packed sequences. Defaults to the index in x.
         Returns:
             torch.Tensor: Encoded tensor (batch, time, `*`).
             torch.Tensor: Positional embedding tensor (1, time, `*`).
         """
         self.extend_pe(x)
         x = x * self.xscale
-        pos_emb = self.pe[:, : x.size(1)]
+        if positions is None:
+            pos_emb = self.pe[:, : x.size(1)]
+        else:
+            pos_emb = self.pe[0, positions]
         return self.dropout(x) + self.dropout(pos_emb)
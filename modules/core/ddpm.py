@@ -7,6 +7,7 @@ from typing import List, Tuple
 import numpy as np
 import torch
 from torch import nn
+from torch.profiler import record_function
 from tqdm import tqdm
 
 from modules.backbones.wavenet import WaveNet
@@ -145,10 +146,13 @@ class GaussianDiffusion(nn.Module):
         return model_mean, posterior_variance, posterior_log_variance
 
     @torch.no_grad()
-    def p_sample(self, x, t, cond, clip_denoised=True, repeat_noise=False):
+    def p_sample(self, x, t, cond, clip_denoised=True, repeat_noise=False, noise_fn=None):
         b, *_, device = *x.shape, x.device
         model_mean, _, model_log_variance = self.p_mean_variance(x=x, t=t, cond=cond)
-        noise = noise_like(x.shape, device, repeat_noise)
+        if noise_fn is not None:
+            noise = noise_fn()
+        else:
+            noise = noise_like(x.shape, device, repeat_noise)
         # no noise when t == 0
         nonzero_mask = (1 - (t == 0).float()).reshape(b, *((1,) * (len(x.shape) - 1)))
         return model_mean + nonzero_mask * (0.5 * model_log_variance).exp() * noise
@@ -187,7 +191,7 @@ class GaussianDiffusion(nn.Module):
 
         if len(noise_list) == 0:
             x_pred = get_x_pred(x, noise_pred, t)
-            noise_pred_prev = self.denoise_fn(x_pred, max(t - interval, 0), cond=cond)
+            noise_pred_prev = self.denoise_fn(x_pred, torch.clamp(t - interval, min=0), cond=cond)
             noise_pred_prime = (noise_pred + noise_pred_prev) / 2
         elif len(noise_list) == 1:
             noise_pred_prime = (3 * noise_pred - noise_list[-1]) / 2
@@ -216,13 +220,20 @@ class GaussianDiffusion(nn.Module):
 
         return x_recon, noise
 
-    def inference(self, cond, b=1, x_start=None, device=None):
+    def inference(self, cond, b=1, x_start=None, device=None, noise_fn=None):
+        """
+        :param noise_fn: function that draws noise of shape [B, F, M, T], used for the initial noise
+        and the noise added at each step of the sampler (if any), instead of the global RNG
+        """
         depth = hparams.get('K_step_infer', self.k_step)
         speedup = hparams['diff_speedup']
         if speedup > 0:
             assert depth % speedup == 0, f'Acceleration ratio must be a factor of diffusion depth {depth}.'
 
-        noise = torch.randn(b, self.num_feats, self.out_dims, cond.shape[2], device=device)
+        if noise_fn is not None:
+            noise = noise_fn()
+        else:
+            noise = torch.randn(b, self.num_feats, self.out_dims, cond.shape[2], device=device)
         if self.use_shallow_diffusion:
             t_max = min(depth, self.k_step)
         else:
@@ -251,7 +262,8 @@ class GaussianDiffusion(nn.Module):
                 # `model` with the noise prediction type ("noise") .
                 def my_wrapper(fn):
                     def wrapped(x, t, **kwargs):
-                        ret = fn(x, t, **kwargs)
+                        with record_function('sampling_step'):
+                            ret = fn(x, t, **kwargs)
                         self.bar.update(1)
                         return ret
 
@@ -290,7 +302,8 @@ class GaussianDiffusion(nn.Module):
                 # `model` with the noise prediction type ("noise") .
                 def my_wrapper(fn):
                     def wrapped(x, t, **kwargs):
-                        ret = fn(x, t, **kwargs)
+                        with record_function('sampling_step'):
+                            ret = fn(x, t, **kwargs)
                         self.bar.update(1)
                         return ret
 
@@ -325,30 +338,35 @@ class GaussianDiffusion(nn.Module):
                         reversed(range(0, t_max, iteration_interval)), desc='sample time step',
                         total=t_max // iteration_interval, disable=not hparams['infer'], leave=False
                 ):
-                    x = self.p_sample_plms(
-                        x, torch.full((b,), i, device=device, dtype=torch.long),
-                        iteration_interval, cond=cond
-                    )
+                    with record_function('sampling_step'):
+                        x = self.p_sample_plms(
+                            x, torch.full((b,), i, device=device, dtype=torch.long),
+                            iteration_interval, cond=cond
+                        )
             elif algorithm == 'ddim':
                 iteration_interval = speedup
                 for i in tqdm(
                         reversed(range(0, t_max, iteration_interval)), desc='sample time step',
                         total=t_max // iteration_interval, disable=not hparams['infer'], leave=False
                 ):
-                    x = self.p_sample_ddim(
-                        x, torch.full((b,), i, device=device, dtype=torch.long),
-                        iteration_interval, cond=cond
-                    )
+                    with record_function('sampling_step'):
+                        x = self.p_sample_ddim(
+                            x, torch.full((b,), i, device=device, dtype=torch.long),
+                            iteration_interval, cond=cond
+                        )
             else:
                 raise ValueError(f"Unsupported acceleration algorithm for DDPM: {algorithm}.")
         else:
             for i in tqdm(reversed(range(0, t_max)), desc='sample time step', total=t_max,
                           disable=not hparams['infer'], leave=False):
-                x = self.p_sample(x, torch.full((b,), i, device=device, dtype=torch.long), cond)
+                with record_function('sampling_step'):
+                    x = self.p_sample(
+                        x, torch.full((b,), i, device=device, dtype=torch.long), cond, noise_fn=noise_fn
+                    )
         x = x.transpose(2, 3).squeeze(1)  # [B, F, M, T] => [B, T, M] or [B, F, T, M]
         return x
 
-    def forward(self, condition, gt_spec=None, src_spec=None, infer=True):
+    def forward(self, condition, gt_spec=None, src_spec=None, infer=True, noise_fn=None):
         """
             conditioning diffusion, use fastspeech2 encoder output as the condition
         """
@@ -371,7 +389,9 @@ class GaussianDiffusion(nn.Module):
                     spec = spec[:, None, :, :]
             else:
                 spec = None
-            x = self.inference(cond, b=b, x_start=spec, device=device)
+            # cond stays the same across all sampling steps, so its projections are computed only once
+            with self.denoise_fn.cache_conditioner(cond, num_steps=self.timesteps):
+                x = self.inference(cond, b=b, x_start=spec, device=device, noise_fn=noise_fn)
             return self.denorm_spec(x)
 
     def norm_spec(self, x):
@@ -4,6 +4,7 @@ from typing import List, Tuple
 
 import torch
 import torch.nn as nn
+from torch.profiler import record_function
 from tqdm import tqdm
 
 from modules.backbones import BACKBONES
@@ -40,7 +41,7 @@ class RectifiedFlow(nn.Module):
 
         return v_pred, x_end - x_start
 
-    def forward(self, condition, gt_spec=None, src_spec=None, infer=True):
+    def forward(self, condition, gt_spec=None, src_spec=None, infer=True, noise_fn=None):
         cond = condition.transpose(1, 2)
         b, device = condition.shape[0], condition.device
 
@@ -60,7 +61,9 @@ class RectifiedFlow(nn.Module):
                     spec = spec[:, None, :, :]
             else:
                 spec = None
-            x = self.inference(cond, b=b, x_end=spec, device=device)
+            # cond stays the same across all sampling steps, so its projections are computed only once
+            with self.velocity_fn.cache_conditioner(cond):
+                x = self.inference(cond, b=b, x_end=spec, device=device, noise_fn=noise_fn)
             return self.denorm_spec(x)
 
     @torch.no_grad()
@@ -102,8 +105,11 @@ class RectifiedFlow(nn.Module):
         return x, t
 
     @torch.no_grad()
-    def inference(self, cond, b=1, x_end=None, device=None):
-        noise = torch.randn(b, self.num_feats, self.out_dims, cond.shape[2], device=device)
+    def inference(self, cond, b=1, x_end=None, device=None, noise_fn=None):
+        if noise_fn is not None:
+            noise = noise_fn()
+        else:
+            noise = torch.randn(b, self.num_feats, self.out_dims, cond.shape[2], device=device)
         t_start = hparams.get('T_start_infer', self.t_start)
         if self.use_shallow_diffusion and t_start > 0:
             assert x_end is not None, 'Missing shallow diffusion source.'
@@ -132,7 +138,8 @@ class RectifiedFlow(nn.Module):
             dts = torch.tensor([dt]).to(x)
             for i in tqdm(range(infer_step), desc='sample time step', total=infer_step,
                           disable=not hparams['infer'], leave=False):
-                x, _ = algorithm_fn(x, t_start + i * dts, dt, cond)
+                with record_function('sampling_step'):
+                    x, _ = algorithm_fn(x, t_start + i * dts, dt, cond)
             x = x.float()
         x = x.transpose(2, 3).squeeze(1)  # [B, F, M, T] => [B, T, M] or [B, F, T, M]
         return x
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.profiler import record_function
 
 from modules.commons.common_layers import (
     NormalInitEmbedding as Embedding,
@@ -78,21 +79,29 @@ class FastSpeech2Acoustic(nn.Module):
     def forward(
             self, txt_tokens, mel2ph, f0,
             key_shift=None, speed=None,
-            spk_embed_id=None, **kwargs
+            spk_embed_id=None, ph_seg=None, **kwargs
     ):
+        """
+        :param ph_seg: [B, T_ph], index of the utterance of each phoneme in packed rows (see packing_frames);
+            spk_embed_id, key_shift and speed are then given for each frame
+        """
         txt_embed = self.txt_embed(txt_tokens)
         dur = mel2ph_to_dur(mel2ph, txt_tokens.shape[1]).float()
         dur_embed = self.dur_embed(dur[:, :, None])
-        encoder_out = self.encoder(txt_embed, dur_embed, txt_tokens == 0)
+        with record_function('encoder'):
+            encoder_out = self.encoder(txt_embed, dur_embed, txt_tokens == 0, segment_ids=ph_seg)
 
-        encoder_out = F.pad(encoder_out, [0, 0, 1, 0])
-        mel2ph_ = mel2ph[..., None].repeat([1, 1, encoder_out.shape[-1]])
-        condition = torch.gather(encoder_out, 1, mel2ph_)
+        with record_function('length_regulation'):
+            encoder_out = F.pad(encoder_out, [0, 0, 1, 0])
+            mel2ph_ = mel2ph[..., None].repeat([1, 1, encoder_out.shape[-1]])
+            condition = torch.gather(encoder_out, 1, mel2ph_)
 
         if self.use_spk_id:
             spk_mix_embed = kwargs.get('spk_mix_embed')
             if spk_mix_embed is not None:
                 spk_embed = spk_mix_embed
+            elif spk_embed_id.dim() == 2:  # [B, T_s] in packed rows
+                spk_embed = self.spk_embed(spk_embed_id)
             else:
                 spk_embed = self.spk_embed(spk_embed_id)[:, None, :]
             condition += spk_embed
@@ -4,6 +4,7 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 
+import utils
 from modules.commons.common_layers import SinusoidalPositionalEmbedding, EncSALayer
 from modules.commons.espnet_positional_embedding import RelPositionalEncoding
 
@@ -280,15 +281,17 @@ class LengthRegulator(torch.nn.Module):
     def forward(self, dur, dur_padding=None, alpha=None):
         """
         Example (no batch dim version):
-            1. dur = [2,2,3]
-            2. token_idx = [[1],[2],[3]], dur_cumsum = [2,4,7], dur_cumsum_prev = [0,2,4]
-            3. token_mask = [[1,1,0,0,0,0,0],
-                             [0,0,1,1,0,0,0],
-                             [0,0,0,0,1,1,1]]
-            4. token_idx * token_mask = [[1,1,0,0,0,0,0],
-                                         [0,0,2,2,0,0,0],
-                                         [0,0,0,0,3,3,3]]
-            5. (token_idx * token_mask).sum(0) = [1,1,2,2,3,3,3]
+            1. dur = [2,0,2,3]
+            2. dur_cumsum = [2,2,4,7], token_start = [0,2,2,4]
+            3. mark the start frame of each token with non-zero duration (tokens 1,3,4):
+               start_mask = [1,0,1,0,1,0,0]
+            4. ordinal of the covering token among non-zero tokens:
+               ordinal = cumsum(start_mask) = [1,1,2,2,3,3,3]
+            5. map ordinals back to token indices:
+               ordinal_to_token = [_,1,3,4]
+            6. ordinal_to_token[ordinal] = [1,1,3,3,4,4,4]
+        All intermediate tensors have the size of either dur or mel2ph, so memory is
+        O(B * (T_txt + T_speech)) instead of O(B * T_txt * T_speech).
 
         :param dur: Batch of durations of each frame (B, T_txt)
         :param dur_padding: Batch of padding of each frame (B, T_txt)
@@ -301,13 +304,19 @@ class LengthRegulator(torch.nn.Module):
             dur = torch.round(dur.float() * alpha).long()
         if dur_padding is not None:
             dur = dur * (1 - dur_padding.long())
-        token_idx = torch.arange(1, dur.shape[1] + 1)[None, :, None].to(dur.device)
+        token_idx = torch.arange(1, dur.shape[1] + 1, device=dur.device)[None, :].expand_as(dur)
         dur_cumsum = torch.cumsum(dur, 1)
-        dur_cumsum_prev = F.pad(dur_cumsum, [1, -1], mode='constant', value=0)
-
-        pos_idx = torch.arange(dur.sum(-1).max())[None, None].to(dur.device)
-        token_mask = (pos_idx >= dur_cumsum_prev[:, :, None]) & (pos_idx < dur_cumsum[:, :, None])
-        mel2ph = (token_idx * token_mask.long()).sum(1)
+        token_nonzero = (dur > 0).long()
+
+        pos_idx = torch.arange(dur.sum(-1).max(), device=dur.device)[None]
+        # slot 0 collects tokens with zero duration, which do not cover any frame
+        token_start = (dur_cumsum - dur + 1) * token_nonzero
+        start_mask = torch.zeros((dur.shape[0], pos_idx.shape[1] + 1), dtype=torch.long, device=dur.device)
+        start_mask.scatter_(1, token_start, token_nonzero)
+        ordinal = torch.cumsum(start_mask[:, 1:], 1)
+        ordinal_to_token = torch.zeros((dur.shape[0], dur.shape[1] + 1), dtype=torch.long, device=dur.device)
+        ordinal_to_token.scatter_(1, torch.cumsum(token_nonzero, 1) * token_nonzero, token_idx * token_nonzero)
+        mel2ph = torch.gather(ordinal_to_token, 1, ordinal) * (pos_idx < dur_cumsum[:, -1:]).long()
         return mel2ph
 
 
@@ -380,13 +389,23 @@ class FastSpeech2Encoder(nn.Module):
                 hidden_size, self.padding_idx, init_size=DEFAULT_MAX_TARGET_POSITIONS,
             )
 
-    def forward_embedding(self, main_embed, extra_embed=None, padding_mask=None):
+    def forward_embedding(self, main_embed, extra_embed=None, padding_mask=None, segment_ids=None):
         # embed tokens and positions
         x = self.embed_scale * main_embed
         if extra_embed is not None:
             x = x + extra_embed
         if self.use_pos_embed:
-            if self.rel_pos:
+            if segment_ids is not None:
+                # positions restart in each segment of packed sequences
+                pos_from_start, _ = utils.segment_positions(segment_ids)
+                if self.rel_pos:
+                    x = self.embed_positions(x, positions=pos_from_start)
+                else:
+                    positions = self.embed_positions(
+                        segment_ids, positions=(pos_from_start + 1) * (segment_ids > 0) + self.padding_idx
+                    )
+                    x = x + positions
+            elif self.rel_pos:
                 x = self.embed_positions(x)
             else:
                 positions = self.embed_positions(~padding_mask)
@@ -394,8 +413,16 @@ class FastSpeech2Encoder(nn.Module):
         x = F.dropout(x, p=self.dropout, training=self.training)
         return x
 
-    def forward(self, main_embed, extra_embed, padding_mask, attn_mask=None, return_hiddens=False):
-        x = self.forward_embedding(main_embed, extra_embed, padding_mask=padding_mask)  # [B, T, H]
+    def forward(self, main_embed, extra_embed, padding_mask, attn_mask=None, return_hiddens=False, segment_ids=None):
+        """
+        :param segment_ids: [B, T], 1-based index of the sequence at each position when several
+            sequences are packed into one row, 0 for padding; attention and convolutions do not cross sequences
+        """
+        if segment_ids is not None and attn_mask is None:
+            attn_mask = utils.segment_attention_mask(segment_ids)
+        x = self.forward_embedding(
+            main_embed, extra_embed, padding_mask=padding_mask, segment_ids=segment_ids
+        )  # [B, T, H]
         nonpadding_mask_TB = 1 - padding_mask.transpose(0, 1).float()[:, :, None]  # [T, B, 1]
 
         # NOTICE:
@@ -415,7 +442,9 @@ class FastSpeech2Encoder(nn.Module):
         x = x.transpose(0, 1) * nonpadding_mask_TB
         hiddens = []
         for layer in self.layers:
-            x = layer(x, encoder_padding_mask=padding_mask, attn_mask=attn_mask) * nonpadding_mask_TB
+            x = layer(
+                x, encoder_padding_mask=padding_mask, attn_mask=attn_mask, segment_ids=segment_ids
+            ) * nonpadding_mask_TB
             hiddens.append(x)
         x = self.layer_norm(x) * nonpadding_mask_TB
         if return_hiddens:
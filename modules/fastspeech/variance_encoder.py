@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.profiler import record_function
 
 from modules.commons.common_layers import (
     NormalInitEmbedding as Embedding,
@@ -45,7 +46,9 @@ class FastSpeech2Variance(nn.Module):
                 dur_loss_type=dur_hparams['loss_type']
             )
 
-    def forward(self, txt_tokens, midi, ph2word, ph_dur=None, word_dur=None, spk_embed=None, infer=True):
+    def forward(
+            self, txt_tokens, midi, ph2word, ph_dur=None, word_dur=None, spk_embed=None, infer=True, ph_seg=None
+    ):
         """
         :param txt_tokens: (train, infer) [B, T_ph]
         :param midi: (train, infer) [B, T_ph]
@@ -54,6 +57,7 @@ class FastSpeech2Variance(nn.Module):
         :param word_dur: (infer) [B, T_w]
         :param spk_embed: (train) [B, T_ph, H]
         :param infer: whether inference
+        :param ph_seg: (train) [B, T_ph], index of the utterance of each phoneme in packed rows
         :return: encoder_out, ph_dur_pred
         """
         txt_embed = self.txt_embed(txt_tokens)
@@ -69,17 +73,22 @@ class FastSpeech2Variance(nn.Module):
             word_dur = torch.gather(F.pad(word_dur, [1, 0], value=0), 1, ph2word)  # [B, T_w] => [B, T_ph]
             word_dur_embed = self.word_dur_embed(word_dur.float()[:, :, None])
 
-            encoder_out = self.encoder(txt_embed, onset_embed + word_dur_embed, txt_tokens == 0)
+            with record_function('encoder'):
+                encoder_out = self.encoder(
+                    txt_embed, onset_embed + word_dur_embed, txt_tokens == 0, segment_ids=ph_seg
+                )
         else:
             ph_dur_embed = self.ph_dur_embed(ph_dur.float()[:, :, None])
-            encoder_out = self.encoder(txt_embed, ph_dur_embed, txt_tokens == 0)
+            with record_function('encoder'):
+                encoder_out = self.encoder(txt_embed, ph_dur_embed, txt_tokens == 0, segment_ids=ph_seg)
 
         if self.predict_dur:
             midi_embed = self.midi_embed(midi)  # => [B, T_ph, H]
             dur_cond = encoder_out + midi_embed
             if spk_embed is not None:
                 dur_cond += spk_embed
-            ph_dur_pred = self.dur_predictor(dur_cond, x_masks=txt_tokens == PAD_INDEX, infer=infer)
+            with record_function('dur_predictor'):
+                ph_dur_pred = self.dur_predictor(dur_cond, x_masks=txt_tokens == PAD_INDEX, infer=infer)
 
             return encoder_out, ph_dur_pred
         else:
@@ -113,12 +122,13 @@ class MelodyEncoder(nn.Module):
         )
         self.out_proj = Linear(hidden_size, hparams['hidden_size'])
 
-    def forward(self, note_midi, note_rest, note_dur, glide=None):
+    def forward(self, note_midi, note_rest, note_dur, glide=None, note_seg=None):
         """
         :param note_midi: float32 [B, T_n], -1: padding
         :param note_rest: bool [B, T_n]
         :param note_dur: int64 [B, T_n]
         :param glide: int64 [B, T_n]
+        :param note_seg: int64 [B, T_n], index of the utterance of each note in packed rows
         :return: [B, T_n, H]
         """
         midi_embed = self.note_midi_embed(note_midi[:, :, None]) * ~note_rest[:, :, None]
@@ -128,7 +138,7 @@ class MelodyEncoder(nn.Module):
             ornament_embed += self.note_glide_embed(glide) * self.glide_embed_scale
         encoder_out = self.encoder(
             midi_embed, dur_embed + ornament_embed,
-            padding_mask=note_midi < 0
+            padding_mask=note_midi < 0, segment_ids=note_seg
         )
         encoder_out = self.out_proj(encoder_out)
         return encoder_out
@@ -27,7 +27,13 @@ class DurationLoss(nn.Module):
     def linear2log(self, any_dur):
         return torch.log(any_dur + self.offset)
 
-    def forward(self, dur_pred: Tensor, dur_gt: Tensor, ph2word: Tensor) -> Tensor:
+    def forward(self, dur_pred: Tensor, dur_gt: Tensor, ph2word: Tensor, segments: Tensor = None) -> Tensor:
+        """
+        :param dur_pred: [B, T_ph]
+        :param dur_gt: [B, T_ph]
+        :param ph2word: [B, T_ph]
+        :param segments: [B, T_ph], index of the utterance of each phoneme in packed rows, 0 for padding
+        """
         dur_gt = dur_gt.to(dtype=dur_pred.dtype)
 
         # pdur_loss
@@ -46,8 +52,15 @@ class DurationLoss(nn.Module):
         wdur_loss = self.lambda_wdur * self.loss(self.linear2log(wdur_pred), self.linear2log(wdur_gt))
 
         # sdur loss
-        sdur_pred = dur_pred.sum(dim=1)
-        sdur_gt = dur_gt.sum(dim=1)
+        if segments is None:
+            sdur_pred = dur_pred.sum(dim=1)
+            sdur_gt = dur_gt.sum(dim=1)
+        else:
+            # one sentence for each utterance in the packed rows
+            shape = dur_pred.shape[0], segments.max() + 1
+            valid = segments.new_zeros(*shape).scatter_add(1, segments, torch.ones_like(segments))[:, 1:] > 0
+            sdur_pred = dur_pred.new_zeros(*shape).scatter_add(1, segments, dur_pred)[:, 1:][valid]
+            sdur_gt = dur_gt.new_zeros(*shape).scatter_add(1, segments, dur_gt)[:, 1:][valid]
         sdur_loss = self.lambda_sdur * self.loss(self.linear2log(sdur_pred), self.linear2log(sdur_gt))
 
         # combine
@@ -1,9 +1,12 @@
+from basics.base_pe import BasePE
 from utils import hparams
 
 from .pm import ParselmouthPE
 from .pw import HarvestPE
 from .rmvpe import RMVPE
 
+pitch_extractor: BasePE = None
+
 
 def initialize_pe():
     pe = hparams['pe']
@@ -11,8 +14,23 @@ def initialize_pe():
     if pe == 'parselmouth':
         return ParselmouthPE()
     elif pe == 'rmvpe':
-        return RMVPE(pe_ckpt)
+        return RMVPE(
+            pe_ckpt, batch_frames=hparams.get('pe_batch_frames', 16384),
+            # keep the results of a whole prefetched bucket until its items are processed
+            cache_size=max(256, hparams.get('binarization_args', {}).get('pe_batch_size', 1)),
+            chunk_frames=hparams.get('pe_chunk_frames', 0), context_frames=hparams.get('pe_context_frames', 256)
+        )
     elif pe == 'harvest':
         return HarvestPE()
     else:
         raise ValueError(f" [x] Unknown f0 extractor: {pe}")
+
+
+def get_pitch_extractor() -> BasePE:
+    """
+    Get the pitch extractor shared by the binarizer and the augmentations in the current process.
+    """
+    global pitch_extractor
+    if pitch_extractor is None:
+        pitch_extractor = initialize_pe()
+    return pitch_extractor
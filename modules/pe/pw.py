@@ -8,7 +8,7 @@ class HarvestPE(BasePE):
     def get_pitch(
             self, waveform, samplerate, length,
             *, hop_size, f0_min=65, f0_max=1100,
-            speed=1, interp_uv=False
+            speed=1, interp_uv=False, key=None
     ):
         hop_size = int(np.round(hop_size * speed))
         time_step = 1000 * hop_size / samplerate
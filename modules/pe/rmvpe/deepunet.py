@@ -3,6 +3,26 @@ import torch.nn as nn
 from .constants import N_MELS
 
 
+def apply_time_mask(x, mask):
+    """
+    Zero out the padding frames of each item in a batch, so that the convolutions see the
+    same zeros as on a single unpadded item.
+    :param x: [B, C, T, F], with T equal to or downsampled from the length of the mask
+    :param mask: [B, T_max], or None to keep x unchanged
+    """
+    if mask is None:
+        return x
+    return x * mask[:, None, ::mask.shape[1] // x.shape[2], None]
+
+
+def masked_forward(layers, x, mask):
+    for layer in layers:
+        if isinstance(layer, (nn.Conv2d, nn.ConvTranspose2d)):
+            x = apply_time_mask(x, mask)
+        x = layer(x)
+    return x
+
+
 class ConvBlockRes(nn.Module):
     def __init__(self, in_channels, out_channels, momentum=0.01):
         super(ConvBlockRes, self).__init__()
@@ -31,11 +51,11 @@ class ConvBlockRes(nn.Module):
         else:
             self.is_shortcut = False
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         if self.is_shortcut:
-            return self.conv(x) + self.shortcut(x)
+            return masked_forward(self.conv, x, mask) + self.shortcut(x)
         else:
-            return self.conv(x) + x
+            return masked_forward(self.conv, x, mask) + x
 
 
 class ResEncoderBlock(nn.Module):
@@ -50,9 +70,9 @@ class ResEncoderBlock(nn.Module):
         if self.kernel_size is not None:
             self.pool = nn.AvgPool2d(kernel_size=kernel_size)
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         for i in range(self.n_blocks):
-            x = self.conv[i](x)
+            x = self.conv[i](x, mask=mask)
         if self.kernel_size is not None:
             return x, self.pool(x)
         else:
@@ -80,11 +100,11 @@ class ResDecoderBlock(nn.Module):
         for i in range(n_blocks-1):
             self.conv2.append(ConvBlockRes(out_channels, out_channels, momentum))
 
-    def forward(self, x, concat_tensor):
-        x = self.conv1(x)
+    def forward(self, x, concat_tensor, mask=None):
+        x = masked_forward(self.conv1, x, mask)
         x = torch.cat((x, concat_tensor), dim=1)
         for i in range(self.n_blocks):
-            x = self.conv2[i](x)
+            x = self.conv2[i](x, mask=mask)
         return x
 
 
@@ -104,11 +124,11 @@ class Encoder(nn.Module):
         self.out_size = in_size
         self.out_channel = out_channels
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         concat_tensors = []
         x = self.bn(x)
         for i in range(self.n_encoders):
-            _, x = self.layers[i](x)
+            _, x = self.layers[i](x, mask=mask)
             concat_tensors.append(_)
         return x, concat_tensors
 
@@ -122,9 +142,9 @@ class Intermediate(nn.Module):
         for i in range(self.n_inters-1):
             self.layers.append(ResEncoderBlock(out_channels, out_channels, None, n_blocks, momentum))
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         for i in range(self.n_inters):
-            x = self.layers[i](x)
+            x = self.layers[i](x, mask=mask)
         return x
 
 
@@ -138,9 +158,9 @@ class Decoder(nn.Module):
             self.layers.append(ResDecoderBlock(in_channels, out_channels, stride, n_blocks, momentum))
             in_channels = out_channels
 
-    def forward(self, x, concat_tensors):
+    def forward(self, x, concat_tensors, mask=None):
         for i in range(self.n_decoders):
-            x = self.layers[i](x, concat_tensors[-1-i])
+            x = self.layers[i](x, concat_tensors[-1-i], mask=mask)
         return x
 
 
@@ -166,8 +186,12 @@ class DeepUnet0(nn.Module):
         self.tf = TimbreFilter(self.encoder.latent_channels)
         self.decoder = Decoder(self.encoder.out_channel, en_de_layers, kernel_size, n_blocks)
 
-    def forward(self, x):
-        x, concat_tensors = self.encoder(x)
-        x = self.intermediate(x)
-        x = self.decoder(x, concat_tensors)
+    def forward(self, x, mask=None):
+        """
+        :param x: [B, 1, T, M]
+        :param mask: [B, T], False on the padding frames of batched items whose lengths differ
+        """
+        x, concat_tensors = self.encoder(x, mask=mask)
+        x = self.intermediate(x, mask=mask)
+        x = self.decoder(x, concat_tensors, mask=mask)
         return x
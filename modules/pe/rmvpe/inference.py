@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -13,7 +15,8 @@ from .utils import to_local_average_f0, to_viterbi_f0
 
 
 class RMVPE(BasePE):
-    def __init__(self, model_path, hop_length=160):
+    def __init__(self, model_path, hop_length=160, batch_frames=16384, cache_size=256,
+                 chunk_frames=0, context_frames=256):
         self.resample_kernel = {}
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.model = E2E0(4, 1, (2, 2)).eval().to(self.device)
@@ -22,6 +25,16 @@ class RMVPE(BasePE):
         self.mel_extractor = MelSpectrogram(
             N_MELS, SAMPLE_RATE, WINDOW_LENGTH, hop_length, None, MEL_FMIN, MEL_FMAX
         ).to(self.device)
+        # maximum number of (padded) mel frames in one forward pass of batched inference
+        self.batch_frames = batch_frames
+        # waveforms longer than chunk_frames mel frames are run through the network in chunks,
+        # each with context_frames extra frames on both sides which are discarded afterwards
+        self.chunk_frames = chunk_frames
+        self.context_frames = context_frames
+        # raw f0 curves (10 ms) of recently extracted waveforms keyed on the names given by the callers,
+        # so that prefetched items and augmented copies of an item with different speeds do not run the network again
+        self.cache_size = cache_size
+        self.f0_cache = OrderedDict()
 
     @torch.no_grad()
     def mel2hidden(self, mel):
@@ -30,41 +43,201 @@ class RMVPE(BasePE):
         hidden = self.model(mel)
         return hidden[:, :n_frames]
 
-    def decode(self, hidden, thred=0.03, use_viterbi=False):
+    @torch.no_grad()
+    def mel2hidden_batch(self, mels):
+        """
+        Each item is padded to a multiple of 32 frames as in mel2hidden(), and the network masks
+        the frames beyond that, so the results do not depend on the other items in the batch.
+        :param mels: list of [M, T_i]
+        :return: [B, T_max, N]
+        """
+        n_frames = max(mel.shape[-1] for mel in mels)
+        n_frames_padded = 32 * ((n_frames - 1) // 32 + 1)
+        mel = torch.stack([
+            F.pad(m, (0, n_frames_padded - m.shape[-1]), mode='constant') for m in mels
+        ])
+        lengths = torch.LongTensor([32 * ((m.shape[-1] - 1) // 32 + 1) for m in mels]).to(mel.device)
+        hidden = self.model(mel, lengths=lengths)
+        return hidden[:, :n_frames]
+
+    def decode(self, hidden, thred=0.03, use_viterbi=False, lengths=None):
         if use_viterbi:
-            f0 = to_viterbi_f0(hidden, thred=thred)
+            f0 = to_viterbi_f0(hidden, thred=thred, lengths=lengths)
         else:
             f0 = to_local_average_f0(hidden, thred=thred)
         return f0
 
+    def resample(self, audio, sample_rate):
+        if sample_rate == 16000:
+            return audio
+        key_str = str(sample_rate)
+        if key_str not in self.resample_kernel:
+            self.resample_kernel[key_str] = Resample(sample_rate, 16000, lowpass_filter_width=128)
+        self.resample_kernel[key_str] = self.resample_kernel[key_str].to(self.device)
+        return self.resample_kernel[key_str](audio)
+
+    def num_frames(self, audio_res):
+        return audio_res.shape[-1] // self.mel_extractor.hop_length + 1
+
+    @torch.no_grad()
+    def iter_hidden_chunks(self, audio_res, chunk_frames=None, context_frames=None):
+        """
+        Run the network on overlapping chunks of a (resampled) waveform and yield the salience
+        of consecutive frames, so that the peak memory does not grow with the waveform length.
+        The mel-spectrogram of each chunk is computed from its own span of the waveform and
+        equals the corresponding frames of the whole mel-spectrogram.
+        :param audio_res: [1, T_wav] at 16 kHz
+        :param chunk_frames: number of frames kept from each chunk
+        :param context_frames: number of extra frames on each side of a chunk that are discarded
+        :return: generator of [1, T_chunk, N]
+        """
+        if chunk_frames is None:
+            chunk_frames = self.chunk_frames
+        if context_frames is None:
+            context_frames = self.context_frames
+        assert chunk_frames > 0, 'Chunk length must be positive.'
+        hop_length = self.mel_extractor.hop_length
+        n_fft = self.mel_extractor.n_fft
+        n_frames = self.num_frames(audio_res)
+        # the same padding as center=True, so that frame i covers audio_pad[i * hop : i * hop + n_fft]
+        audio_pad = F.pad(audio_res[:, None], (n_fft // 2, n_fft // 2), mode='reflect')[:, 0]
+        for start in range(0, n_frames, chunk_frames):
+            end = min(start + chunk_frames, n_frames)
+            ctx_start = max(0, start - context_frames)
+            ctx_end = min(n_frames, end + context_frames)
+            mel = self.mel_extractor(
+                audio_pad[:, ctx_start * hop_length: (ctx_end - 1) * hop_length + n_fft], center=False
+            )
+            hidden = self.mel2hidden(mel)
+            yield hidden[:, start - ctx_start: end - ctx_start]
+
     def infer_from_audio(self, audio, sample_rate=16000, thred=0.03, use_viterbi=False):
         audio = torch.from_numpy(audio).float().unsqueeze(0).to(self.device)
-        if sample_rate == 16000:
-            audio_res = audio
+        audio_res = self.resample(audio, sample_rate)
+        if 0 < self.chunk_frames < self.num_frames(audio_res):
+            hidden = torch.cat(list(self.iter_hidden_chunks(audio_res)), dim=1)
         else:
-            key_str = str(sample_rate)
-            if key_str not in self.resample_kernel:
-                self.resample_kernel[key_str] = Resample(sample_rate, 16000, lowpass_filter_width=128)
-            self.resample_kernel[key_str] = self.resample_kernel[key_str].to(self.device)
-            audio_res = self.resample_kernel[key_str](audio)
-        mel = self.mel_extractor(audio_res, center=True)
-        hidden = self.mel2hidden(mel)
+            mel = self.mel_extractor(audio_res, center=True)
+            hidden = self.mel2hidden(mel)
         f0 = self.decode(hidden, thred=thred, use_viterbi=use_viterbi)
         return f0
 
+    def infer_from_audio_stream(self, audio, sample_rate=16000, thred=0.03, chunk_frames=None, context_frames=None):
+        """
+        Streaming version of infer_from_audio() that yields f0 of consecutive chunks as soon as
+        they are finished. Viterbi decoding needs the whole sequence and is not supported here.
+        See iter_hidden_chunks() for the arguments.
+        :return: generator of f0 curves with 10 ms time step
+        """
+        audio = torch.from_numpy(audio).float().unsqueeze(0).to(self.device)
+        audio_res = self.resample(audio, sample_rate)
+        for hidden in self.iter_hidden_chunks(audio_res, chunk_frames=chunk_frames, context_frames=context_frames):
+            yield self.decode(hidden, thred=thred)
+
+    def build_buckets(self, lengths):
+        """
+        Group items into buckets of similar lengths, each of which fits in the frame budget
+        after padding. Items longer than the budget are put into buckets of their own.
+        :param lengths: number of mel frames of each item
+        :return: list of buckets of item indices
+        """
+        buckets = []
+        bucket = []
+        for i in sorted(range(len(lengths)), key=lambda x: lengths[x]):
+            padded = 32 * ((lengths[i] - 1) // 32 + 1)
+            if len(bucket) > 0 and (len(bucket) + 1) * padded > self.batch_frames:
+                buckets.append(bucket)
+                bucket = []
+            bucket.append(i)
+        if len(bucket) > 0:
+            buckets.append(bucket)
+        return buckets
+
+    @torch.no_grad()
+    def infer_from_audio_batch(self, audios, sample_rate=16000, thred=0.03, use_viterbi=False):
+        """
+        Batched version of infer_from_audio(). The waveforms are sorted by length and run through
+        the network in padded batches of at most self.batch_frames frames.
+        :param audios: list of waveforms
+        :return: list of f0 curves with 10 ms time step
+        """
+        f0s = [None] * len(audios)
+        mels = {}
+        for i, audio in enumerate(audios):
+            audio_res = self.resample(torch.from_numpy(audio).float().unsqueeze(0).to(self.device), sample_rate)
+            if 0 < self.chunk_frames < self.num_frames(audio_res):
+                # too long to be batched; run it in chunks instead
+                hidden = torch.cat(list(self.iter_hidden_chunks(audio_res)), dim=1)
+                f0s[i] = self.decode(hidden, thred=thred, use_viterbi=use_viterbi)
+            else:
+                mels[i] = self.mel_extractor(audio_res, center=True)[0]
+        indices = list(mels.keys())
+        for bucket in self.build_buckets([mels[i].shape[-1] for i in indices]):
+            bucket = [indices[j] for j in bucket]
+            lengths = [mels[i].shape[-1] for i in bucket]
+            hidden = self.mel2hidden_batch([mels[i] for i in bucket])
+            f0 = self.decode(hidden, thred=thred, use_viterbi=use_viterbi, lengths=lengths)
+            f0 = f0.reshape(len(bucket), -1)  # decode() squeezes the batch dimension of single items
+            for i, f0_i, length in zip(bucket, f0, lengths):
+                f0s[i] = f0_i[:length]
+        return f0s
+
+    def extract_f0(self, waveforms, samplerate, keys=None):
+        """
+        Get the raw f0 curves of the waveforms from the cache, or extract the missing ones in batches.
+        :param keys: names of the waveforms (e.g. item names) to look up and store the results in the cache,
+        or None to extract all of them without caching
+        :return: list of f0 curves with 10 ms time step
+        """
+        if keys is None:
+            return self.infer_from_audio_batch(waveforms, sample_rate=samplerate)
+        results = {}
+        missing = {}
+        for key, waveform in zip(keys, waveforms):
+            if key in self.f0_cache:
+                self.f0_cache.move_to_end(key)
+                results[key] = self.f0_cache[key]
+            else:
+                missing[key] = waveform
+        if len(missing) > 0:
+            f0s = self.infer_from_audio_batch(list(missing.values()), sample_rate=samplerate)
+            for key, f0 in zip(missing.keys(), f0s):
+                results[key] = self.f0_cache[key] = f0
+            while len(self.f0_cache) > self.cache_size:
+                self.f0_cache.popitem(last=False)
+        return [results[key] for key in keys]
+
+    def prefetch_pitch(self, waveforms, samplerate, keys):
+        self.extract_f0(waveforms, samplerate, keys=keys)
+
     def get_pitch(
             self, waveform, samplerate, length,
             *, hop_size, f0_min=65, f0_max=1100,
-            speed=1, interp_uv=False
+            speed=1, interp_uv=False, key=None
     ):
-        f0 = self.infer_from_audio(waveform, sample_rate=samplerate)
-        uv = f0 == 0
-        f0, uv = interp_f0(f0, uv)
-
-        hop_size = int(np.round(hop_size * speed))
-        time_step = hop_size / samplerate
-        f0_res = resample_align_curve(f0, 0.01, time_step, length)
-        uv_res = resample_align_curve(uv.astype(np.float32), 0.01, time_step, length) > 0.5
-        if not interp_uv:
-            f0_res[uv_res] = 0
-        return f0_res, uv_res
+        return self.get_pitch_batch(
+            [waveform], samplerate, [length],
+            hop_size=hop_size, f0_min=f0_min, f0_max=f0_max,
+            speeds=[speed], interp_uv=interp_uv, keys=None if key is None else [key]
+        )[0]
+
+    def get_pitch_batch(
+            self, waveforms, samplerate, lengths,
+            *, hop_size, f0_min=65, f0_max=1100,
+            speeds=None, interp_uv=False, keys=None
+    ):
+        if speeds is None:
+            speeds = [1] * len(waveforms)
+        results = []
+        for f0, length, speed in zip(self.extract_f0(waveforms, samplerate, keys=keys), lengths, speeds):
+            uv = f0 == 0
+            f0, uv = interp_f0(f0, uv)
+
+            hop_size_real = int(np.round(hop_size * speed))
+            time_step = hop_size_real / samplerate
+            f0_res = resample_align_curve(f0, 0.01, time_step, length)
+            uv_res = resample_align_curve(uv.astype(np.float32), 0.01, time_step, length) > 0.5
+            if not interp_uv:
+                f0_res[uv_res] = 0
+            results.append((f0_res, uv_res))
+        return results
@@ -1,7 +1,8 @@
+import torch
 from torch import nn
 
 from .constants import *
-from .deepunet import DeepUnet0
+from .deepunet import DeepUnet0, apply_time_mask
 from .seq import BiGRU
 
 
@@ -25,8 +26,22 @@ class E2E0(nn.Module):
                 nn.Sigmoid()
             )
 
-    def forward(self, mel):
+    def forward(self, mel, lengths=None):
+        """
+        :param mel: [B, M, T]
+        :param lengths: [B], numbers of frames of the items if they are padded to T,
+        so that each item gets the same results as if it were run alone
+        :return: [B, T, N_CLASS]
+        """
+        mask = None
+        if lengths is not None:
+            mask = torch.arange(mel.shape[-1], device=mel.device)[None] < lengths[:, None]
         mel = mel.transpose(-1, -2).unsqueeze(1)
-        x = self.cnn(self.unet(mel)).transpose(1, 2).flatten(-2)
-        x = self.fc(x)
+        x = apply_time_mask(self.unet(mel, mask=mask), mask)
+        x = self.cnn(x).transpose(1, 2).flatten(-2)
+        if isinstance(self.fc[0], BiGRU):
+            x = self.fc[0](x, lengths=lengths)
+            x = self.fc[1:](x)
+        else:
+            x = self.fc(x)
         return x
@@ -6,5 +6,11 @@ class BiGRU(nn.Module):
         super(BiGRU, self).__init__()
         self.gru = nn.GRU(input_features, hidden_features, num_layers=num_layers, batch_first=True, bidirectional=True)
 
-    def forward(self, x):
-        return self.gru(x)[0]
+    def forward(self, x, lengths=None):
+        if lengths is None:
+            return self.gru(x)[0]
+        # the backward direction of each item must start from its own last frame
+        total_length = x.shape[1]
+        x = nn.utils.rnn.pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+        x = self.gru(x)[0]
+        return nn.utils.rnn.pad_packed_sequence(x, batch_first=True, total_length=total_length)[0]
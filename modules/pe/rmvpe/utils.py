@@ -1,6 +1,6 @@
-import librosa
 import numpy as np
 import torch
+import torch.nn.functional as F
 
 from .constants import *
 
@@ -23,21 +23,69 @@ def to_local_average_f0(hidden, center=None, thred=0.03):
     return f0.squeeze(0).cpu().numpy()
 
 
-def to_viterbi_f0(hidden, thred=0.03):
-    # Create viterbi transition matrix
-    if not hasattr(to_viterbi_f0, 'transition'):
-        xx, yy = np.meshgrid(range(N_CLASS), range(N_CLASS))
-        transition = np.maximum(30 - abs(xx - yy), 0)
-        transition = transition / transition.sum(axis=1, keepdims=True)
-        to_viterbi_f0.transition = transition
+def viterbi_decode(prob, lengths=None, band=30):
+    """
+    Batched Viterbi decoding with the transition matrix A[i, j] ~ max(band - |i - j|, 0),
+    normalized over j, and a uniform initial distribution. As in librosa.sequence.viterbi(),
+    zero transitions are taken as a tiny epsilon, so every out-of-band transition has the same
+    cost and only the best previous state is needed for them. This makes each step O(N * band)
+    instead of O(N^2).
+    :param prob: [B, T, N], normalized over N
+    :param lengths: [B], number of valid frames of each item; defaults to T
+    :param band: width of the non-zero band of the transition matrix
+    :return: [B, T] state sequences
+    """
+    B, T, N = prob.shape
+    device = prob.device
+    K = band - 1
+    eps = torch.finfo(prob.dtype).tiny
+    if lengths is None:
+        lengths = torch.full((B,), T, dtype=torch.long, device=device)
+    else:
+        lengths = torch.as_tensor(lengths, dtype=torch.long, device=device)
 
-    # Convert to probability
-    prob = hidden.squeeze(0).cpu().numpy()
-    prob = prob.T
-    prob = prob / prob.sum(axis=0)
+    # log_trans_band[j, k]: log A[j + k - K, j], or -inf if state j + k - K does not exist
+    offsets = torch.arange(-K, K + 1, device=device)
+    weights = (band - offsets.abs()).double()  # [2K+1]
+    src = torch.arange(N, device=device)[:, None] + offsets  # [N, 2K+1]
+    valid = (src >= 0) & (src < N)
+    # row sums of the transition weights, for each source state
+    row_sums = torch.zeros(N + 2 * K, dtype=torch.float64, device=device).index_add_(
+        0, (src + K).flatten(), weights.expand(N, -1).flatten()
+    )[K: N + K]
+    log_trans_band = torch.log(weights / row_sums[src.clamp(0, N - 1)] + eps)
+    log_trans_band = log_trans_band.masked_fill(~valid, -float('inf')).to(prob.dtype)
+    log_eps = float(np.log(eps))
 
-    # Perform viterbi decoding
-    path = librosa.sequence.viterbi(prob, to_viterbi_f0.transition).astype(np.int64)
-    center = torch.from_numpy(path).unsqueeze(0).unsqueeze(-1).to(hidden.device)
+    log_prob = torch.log(prob + eps)
+    value = log_prob[:, 0] + float(np.log(1. / N + eps))
+    ptr = torch.zeros(B, T, N, dtype=torch.int16, device=device)
+    last_state = torch.argmax(value, dim=1)
+    state_idx = torch.arange(N, device=device)
+    for t in range(1, T):
+        windows = F.pad(value, (K, K), value=-float('inf')).unfold(1, 2 * K + 1, 1)  # [B, N, 2K+1]
+        best, arg = (windows + log_trans_band).max(dim=2)  # [B, N]
+        arg = arg + state_idx - K
+        glob_best, glob_arg = value.max(dim=1, keepdim=True)  # [B, 1]
+        use_far = glob_best + log_eps > best
+        best = torch.where(use_far, glob_best + log_eps, best)
+        arg = torch.where(use_far, glob_arg, arg)
+        value = best + log_prob[:, t]
+        # only the differences between states matter, so keep the values small
+        value = value - value.max(dim=1, keepdim=True)[0]
+        ptr[:, t] = arg.to(torch.int16)
+        last_state = torch.where(lengths == t + 1, torch.argmax(value, dim=1), last_state)
 
+    path = torch.zeros(B, T, dtype=torch.long, device=device)
+    state = last_state
+    for t in range(T - 1, -1, -1):
+        state = torch.where(lengths == t + 1, last_state, state)
+        path[:, t] = state
+        state = ptr[:, t].gather(1, state[:, None]).squeeze(1).long()
+    return path
+
+
+def to_viterbi_f0(hidden, thred=0.03, lengths=None):
+    prob = hidden / hidden.sum(dim=2, keepdim=True)
+    center = viterbi_decode(prob, lengths=lengths).unsqueeze(-1)  # [B, T, 1]
     return to_local_average_f0(hidden, center=center, thred=thred)
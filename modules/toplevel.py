@@ -4,6 +4,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch import Tensor
+from torch.profiler import record_function
 
 from basics.base_module import CategorizedModule
 from modules.aux_decoder import AuxDecoderAdaptor
@@ -88,7 +89,7 @@ class DiffSingerAcoustic(CategorizedModule, ParameterAdaptorModule):
 
     def forward(
             self, txt_tokens, mel2ph, f0, key_shift=None, speed=None,
-            spk_embed_id=None, gt_mel=None, infer=True, **kwargs
+            spk_embed_id=None, gt_mel=None, infer=True, noise_fn=None, **kwargs
     ) -> ShallowDiffusionOutput:
         condition = self.fs2(
             txt_tokens, mel2ph, f0, key_shift=key_shift, speed=speed,
@@ -96,7 +97,8 @@ class DiffSingerAcoustic(CategorizedModule, ParameterAdaptorModule):
         )
         if infer:
             if self.use_shallow_diffusion:
-                aux_mel_pred = self.aux_decoder(condition, infer=True)
+                with record_function('aux_decoder'):
+                    aux_mel_pred = self.aux_decoder(condition, infer=True)
                 aux_mel_pred *= ((mel2ph > 0).float()[:, :, None])
                 if gt_mel is not None and self.shallow_args['val_gt_start']:
                     src_mel = gt_mel
@@ -104,25 +106,29 @@ class DiffSingerAcoustic(CategorizedModule, ParameterAdaptorModule):
                     src_mel = aux_mel_pred
             else:
                 aux_mel_pred = src_mel = None
-            mel_pred = self.diffusion(condition, src_spec=src_mel, infer=True)
+            with record_function('diffusion'):
+                mel_pred = self.diffusion(condition, src_spec=src_mel, infer=True, noise_fn=noise_fn)
             mel_pred *= ((mel2ph > 0).float()[:, :, None])
             return ShallowDiffusionOutput(aux_out=aux_mel_pred, diff_out=mel_pred)
         else:
             if self.use_shallow_diffusion:
                 if self.train_aux_decoder:
                     aux_cond = condition * self.aux_decoder_grad + condition.detach() * (1 - self.aux_decoder_grad)
-                    aux_out = self.aux_decoder(aux_cond, infer=False)
+                    with record_function('aux_decoder'):
+                        aux_out = self.aux_decoder(aux_cond, infer=False)
                 else:
                     aux_out = None
                 if self.train_diffusion:
-                    diff_out = self.diffusion(condition, gt_spec=gt_mel, infer=False)
+                    with record_function('diffusion'):
+                        diff_out = self.diffusion(condition, gt_spec=gt_mel, infer=False)
                 else:
                     diff_out = None
                 return ShallowDiffusionOutput(aux_out=aux_out, diff_out=diff_out)
 
             else:
                 aux_out = None
-                diff_out = self.diffusion(condition, gt_spec=gt_mel, infer=False)
+                with record_function('diffusion'):
+                    diff_out = self.diffusion(condition, gt_spec=gt_mel, infer=False)
                 return ShallowDiffusionOutput(aux_out=aux_out, diff_out=diff_out)
 
 
@@ -211,14 +217,22 @@ class DiffSingerVariance(CategorizedModule, ParameterAdaptorModule):
             note_midi=None, note_rest=None, note_dur=None, note_glide=None, mel2note=None,
             base_pitch=None, pitch=None, pitch_expr=None, pitch_retake=None,
             variance_retake: Dict[str, Tensor] = None,
-            spk_id=None, infer=True, **kwargs
+            spk_id=None, infer=True, ph_seg=None, note_seg=None, **kwargs
     ):
+        """
+        :param ph_seg: [B, T_ph], index of the utterance of each phoneme in packed rows (see packing_frames);
+            spk_id is then given for each phoneme
+        :param note_seg: [B, T_n], index of the utterance of each note in packed rows
+        """
         if self.use_spk_id:
             ph_spk_mix_embed = kwargs.get('ph_spk_mix_embed')
             spk_mix_embed = kwargs.get('spk_mix_embed')
             if ph_spk_mix_embed is not None and spk_mix_embed is not None:
                 ph_spk_embed = ph_spk_mix_embed
                 spk_embed = spk_mix_embed
+            elif spk_id.dim() == 2:  # [B, T_ph] in packed rows
+                ph_spk_embed = self.spk_embed(spk_id)  # [B, T_ph, H]
+                spk_embed = None  # gathered with mel2ph below
             else:
                 ph_spk_embed = spk_embed = self.spk_embed(spk_id)[:, None, :]  # [B,] => [B, T=1, H]
         else:
@@ -227,30 +241,34 @@ class DiffSingerVariance(CategorizedModule, ParameterAdaptorModule):
         encoder_out, dur_pred_out = self.fs2(
             txt_tokens, midi=midi, ph2word=ph2word,
             ph_dur=ph_dur, word_dur=word_dur,
-            spk_embed=ph_spk_embed, infer=infer
+            spk_embed=ph_spk_embed, infer=infer, ph_seg=ph_seg
         )
 
         if not self.predict_pitch and not self.predict_variances:
             return dur_pred_out, None, ({} if infer else None)
 
-        if mel2ph is None and word_dur is not None:  # inference from file
-            dur_pred_align = self.rr(dur_pred_out, ph2word, word_dur)
-            mel2ph = self.lr(dur_pred_align)
-            mel2ph = F.pad(mel2ph, [0, base_pitch.shape[1] - mel2ph.shape[1]])
+        with record_function('length_regulation'):
+            if mel2ph is None and word_dur is not None:  # inference from file
+                dur_pred_align = self.rr(dur_pred_out, ph2word, word_dur)
+                mel2ph = self.lr(dur_pred_align)
+                mel2ph = F.pad(mel2ph, [0, base_pitch.shape[1] - mel2ph.shape[1]])
 
-        encoder_out = F.pad(encoder_out, [0, 0, 1, 0])
-        mel2ph_ = mel2ph[..., None].repeat([1, 1, hparams['hidden_size']])
-        condition = torch.gather(encoder_out, 1, mel2ph_)
+            encoder_out = F.pad(encoder_out, [0, 0, 1, 0])
+            mel2ph_ = mel2ph[..., None].repeat([1, 1, hparams['hidden_size']])
+            condition = torch.gather(encoder_out, 1, mel2ph_)
 
         if self.use_spk_id:
+            if spk_embed is None:
+                spk_embed = torch.gather(F.pad(ph_spk_embed, [0, 0, 1, 0]), 1, mel2ph_)
             condition += spk_embed
 
         if self.predict_pitch:
             if self.use_melody_encoder:
-                melody_encoder_out = self.melody_encoder(
-                    note_midi, note_rest, note_dur,
-                    glide=note_glide
-                )
+                with record_function('melody_encoder'):
+                    melody_encoder_out = self.melody_encoder(
+                        note_midi, note_rest, note_dur,
+                        glide=note_glide, note_seg=note_seg
+                    )
                 melody_encoder_out = F.pad(melody_encoder_out, [0, 0, 1, 0])
                 mel2note_ = mel2note[..., None].repeat([1, 1, hparams['hidden_size']])
                 melody_condition = torch.gather(melody_encoder_out, 1, mel2note_)
@@ -286,10 +304,11 @@ class DiffSingerVariance(CategorizedModule, ParameterAdaptorModule):
                     base_pitch = base_pitch * pitch_retake + pitch * ~pitch_retake
                 pitch_cond += self.base_pitch_embed(base_pitch[:, :, None])
 
-            if infer:
-                pitch_pred_out = self.pitch_predictor(pitch_cond, infer=True)
-            else:
-                pitch_pred_out = self.pitch_predictor(pitch_cond, pitch - base_pitch, infer=False)
+            with record_function('pitch_predictor'):
+                if infer:
+                    pitch_pred_out = self.pitch_predictor(pitch_cond, infer=True)
+                else:
+                    pitch_pred_out = self.pitch_predictor(pitch_cond, pitch - base_pitch, infer=False)
         else:
             pitch_pred_out = None
 
@@ -308,7 +327,8 @@ class DiffSingerVariance(CategorizedModule, ParameterAdaptorModule):
             ]
             var_cond += torch.stack(variance_embeds, dim=-1).sum(-1)
 
-        variance_outputs = self.variance_predictor(var_cond, variance_inputs, infer=infer)
+        with record_function('variance_predictor'):
+            variance_outputs = self.variance_predictor(var_cond, variance_inputs, infer=infer)
 
         if infer:
             variances_pred_out = self.collect_variance_outputs(variance_outputs)
@@ -12,23 +12,26 @@ import pathlib
 import random
 from copy import deepcopy
 
-import librosa
 import numpy as np
 import torch
 
 from basics.base_binarizer import BaseBinarizer
-from basics.base_pe import BasePE
 from modules.fastspeech.tts_modules import LengthRegulator
-from modules.pe import initialize_pe
+from modules.pe import get_pitch_extractor
 from utils.binarizer_utils import (
     DecomposedWaveform,
     SinusoidalSmoothingConv1d,
+    array_digest,
+    cached_feature,
+    feature_params,
+    get_feature_cache,
     get_mel_torch,
     get_mel2ph_torch,
     get_energy_librosa,
     get_breathiness_pyworld,
     get_voicing_pyworld,
     get_tension_base_harmonic,
+    load_waveform,
 )
 from utils.hparams import hparams
 
@@ -47,7 +50,6 @@ ACOUSTIC_ITEM_ATTRIBUTES = [
     'speed',
 ]
 
-pitch_extractor: BasePE = None
 energy_smooth: SinusoidalSmoothingConv1d = None
 breathiness_smooth: SinusoidalSmoothingConv1d = None
 voicing_smooth: SinusoidalSmoothingConv1d = None
@@ -81,15 +83,42 @@ class AcousticBinarizer(BaseBinarizer):
 
         self.items.update(meta_data_dict)
 
-    @torch.no_grad()
-    def process_item(self, item_name, meta_data, binarization_args):
-        waveform, _ = librosa.load(meta_data['wav_fn'], sr=hparams['audio_sample_rate'], mono=True)
-        mel = get_mel_torch(
+    def initialize_worker(self):
+        get_pitch_extractor()
+
+    def get_mel(self, wav_fn, waveform):
+        return cached_feature(wav_fn, 'mel', feature_params(
+            'audio_sample_rate', 'audio_num_mel_bins', 'hop_size', 'win_size', 'fft_size', 'fmin', 'fmax', 'mel_base'
+        ), lambda: get_mel_torch(
             waveform, hparams['audio_sample_rate'], num_mel_bins=hparams['audio_num_mel_bins'],
             hop_size=hparams['hop_size'], win_size=hparams['win_size'], fft_size=hparams['fft_size'],
             fmin=hparams['fmin'], fmax=hparams['fmax'], mel_base=hparams['mel_base'],
             device=self.device
-        )
+        ))
+
+    def prefetch_items(self, items):
+        feature_cache = get_feature_cache()
+        waveforms = []
+        keys = []
+        for item_name, meta_data in items:
+            wav_fn = meta_data['wav_fn']
+            waveform = load_waveform(wav_fn, hparams['audio_sample_rate'])
+            if feature_cache is not None:
+                # the length is only known from the mel-spectrogram, which is cached as well
+                length = self.get_mel(wav_fn, waveform).shape[0]
+                if feature_cache.contains(wav_fn, 'f0', feature_params(
+                    'audio_sample_rate', 'hop_size', 'pe', 'pe_ckpt', 'f0_min', 'f0_max', length=length
+                )):
+                    continue
+            waveforms.append(waveform)
+            keys.append(item_name)
+        get_pitch_extractor().prefetch_pitch(waveforms, hparams['audio_sample_rate'], keys=keys)
+
+    @torch.no_grad()
+    def process_item(self, item_name, meta_data, binarization_args):
+        wav_fn = meta_data['wav_fn']
+        waveform = load_waveform(wav_fn, hparams['audio_sample_rate'])
+        mel = self.get_mel(wav_fn, waveform)
         length = mel.shape[0]
         seconds = length * hparams['hop_size'] / hparams['audio_sample_rate']
         processed_input = {
@@ -110,14 +139,14 @@ class AcousticBinarizer(BaseBinarizer):
         ).cpu().numpy()
 
         # get ground truth f0
-        global pitch_extractor
-        if pitch_extractor is None:
-            pitch_extractor = initialize_pe()
-        gt_f0, uv = pitch_extractor.get_pitch(
+        pitch_extractor = get_pitch_extractor()
+        gt_f0, uv = cached_feature(wav_fn, 'f0', feature_params(
+            'audio_sample_rate', 'hop_size', 'pe', 'pe_ckpt', 'f0_min', 'f0_max', length=length
+        ), lambda: pitch_extractor.get_pitch(
             waveform, samplerate=hparams['audio_sample_rate'], length=length,
             hop_size=hparams['hop_size'], f0_min=hparams['f0_min'], f0_max=hparams['f0_max'],
-            interp_uv=True
-        )
+            interp_uv=True, key=item_name
+        ))
         if uv.all():  # All unvoiced
             print(f'Skipped \'{item_name}\': empty gt f0')
             return None
@@ -125,9 +154,11 @@ class AcousticBinarizer(BaseBinarizer):
 
         if self.need_energy:
             # get ground truth energy
-            energy = get_energy_librosa(
+            energy = cached_feature(wav_fn, 'energy', feature_params(
+                'audio_sample_rate', 'hop_size', 'win_size', length=length
+            ), lambda: get_energy_librosa(
                 waveform, length, hop_size=hparams['hop_size'], win_size=hparams['win_size']
-            ).astype(np.float32)
+            ).astype(np.float32))
 
             global energy_smooth
             if energy_smooth is None:
@@ -143,12 +174,16 @@ class AcousticBinarizer(BaseBinarizer):
             waveform, samplerate=hparams['audio_sample_rate'], f0=gt_f0 * ~uv,
             hop_size=hparams['hop_size'], fft_size=hparams['fft_size'], win_size=hparams['win_size']
         )
+        # features from the decomposed waveform depend on the f0 curve it is built from
+        world_params = feature_params(
+            'audio_sample_rate', 'hop_size', 'fft_size', 'win_size', length=length, f0=array_digest(gt_f0 * ~uv)
+        )
 
         if self.need_breathiness:
             # get ground truth breathiness
-            breathiness = get_breathiness_pyworld(
+            breathiness = cached_feature(wav_fn, 'breathiness', world_params, lambda: get_breathiness_pyworld(
                 dec_waveform, None, None, length=length
-            )
+            ))
 
             global breathiness_smooth
             if breathiness_smooth is None:
@@ -161,9 +196,9 @@ class AcousticBinarizer(BaseBinarizer):
 
         if self.need_voicing:
             # get ground truth voicing
-            voicing = get_voicing_pyworld(
+            voicing = cached_feature(wav_fn, 'voicing', world_params, lambda: get_voicing_pyworld(
                 dec_waveform, None, None, length=length
-            )
+            ))
 
             global voicing_smooth
             if voicing_smooth is None:
@@ -176,9 +211,9 @@ class AcousticBinarizer(BaseBinarizer):
 
         if self.need_tension:
             # get ground truth tension
-            tension = get_tension_base_harmonic(
+            tension = cached_feature(wav_fn, 'tension', world_params, lambda: get_tension_base_harmonic(
                 dec_waveform, None, None, length=length, domain='logit'
-            )
+            ))
 
             global tension_smooth
             if tension_smooth is None:
@@ -199,6 +234,11 @@ class AcousticBinarizer(BaseBinarizer):
         if hparams['use_speed_embed']:
             processed_input['speed'] = 1.
 
+        processed_input['timings'] = {
+            'world': dec_waveform.world_seconds,
+            'world_saved': dec_waveform.world_saved_seconds,
+        }
+
         return processed_input
 
     def arrange_data_augmentation(self, data_iterator):
@@ -206,7 +246,6 @@ class AcousticBinarizer(BaseBinarizer):
         aug_list = []
         all_item_names = [item_name for item_name, _ in data_iterator]
         total_scale = 0
-        aug_pe = initialize_pe()
         if self.augmentation_args['random_pitch_shifting']['enabled']:
             from augmentation.spec_stretch import SpectrogramStretchAugmentation
             aug_args = self.augmentation_args['random_pitch_shifting']
@@ -216,7 +255,7 @@ class AcousticBinarizer(BaseBinarizer):
             assert key_shift_min < 0 < key_shift_max, \
                 'Random pitch shifting augmentation must have a range where min < 0 < max.'
 
-            aug_ins = SpectrogramStretchAugmentation(self.raw_data_dirs, aug_args, pe=aug_pe)
+            aug_ins = SpectrogramStretchAugmentation(self.raw_data_dirs, aug_args)
             scale = aug_args['scale']
             aug_item_names = random.choices(all_item_names, k=int(scale * len(all_item_names)))
 
@@ -255,7 +294,7 @@ class AcousticBinarizer(BaseBinarizer):
                 f'Fixed pitch shifting augmentation requires num_spk >= (1 + len(targets)) * (max(spk_ids) + 1).'
             assert scale < 1, 'Fixed pitch shifting augmentation requires scale < 1.'
 
-            aug_ins = SpectrogramStretchAugmentation(self.raw_data_dirs, aug_args, pe=aug_pe)
+            aug_ins = SpectrogramStretchAugmentation(self.raw_data_dirs, aug_args)
             for i, target in enumerate(targets):
                 aug_item_names = random.choices(all_item_names, k=int(scale * len(all_item_names)))
                 for aug_item_name in aug_item_names:
@@ -282,7 +321,7 @@ class AcousticBinarizer(BaseBinarizer):
             assert 0 < speed_min < 1 < speed_max, \
                 'Random time stretching augmentation must have a range where 0 < min < 1 < max.'
 
-            aug_ins = SpectrogramStretchAugmentation(self.raw_data_dirs, aug_args, pe=aug_pe)
+            aug_ins = SpectrogramStretchAugmentation(self.raw_data_dirs, aug_args)
             scale = aug_args['scale']
             k_from_raw = int(scale / (1 + total_scale) * len(all_item_names))
             k_from_aug = int(total_scale * scale / (1 + total_scale) * len(all_item_names))
@@ -10,17 +10,21 @@ import torch.nn.functional as F
 from scipy import interpolate
 
 from basics.base_binarizer import BaseBinarizer, BinarizationError
-from basics.base_pe import BasePE
 from modules.fastspeech.tts_modules import LengthRegulator
-from modules.pe import initialize_pe
+from modules.pe import get_pitch_extractor
 from utils.binarizer_utils import (
     DecomposedWaveform,
     SinusoidalSmoothingConv1d,
+    array_digest,
+    cached_feature,
+    feature_params,
+    get_feature_cache,
     get_mel2ph_torch,
     get_energy_librosa,
     get_breathiness_pyworld,
     get_voicing_pyworld,
     get_tension_base_harmonic,
+    load_waveform,
 )
 from utils.hparams import hparams
 from utils.infer_utils import resample_align_curve
@@ -52,7 +56,6 @@ DS_INDEX_SEP = '#'
 
 # These operators are used as global variables due to a PyTorch shared memory bug on Windows platforms.
 # See https://github.com/pytorch/pytorch/issues/100358
-pitch_extractor: BasePE = None
 midi_smooth: SinusoidalSmoothingConv1d = None
 energy_smooth: SinusoidalSmoothingConv1d = None
 breathiness_smooth: SinusoidalSmoothingConv1d = None
@@ -229,6 +232,31 @@ class VarianceBinarizer(BaseBinarizer):
                     f'{sorted([g for g, n in glide_count.items() if n == 0], key=lambda k: self.glide_map[k])}'
                 )
 
+    def initialize_worker(self):
+        get_pitch_extractor()
+
+    def prefetch_items(self, items):
+        feature_cache = get_feature_cache()
+        waveforms = []
+        keys = []
+        for item_name, meta_data in items:
+            wav_fn = meta_data['wav_fn']
+            if not pathlib.Path(wav_fn).exists():
+                continue
+            if self.prefer_ds:
+                ds_id, name = item_name.split(':', maxsplit=1)
+                name = name.rsplit(DS_INDEX_SEP, maxsplit=1)[0]
+                if self.load_attr_from_ds(int(ds_id), name, 'f0_seq', idx=meta_data['ds_idx']) is not None:
+                    continue
+            length = round(sum(meta_data['ph_dur']) / self.timestep)
+            if feature_cache is not None and feature_cache.contains(wav_fn, 'f0', feature_params(
+                'audio_sample_rate', 'hop_size', 'pe', 'pe_ckpt', 'f0_min', 'f0_max', length=length
+            )):
+                continue
+            waveforms.append(load_waveform(wav_fn, hparams['audio_sample_rate']))
+            keys.append(item_name)
+        get_pitch_extractor().prefetch_pitch(waveforms, hparams['audio_sample_rate'], keys=keys)
+
     @torch.no_grad()
     def process_item(self, item_name, meta_data, binarization_args):
         ds_id, name = item_name.split(':', maxsplit=1)
@@ -261,16 +289,15 @@ class VarianceBinarizer(BaseBinarizer):
             processed_input['mel2ph'] = mel2ph.cpu().numpy()
 
         # Below: extract actual f0, convert to pitch and calculate delta pitch
-        if pathlib.Path(meta_data['wav_fn']).exists():
-            waveform, _ = librosa.load(meta_data['wav_fn'], sr=hparams['audio_sample_rate'], mono=True)
+        wav_fn = meta_data['wav_fn']
+        if pathlib.Path(wav_fn).exists():
+            waveform = load_waveform(wav_fn, hparams['audio_sample_rate'])
         elif not self.prefer_ds:
-            raise FileNotFoundError(meta_data['wav_fn'])
+            raise FileNotFoundError(wav_fn)
         else:
             waveform = None
 
-        global pitch_extractor
-        if pitch_extractor is None:
-            pitch_extractor = initialize_pe()
+        pitch_extractor = get_pitch_extractor()
         f0 = uv = None
         if self.prefer_ds:
             f0_seq = self.load_attr_from_ds(ds_id, name, 'f0_seq', idx=ds_seg_idx)
@@ -284,11 +311,13 @@ class VarianceBinarizer(BaseBinarizer):
                 uv = f0 == 0
                 f0, _ = interp_f0(f0, uv)
         if f0 is None:
-            f0, uv = pitch_extractor.get_pitch(
+            f0, uv = cached_feature(wav_fn, 'f0', feature_params(
+                'audio_sample_rate', 'hop_size', 'pe', 'pe_ckpt', 'f0_min', 'f0_max', length=length
+            ), lambda: pitch_extractor.get_pitch(
                 waveform, samplerate=hparams['audio_sample_rate'], length=length,
                 hop_size=hparams['hop_size'], f0_min=hparams['f0_min'], f0_max=hparams['f0_max'],
-                interp_uv=True
-            )
+                interp_uv=True, key=item_name
+            ))
         if uv.all():  # All unvoiced
             print(f'Skipped \'{item_name}\': empty gt f0')
             return None
@@ -368,10 +397,12 @@ class VarianceBinarizer(BaseBinarizer):
                         align_length=length
                     )
             if energy is None:
-                energy = get_energy_librosa(
+                energy = cached_feature(wav_fn, 'energy', feature_params(
+                    'audio_sample_rate', 'hop_size', 'win_size', length=length
+                ), lambda: get_energy_librosa(
                     waveform, length,
                     hop_size=hparams['hop_size'], win_size=hparams['win_size']
-                ).astype(np.float32)
+                ).astype(np.float32))
                 energy_from_wav = True
 
             if energy_from_wav:
@@ -389,6 +420,10 @@ class VarianceBinarizer(BaseBinarizer):
             waveform, samplerate=hparams['audio_sample_rate'], f0=f0 * ~uv,
             hop_size=hparams['hop_size'], fft_size=hparams['fft_size'], win_size=hparams['win_size']
         ) if waveform is not None else None
+        # features from the decomposed waveform depend on the f0 curve it is built from
+        world_params = feature_params(
+            'audio_sample_rate', 'hop_size', 'fft_size', 'win_size', length=length, f0=array_digest(f0 * ~uv)
+        )
 
         # Below: extract breathiness
         if hparams['predict_breathiness']:
@@ -406,9 +441,9 @@ class VarianceBinarizer(BaseBinarizer):
                         align_length=length
                     )
             if breathiness is None:
-                breathiness = get_breathiness_pyworld(
+                breathiness = cached_feature(wav_fn, 'breathiness', world_params, lambda: get_breathiness_pyworld(
                     dec_waveform, None, None, length=length
-                )
+                ))
                 breathiness_from_wav = True
 
             if breathiness_from_wav:
@@ -437,9 +472,9 @@ class VarianceBinarizer(BaseBinarizer):
                         align_length=length
                     )
             if voicing is None:
-                voicing = get_voicing_pyworld(
+                voicing = cached_feature(wav_fn, 'voicing', world_params, lambda: get_voicing_pyworld(
                     dec_waveform, None, None, length=length
-                )
+                ))
                 voicing_from_wav = True
 
             if voicing_from_wav:
@@ -468,9 +503,9 @@ class VarianceBinarizer(BaseBinarizer):
                         align_length=length
                     )
             if tension is None:
-                tension = get_tension_base_harmonic(
+                tension = cached_feature(wav_fn, 'tension', world_params, lambda: get_tension_base_harmonic(
                     dec_waveform, None, None, length=length, domain='logit'
-                )
+                ))
                 tension_from_wav = True
 
             if tension_from_wav:
@@ -483,6 +518,12 @@ class VarianceBinarizer(BaseBinarizer):
 
             processed_input['tension'] = tension
 
+        if dec_waveform is not None:
+            processed_input['timings'] = {
+                'world': dec_waveform.world_seconds,
+                'world_saved': dec_waveform.world_saved_seconds,
+            }
+
         return processed_input
 
     def arrange_data_augmentation(self, data_iterator):
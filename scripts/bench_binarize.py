@@ -0,0 +1,130 @@
+# coding=utf8
+import argparse
+import importlib
+import itertools
+import json
+import os
+import pathlib
+import random
+import subprocess
+import sys
+import tempfile
+
+root_dir = pathlib.Path(__file__).parent.parent.resolve()
+os.environ['PYTHONPATH'] = str(root_dir)
+sys.path.insert(0, str(root_dir))
+
+import torch
+
+from utils.hparams import set_hparams, hparams
+
+parser = argparse.ArgumentParser(description='Benchmark the binarization pipeline on items sampled from a dataset')
+parser.add_argument('--config', type=str, required=True, help='Path to the configuration file')
+parser.add_argument('--num-items', type=int, default=100, help='Number of sampled items (0 means all items)')
+parser.add_argument('--num-workers', type=int, nargs='+', default=[0], help='Numbers of workers to compare')
+parser.add_argument('--pe', type=str, nargs='+', required=False,
+                    help='Pitch extractors to compare (default: the one in the config)')
+parser.add_argument('--no-cache', action='store_true', help='Disable the waveform, feature and WORLD caches')
+parser.add_argument('--seed', type=int, default=1234, help='Random seed for sampling items')
+parser.add_argument('--out', type=str, required=False, help='Path to save the JSON report (default: stdout)')
+args = parser.parse_args()
+
+# This runs at import time so that the spawned binarization workers get the same hyperparameters.
+set_hparams(config=args.config, print_hparams=False)
+if args.pe is not None and len(args.pe) == 1:
+    hparams['pe'] = args.pe[0]
+if args.no_cache:
+    hparams['binarization_args']['wav_cache_dir'] = None
+    hparams['binarization_args']['feature_cache_dir'] = None
+    hparams['binarization_args']['world_cache_dir'] = None
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        return None, None
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    unit = 1 if sys.platform == 'darwin' else 1024
+    main = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2 ** 20
+    workers = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 2 ** 20
+    return main, workers
+
+
+def bench(num_workers):
+    binarizer_cls = hparams['binarizer_cls']
+    pkg = '.'.join(binarizer_cls.split('.')[:-1])
+    cls_name = binarizer_cls.split('.')[-1]
+    binarizer = getattr(importlib.import_module(pkg), cls_name)()
+    for ds_id, spk_id, data_dir in zip(range(len(binarizer.raw_data_dirs)), binarizer.spk_ids, binarizer.raw_data_dirs):
+        binarizer.load_meta_data(pathlib.Path(data_dir), ds_id=ds_id, spk_id=spk_id)
+    item_names = sorted(binarizer.items.keys())
+    random.Random(args.seed).shuffle(item_names)
+    if args.num_items > 0:
+        item_names = item_names[:args.num_items]
+    # everything is processed as the training set, which supports multiprocessing
+    binarizer._train_item_names = item_names
+
+    with tempfile.TemporaryDirectory() as binary_data_dir:
+        binarizer.binary_data_dir = pathlib.Path(binary_data_dir)
+        stats = binarizer.process_dataset('train', num_workers=num_workers)
+
+    timings = stats['timings']
+    num_items = max(stats['num_processed_items'], 1)
+    wall_time = stats['wall_time']
+    busy_time = timings.get('item', 0.) + timings.get('prefetch', 0.)
+    if num_workers == 0:
+        busy_time += timings.get('write', 0.)  # the main process also writes the items
+    main_rss, workers_rss = peak_rss_mb()
+    return {
+        'binarizer': hparams['binarizer_cls'],
+        'pe': hparams['pe'],
+        'num_workers': num_workers,
+        'device': 'cuda' if torch.cuda.is_available() else 'cpu',
+        'num_items': stats['num_items'],
+        'num_processed_items': stats['num_processed_items'],
+        'num_written_items': stats['num_written_items'],
+        'wall_time': wall_time,
+        'items_per_second': stats['num_processed_items'] / wall_time,
+        # NOTE: stages may nest: 'decode' and 'resample' can happen inside 'prefetch',
+        # and 'world' happens inside 'breathiness', 'voicing' and 'tension'.
+        'stage_seconds': timings,
+        'stage_seconds_per_item': {k: v / num_items for k, v in timings.items()},
+        'worker_utilization': busy_time / (wall_time * max(num_workers, 1)),
+        'peak_rss_mb': {'main': main_rss, 'workers': workers_rss},
+    }
+
+
+def main():
+    pes = args.pe if args.pe is not None else [hparams['pe']]
+    runs = list(itertools.product(pes, args.num_workers))
+    if len(runs) == 1:
+        reports = [bench(args.num_workers[0])]
+    else:
+        # run each combination in a fresh process, so that models, caches and peak RSS are not shared
+        reports = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for i, (pe, num_workers) in enumerate(runs):
+                report_path = os.path.join(tmp_dir, f'{i}.json')
+                cmd = [
+                    sys.executable, __file__, '--config', args.config,
+                    '--num-items', str(args.num_items), '--num-workers', str(num_workers),
+                    '--pe', pe, '--seed', str(args.seed), '--out', report_path
+                ]
+                if args.no_cache:
+                    cmd.append('--no-cache')
+                subprocess.run(cmd, check=True)
+                with open(report_path, 'r', encoding='utf8') as f:
+                    reports.extend(json.load(f))
+
+    result = json.dumps(reports, indent=2)
+    if args.out is not None:
+        with open(args.out, 'w', encoding='utf8') as f:
+            f.write(result)
+        print(f'| save report to \'{args.out}\'')
+    else:
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# coding=utf8
+import argparse
+import os
+import pathlib
+import sys
+import time
+
+root_dir = pathlib.Path(__file__).parent.parent.resolve()
+os.environ['PYTHONPATH'] = str(root_dir)
+sys.path.insert(0, str(root_dir))
+
+import torch
+import torch.nn.functional as F
+
+from modules.fastspeech.tts_modules import LengthRegulator
+
+parser = argparse.ArgumentParser(description='Benchmark the length regulator on long segments')
+parser.add_argument('--device', type=str, required=False, help='Device to run on (default: cuda if available)')
+parser.add_argument('--batch', type=int, default=1, help='Batch size')
+parser.add_argument('--repeats', type=int, default=20, help='Number of timed runs of each case')
+parser.add_argument('--no-legacy', action='store_true', help='Skip the previous O(T_txt * T_mel) implementation')
+args = parser.parse_args()
+
+device = args.device or ('cuda' if torch.cuda.is_available() else 'cpu')
+
+# (phonemes, frames): a typical segment, a 2-minute segment and a 5-minute one at 512 hop / 44.1 kHz
+CASES = [(100, 1000), (600, 10000), (1500, 26000)]
+
+
+def legacy_length_regulator(dur):
+    token_idx = torch.arange(1, dur.shape[1] + 1)[None, :, None].to(dur.device)
+    dur_cumsum = torch.cumsum(dur, 1)
+    dur_cumsum_prev = F.pad(dur_cumsum, [1, -1], mode='constant', value=0)
+    pos_idx = torch.arange(dur.sum(-1).max())[None, None].to(dur.device)
+    token_mask = (pos_idx >= dur_cumsum_prev[:, :, None]) & (pos_idx < dur_cumsum[:, :, None])
+    return (token_idx * token_mask.long()).sum(1)
+
+
+def random_durations(num_tokens, num_frames):
+    # split num_frames into num_tokens durations, some of which are zero
+    cuts = torch.sort(torch.randint(0, num_frames + 1, (args.batch, num_tokens - 1)), dim=1).values
+    bounds = F.pad(cuts, [1, 0], value=0)
+    bounds = F.pad(bounds, [0, 1], value=num_frames)
+    return torch.diff(bounds, dim=1).to(device)
+
+
+def sync():
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def measure(fn, dur):
+    fn(dur)  # warm up
+    sync()
+    if device.startswith('cuda'):
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    times = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        fn(dur)
+        sync()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    peak = torch.cuda.max_memory_allocated() - base if device.startswith('cuda') else None
+    return times[len(times) // 2], peak
+
+
+def main():
+    torch.manual_seed(0)
+    lr = LengthRegulator().to(device)
+    impls = [('linear', lr)]
+    if not args.no_legacy:
+        impls.append(('legacy', legacy_length_regulator))
+    print(f'| device: {device}, batch size: {args.batch}')
+    for num_tokens, num_frames in CASES:
+        dur = random_durations(num_tokens, num_frames)
+        results = {}
+        with torch.no_grad():
+            for name, fn in impls:
+                results[name] = fn(dur)
+                latency, peak = measure(fn, dur)
+                info = f'| T_txt={num_tokens:<5d} T_mel={num_frames:<6d} {name:<7s} {latency * 1000:9.3f} ms'
+                if peak is not None:
+                    info += f' {peak / 2 ** 20:10.2f} MiB peak'
+                print(info)
+        if len(results) > 1:
+            assert torch.equal(results['linear'], results['legacy']), 'Outputs mismatch.'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# coding=utf8
+import argparse
+import os
+import pathlib
+import sys
+import tempfile
+import time
+
+root_dir = pathlib.Path(__file__).parent.parent.resolve()
+os.environ['PYTHONPATH'] = str(root_dir)
+sys.path.insert(0, str(root_dir))
+
+import numpy as np
+import torch
+
+from modules.pe.rmvpe import RMVPE
+from modules.pe.rmvpe.model import E2E0
+
+parser = argparse.ArgumentParser(description='Benchmark batched RMVPE pitch extraction against one-by-one extraction')
+parser.add_argument('--ckpt', type=str, required=False,
+                    help='Path to the RMVPE checkpoint (default: randomly initialized weights)')
+parser.add_argument('--num-items', type=int, default=64, help='Number of waveforms')
+parser.add_argument('--min-seconds', type=float, default=2., help='Minimum length of the waveforms')
+parser.add_argument('--max-seconds', type=float, default=12., help='Maximum length of the waveforms')
+parser.add_argument('--batch-frames', type=int, nargs='+', default=[4096, 16384],
+                    help='Frame budgets of batched extraction to compare')
+parser.add_argument('--seed', type=int, default=1234, help='Random seed')
+args = parser.parse_args()
+
+
+def random_waveforms():
+    rng = np.random.default_rng(args.seed)
+    waveforms = []
+    for _ in range(args.num_items):
+        t = np.arange(int(rng.uniform(args.min_seconds, args.max_seconds) * 16000)) / 16000
+        f0 = rng.uniform(100, 400) * 2 ** (0.2 * np.sin(2 * np.pi * rng.uniform(0.5, 5) * t))
+        waveform = 0.3 * np.sin(2 * np.pi * np.cumsum(f0) / 16000) + 0.01 * rng.standard_normal(len(t))
+        waveforms.append(waveform.astype(np.float32))
+    return waveforms
+
+
+def sync(pe):
+    if pe.device == 'cuda':
+        torch.cuda.synchronize()
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ckpt = args.ckpt
+        if ckpt is None:
+            torch.manual_seed(args.seed)
+            ckpt = os.path.join(tmp_dir, 'rmvpe.pt')
+            torch.save({'model': E2E0(4, 1, (2, 2)).state_dict()}, ckpt)
+        pe = RMVPE(ckpt)
+    waveforms = random_waveforms()
+    total_seconds = sum(len(w) for w in waveforms) / 16000
+    print(f'| device: {pe.device}, {len(waveforms)} waveforms, {total_seconds:.1f}s in total')
+
+    pe.infer_from_audio(waveforms[0])  # warm up
+    sync(pe)
+    start = time.perf_counter()
+    single = [pe.infer_from_audio(w).reshape(-1) for w in waveforms]
+    sync(pe)
+    baseline = time.perf_counter() - start
+    print(f'| one by one:            {baseline:8.3f}s ({total_seconds / baseline:8.1f}x real time)')
+
+    for batch_frames in args.batch_frames:
+        pe.batch_frames = batch_frames
+        start = time.perf_counter()
+        batched = pe.infer_from_audio_batch(waveforms)
+        sync(pe)
+        elapsed = time.perf_counter() - start
+        max_diff = max(np.abs(b - s).max() for b, s in zip(batched, single))
+        print(
+            f'| batch_frames={batch_frames:<8d} {elapsed:8.3f}s ({total_seconds / elapsed:8.1f}x real time, '
+            f'{baseline / elapsed:.2f}x speedup), max f0 deviation: {max_diff:.4f} Hz'
+        )
+
+
+if __name__ == '__main__':
+    main()
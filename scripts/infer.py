@@ -1,3 +1,4 @@
+import contextlib
 import json
 import os
 import pathlib
@@ -32,6 +33,14 @@ def find_exp(exp):
     return exp
 
 
+def profiling(num_segments, name):
+    if num_segments <= 0:
+        return contextlib.nullcontext()
+    from utils.hparams import hparams
+    from utils.infer_utils import profile_inference
+    return profile_inference(pathlib.Path(hparams['work_dir']) / 'profiler', name)
+
+
 @click.group()
 def main():
     pass
@@ -107,6 +116,20 @@ def main():
     '--mel', is_flag=True,
     help='Save intermediate mel format instead of waveform'
 )
+@click.option(
+    '--batch-frames', type=click.IntRange(min=0),
+    required=False, default=0, metavar='FRAMES',
+    help='Infer segments of similar lengths in batches of at most FRAMES padded frames (0 to disable)'
+)
+@click.option(
+    '--pipeline', is_flag=True,
+    help='Run the acoustic model, the vocoder and audio writing concurrently'
+)
+@click.option(
+    '--profile', type=click.IntRange(min=0),
+    required=False, default=0, metavar='SEGMENTS',
+    help='Profile the inference of the first SEGMENTS segments and save the results to the experiment directory'
+)
 def acoustic(
         proj: pathlib.Path,
         exp: str,
@@ -120,7 +143,10 @@ def acoustic(
         seed: int,
         depth: float,
         steps: int,
-        mel: bool
+        mel: bool,
+        batch_frames: int,
+        pipeline: bool,
+        profile: int
 ):
     name = proj.stem if not title else title
     if out is None:
@@ -135,6 +161,8 @@ def acoustic(
     if len(params) == 0:
         print('The input file is empty.')
         exit()
+    if profile > 0:
+        params = params[:profile]
 
     from utils.infer_utils import trans_key, parse_commandline_spk_mix
 
@@ -204,10 +232,12 @@ def acoustic(
     print(f'| Model: {type(infer_ins.model)}')
 
     try:
-        infer_ins.run_inference(
-            params, out_dir=out, title=name, num_runs=num,
-            spk_mix=spk_mix, seed=seed, save_mel=mel
-        )
+        with profiling(profile, 'infer_acoustic'):
+            infer_ins.run_inference(
+                params, out_dir=out, title=name, num_runs=num,
+                spk_mix=spk_mix, seed=seed, save_mel=mel,
+                batch_frames=batch_frames, pipeline=pipeline
+            )
     except KeyboardInterrupt:
         exit(-1)
 
@@ -277,6 +307,11 @@ def acoustic(
     required=False,
     help='Diffusion sampling steps'
 )
+@click.option(
+    '--profile', type=click.IntRange(min=0),
+    required=False, default=0, metavar='SEGMENTS',
+    help='Profile the inference of the first SEGMENTS segments and save the results to the experiment directory'
+)
 def variance(
         proj: pathlib.Path,
         exp: str,
@@ -289,7 +324,8 @@ def variance(
         key: int,
         expr: float,
         seed: int,
-        steps: int
+        steps: int,
+        profile: int
 ):
     name = proj.stem if not title else title
     if out is None:
@@ -307,6 +343,8 @@ def variance(
     if len(params) == 0:
         print('The input file is empty.')
         exit()
+    if profile > 0:
+        params = params[:profile]
 
     from utils.infer_utils import trans_key, parse_commandline_spk_mix
 
@@ -355,10 +393,11 @@ def variance(
     print(f'| Model: {type(infer_ins.model)}')
 
     try:
-        infer_ins.run_inference(
-            params, out_dir=out, title=name,
-            num_runs=num, seed=seed
-        )
+        with profiling(profile, 'infer_variance'):
+            infer_ins.run_inference(
+                params, out_dir=out, title=name,
+                num_runs=num, seed=seed
+            )
     except KeyboardInterrupt:
         exit(-1)
 
@@ -8,12 +8,11 @@ root_dir = pathlib.Path(__file__).parent.parent.resolve()
 os.environ['PYTHONPATH'] = str(root_dir)
 sys.path.insert(0, str(root_dir))
 
-import numpy as np
 import torch
 import tqdm
 
 from inference.ds_acoustic import DiffSingerAcousticInfer
-from utils.infer_utils import cross_fade, save_wav
+from utils.infer_utils import WaveformAssembler, save_wav
 from utils.hparams import set_hparams, hparams
 
 parser = argparse.ArgumentParser(description='Run DiffSinger vocoder')
@@ -65,22 +64,20 @@ infer_ins = DiffSingerAcousticInfer(load_model=False)
 
 
 def run_vocoder(path: pathlib.Path):
-    result = np.zeros(0)
-    current_length = 0
+    # audio can be streamed to the file only if no segment goes back before a previous one
+    offsets = [seg_mel['offset'] for seg_mel in mel_seq]
+    stream_audio = all(a <= b for a, b in zip(offsets[:-1], offsets[1:]))
+    result = WaveformAssembler(sample_rate, path=path if stream_audio else None)
 
     for seg_mel in tqdm.tqdm(mel_seq, desc='mel segment', total=len(mel_seq)):
         seg_audio = infer_ins.run_vocoder(seg_mel['mel'].to(infer_ins.device), f0=seg_mel['f0'].to(infer_ins.device))
         seg_audio = seg_audio.squeeze(0).cpu().numpy()
-        silent_length = round(seg_mel['offset'] * sample_rate) - current_length
-        if silent_length >= 0:
-            result = np.append(result, np.zeros(silent_length))
-            result = np.append(result, seg_audio)
-        else:
-            result = cross_fade(result, seg_audio, current_length + silent_length)
-        current_length = current_length + silent_length + seg_audio.shape[0]
+        result.add(seg_mel['offset'], seg_audio)
 
     print(f'| save audio: {path}')
-    save_wav(result, path, sample_rate)
+    waveform = result.finish()
+    if waveform is not None:
+        save_wav(waveform, path, sample_rate)
 
 
 os.makedirs(out, exist_ok=True)
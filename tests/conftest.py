@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+root_dir = pathlib.Path(__file__).parent.parent.resolve()
+sys.path.insert(0, str(root_dir))
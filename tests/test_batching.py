@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+import utils
+
+
+def random_sizes(seed, count=500):
+    rng = np.random.default_rng(seed)
+    return rng.integers(1, 2000, count)
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('max_batch_frames, max_batch_size', [(8000, 16), (40000, 48), (2000, 4)])
+def test_batch_by_size_vectorized_matches_batch_by_size(seed, max_batch_frames, max_batch_size):
+    sizes = random_sizes(seed)
+    for ordered in [sizes, np.sort(sizes)[::-1]]:
+        expected = utils.batch_by_size(
+            list(range(len(ordered))), lambda i: ordered[i],
+            max_batch_frames=max_batch_frames, max_batch_size=max_batch_size
+        )
+        bounds = utils.batch_by_size_vectorized(
+            ordered, max_batch_frames=max_batch_frames, max_batch_size=max_batch_size
+        )
+        assert [b.tolist() for b in np.split(np.arange(len(ordered)), bounds[1:-1])] == expected
+
+
+def test_batch_by_size_vectorized_padding_efficiency():
+    sizes = random_sizes(0)
+    bounds = utils.batch_by_size_vectorized(
+        sizes, max_batch_frames=40000, max_batch_size=48, min_padding_efficiency=0.8
+    )
+    assert bounds[0] == 0 and bounds[-1] == len(sizes)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        batch = sizes[start: end]
+        assert batch.max() * len(batch) <= 40000
+        assert len(batch) == 1 or batch.sum() >= 0.8 * batch.max() * len(batch)
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('capacity', [500, 2000, 6000])
+def test_pack_by_size_matches_pack_rows(seed, capacity):
+    # rounded sizes make ties frequent, and some sizes exceed the smaller capacities
+    sizes = np.sort(random_sizes(seed) // 50 * 50 + 50)[::-1]
+    order, bounds = utils.pack_by_size(sizes, capacity)
+    assert sorted(order.tolist()) == list(range(len(sizes)))
+    rows = [order[start: end].tolist() for start, end in zip(bounds[:-1], bounds[1:])]
+    for row in rows:
+        assert len(row) == 1 or sizes[row].sum() <= capacity
+    # the sampler lays out each row in one run; next fit over that layout finds the same rows
+    positions = np.split(np.arange(len(order)), bounds[1:-1])
+    assert utils.pack_rows(sizes[order], capacity) == [p.tolist() for p in positions]
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+import utils.binarizer_utils as binarizer_utils
+from utils.binarizer_utils import DecomposedWaveform, FeatureCache, WorldArtifactCache
+
+
+def make_waveform(samplerate=16000, seconds=0.5):
+    t = np.arange(int(samplerate * seconds)) / samplerate
+    waveform = 0.5 * np.sin(2 * np.pi * 220 * t) + 0.01 * np.random.default_rng(0).standard_normal(len(t))
+    return waveform.astype(np.float32), np.full(len(t) // 256 + 1, 220.)
+
+
+def decompose(waveform, f0):
+    np.random.seed(0)  # the WORLD analysis adds a tiny noise to the waveform
+    dec = DecomposedWaveform(waveform, 16000, f0, hop_size=256, fft_size=1024, win_size=1024, device='cpu')
+    return dec.harmonic(), dec.aperiodic(), dec.harmonic(k=0)
+
+
+def test_world_cache_does_not_change_results(monkeypatch, tmp_path):
+    waveform, f0 = make_waveform()
+    monkeypatch.setattr(binarizer_utils, 'world_cache', None)
+    uncached = decompose(waveform, f0)
+
+    cache = WorldArtifactCache(tmp_path)
+    monkeypatch.setattr(binarizer_utils, 'world_cache', cache)
+    computed = decompose(waveform, f0)
+    assert cache.misses > 0 and cache.hits == 0
+    loaded = decompose(waveform, f0)
+    assert cache.hits > 0
+
+    for a, b, c in zip(uncached, computed, loaded):
+        assert a.dtype == b.dtype == c.dtype
+        np.testing.assert_array_equal(a, b)
+        np.testing.assert_array_equal(a, c)
+
+
+def test_feature_cache_round_trip(tmp_path):
+    wav_fn = tmp_path / 'item.wav'
+    wav_fn.write_bytes(b'audio')
+    cache = FeatureCache(tmp_path / 'cache')
+    f0 = np.linspace(100, 200, 50)
+    uv = f0 > 150
+    params = {'hop_size': 512, 'pe': 'parselmouth'}
+
+    result = cache.get_or_compute(wav_fn, 'f0', params, lambda: (f0, uv))
+    assert cache.contains(wav_fn, 'f0', params)
+    loaded = cache.get_or_compute(wav_fn, 'f0', params, lambda: pytest.fail('the entry should be loaded'))
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert isinstance(loaded, tuple) and len(loaded) == 2
+    for a, b in zip(result, loaded):
+        assert a.dtype == b.dtype
+        np.testing.assert_array_equal(a, b)
+
+    mel = np.random.default_rng(0).standard_normal((20, 8)).astype(np.float32)
+    cache.get_or_compute(wav_fn, 'mel', params, lambda: mel)
+    loaded = cache.get_or_compute(wav_fn, 'mel', params, lambda: None)
+    assert loaded.dtype == np.float32
+    np.testing.assert_array_equal(loaded, mel)
+
+    # other parameters or other audio content miss the cache
+    assert not cache.contains(wav_fn, 'f0', {**params, 'hop_size': 256})
+    wav_fn.write_bytes(b'other audio')
+    assert not cache.contains(wav_fn, 'f0', params)
+
+
+def test_feature_cache_recomputes_corrupted_entries(tmp_path):
+    wav_fn = tmp_path / 'item.wav'
+    wav_fn.write_bytes(b'audio')
+    cache = FeatureCache(tmp_path / 'cache')
+    cache.get_or_compute(wav_fn, 'f0', {}, lambda: np.zeros(4))
+    entry_path, = (tmp_path / 'cache').glob('*/*.npz')
+    entry_path.write_bytes(b'broken')
+    np.testing.assert_array_equal(cache.get_or_compute(wav_fn, 'f0', {}, lambda: np.ones(4)), np.ones(4))
+    np.testing.assert_array_equal(cache.get_or_compute(wav_fn, 'f0', {}, lambda: None), np.ones(4))
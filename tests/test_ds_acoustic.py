@@ -0,0 +1,55 @@
+import pathlib
+
+import pytest
+import torch
+
+from inference.ds_acoustic import DiffSingerAcousticInfer
+from modules.toplevel import DiffSingerAcoustic
+from utils.hparams import hparams, set_hparams
+
+root_dir = pathlib.Path(__file__).parent.parent.resolve()
+
+
+@pytest.fixture
+def infer_ins(monkeypatch):
+    monkeypatch.chdir(root_dir)
+    saved_hparams = dict(hparams)
+    set_hparams(config='configs/acoustic.yaml', print_hparams=False)
+    hparams.update({
+        # a tiny DDPM without acceleration, whose sampler draws noise at every step
+        'diffusion_type': 'ddpm', 'timesteps': 8, 'K_step': 8, 'K_step_infer': 8, 'diff_speedup': 1,
+        'use_shallow_diffusion': False, 'hidden_size': 32, 'enc_layers': 2,
+        'residual_layers': 2, 'residual_channels': 16, 'audio_num_mel_bins': 16,
+    })
+    torch.manual_seed(0)
+    ins = DiffSingerAcousticInfer(device='cpu', load_model=False, load_vocoder=False)
+    ins.variances_to_embed = set()
+    ins.model = DiffSingerAcoustic(vocab_size=10, out_dims=hparams['audio_num_mel_bins']).eval()
+    yield ins
+    hparams.clear()
+    hparams.update(saved_hparams)
+
+
+def make_segment(num_tokens, num_frames):
+    mel2ph = torch.arange(num_frames) * num_tokens // num_frames + 1
+    return {
+        'tokens': torch.randint(1, 10, (1, num_tokens)),
+        'mel2ph': mel2ph[None],
+        'f0': torch.full((1, num_frames), 440.),
+    }
+
+
+def test_segment_noise_does_not_depend_on_bucket(infer_ins):
+    # the last segment is the longest one, so it sees no padding in any bucket
+    batches = [make_segment(5, 24), make_segment(6, 32), make_segment(8, 48)]
+    params = [{'seed': 1}, {'seed': 2}, {'seed': 3}]
+    alone = infer_ins.forward_buckets(params, batches, [[2]])[2]
+    for bucket in [[1, 2], [0, 1, 2]]:
+        batched = infer_ins.forward_buckets(params, batches, [bucket])[2]
+        torch.testing.assert_close(batched, alone, rtol=1e-5, atol=1e-5)
+    # the sequential path reseeds the global RNG with the seed of each segment
+    _, _, sequential = list(infer_ins.iter_mel_preds(params, batches))[2]
+    torch.testing.assert_close(sequential, alone, rtol=1e-5, atol=1e-5)
+    # and a different seed gives a different result
+    reseeded = infer_ins.forward_buckets([{}, {}, {'seed': 4}], batches, [[2]])[2]
+    assert not torch.allclose(reseeded, alone)
@@ -0,0 +1,41 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from modules.fastspeech.tts_modules import LengthRegulator
+
+
+def legacy_length_regulator(dur, dur_padding=None, alpha=None):
+    # the previous O(B * T_txt * T_speech) implementation
+    if alpha is not None:
+        dur = torch.round(dur.float() * alpha).long()
+    if dur_padding is not None:
+        dur = dur * (1 - dur_padding.long())
+    token_idx = torch.arange(1, dur.shape[1] + 1)[None, :, None].to(dur.device)
+    dur_cumsum = torch.cumsum(dur, 1)
+    dur_cumsum_prev = F.pad(dur_cumsum, [1, -1], mode='constant', value=0)
+    pos_idx = torch.arange(dur.sum(-1).max())[None, None].to(dur.device)
+    token_mask = (pos_idx >= dur_cumsum_prev[:, :, None]) & (pos_idx < dur_cumsum[:, :, None])
+    return (token_idx * token_mask.long()).sum(1)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_length_regulator_matches_legacy(seed):
+    generator = torch.Generator().manual_seed(seed)
+    # about a third of the durations are zero, and the rows have different total lengths
+    dur = torch.randint(0, 3, (4, 30), generator=generator) * torch.randint(0, 8, (4, 30), generator=generator)
+    dur_padding = torch.arange(30)[None, :] >= torch.tensor([30, 25, 10, 1])[:, None]
+    lr = LengthRegulator()
+    torch.testing.assert_close(lr(dur), legacy_length_regulator(dur))
+    torch.testing.assert_close(lr(dur, dur_padding), legacy_length_regulator(dur, dur_padding))
+    torch.testing.assert_close(lr(dur, alpha=1.3), legacy_length_regulator(dur, alpha=1.3))
+
+
+def test_length_regulator_edge_cases():
+    lr = LengthRegulator()
+    for dur in [
+        torch.tensor([[2, 0, 2, 3]]),
+        torch.tensor([[0, 0, 4, 1]]),  # leading zeros
+        torch.tensor([[3, 1, 0, 0], [0, 0, 0, 0]]),  # trailing zeros and an empty row
+    ]:
+        torch.testing.assert_close(lr(dur), legacy_length_regulator(dur))
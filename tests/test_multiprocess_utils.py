@@ -0,0 +1,101 @@
+import time
+
+import numpy as np
+import pytest
+
+from utils.multiprocess_utils import SharedResult, chunked_multiprocess_run, ordered_results
+
+
+def square(x):
+    time.sleep(0.01 * (x % 3))
+    return x * x
+
+
+def interrupt_on_three(x):
+    if x == 3:
+        raise KeyboardInterrupt()
+    return x
+
+
+def make_item(x):
+    return {'name': f'item-{x}', 'mel': np.full((x + 1, 4), x, dtype=np.float32), 'uv': np.arange(x) % 2 == 0}
+
+
+def make_arrays():
+    rng = np.random.default_rng(0)
+    return {
+        'name': 'item',
+        'mel': rng.standard_normal((37, 5)).astype(np.float32),
+        'ph_dur': rng.integers(0, 100, 13),
+        'uv': rng.random(11) > 0.5,
+        'f0': [rng.standard_normal(7).astype(np.float16), rng.standard_normal((9, 3))[::2, ::-1]],
+        'scalar': np.float64(3.5),
+        'empty': np.zeros((0, 4)),
+        'objects': np.array(['a', None], dtype=object),
+        'nested': ({'spk_id': np.array(2)}, 42),
+    }
+
+
+def assert_same(a, b):
+    if isinstance(b, np.ndarray):
+        # shared arrays are loaded as memory-mapped views
+        assert isinstance(a, np.ndarray) and a.dtype == b.dtype
+        np.testing.assert_array_equal(a, b)
+        return
+    assert type(a) is type(b)
+    if isinstance(a, dict):
+        assert a.keys() == b.keys()
+        for k in a:
+            assert_same(a[k], b[k])
+    elif isinstance(a, (list, tuple)):
+        assert len(a) == len(b)
+        for x, y in zip(a, b):
+            assert_same(x, y)
+    else:
+        assert a == b
+
+
+def fail_init():
+    raise ValueError('cannot load the model')
+
+
+def test_results_are_written_in_original_order():
+    args = [[x] for x in range(20)]
+    task_order = sorted(range(20), key=lambda i: (i % 4, -i))
+    results = ordered_results(
+        chunked_multiprocess_run(square, args, num_workers=2, task_order=task_order), range(len(args))
+    )
+    assert list(results) == [x * x for x in range(20)]
+
+
+def test_worker_init_failure_is_raised():
+    start = time.perf_counter()
+    with pytest.raises(RuntimeError, match='cannot load the model'):
+        list(chunked_multiprocess_run(square, [[x] for x in range(4)], num_workers=2, init_func=fail_init))
+    assert time.perf_counter() - start < 60
+
+
+def test_worker_interruption_is_raised():
+    with pytest.raises(KeyboardInterrupt, match='interrupted'):
+        list(chunked_multiprocess_run(interrupt_on_three, [[x] for x in range(8)], num_workers=2))
+
+
+def test_shared_result_round_trip(tmp_path):
+    path = tmp_path / 'result'
+    shared = SharedResult.share(make_arrays(), str(path))
+    assert isinstance(shared, SharedResult) and path.exists()
+    assert_same(shared.load(), make_arrays())
+    assert not path.exists()
+    # objects without arrays are sent as they are
+    assert SharedResult.share({'name': 'item', 'length': 3}, str(path)) == {'name': 'item', 'length': 3}
+    assert not path.exists()
+
+
+def test_array_results_are_passed_through_shared_memory():
+    args = [[x] for x in range(6)]
+    results = ordered_results(
+        chunked_multiprocess_run(make_item, args, num_workers=2, shared_memory=True), range(len(args))
+    )
+    for x, result in enumerate(results):
+        assert isinstance(result['mel'], np.memmap)
+        assert_same(result, make_item(x))
@@ -0,0 +1,111 @@
+import pathlib
+
+import pytest
+import torch
+
+from modules.fastspeech.acoustic_encoder import FastSpeech2Acoustic
+from modules.losses import DurationLoss
+from training.acoustic_task import AcousticDataset
+from training.variance_task import VarianceDataset
+from utils.hparams import hparams, set_hparams
+
+root_dir = pathlib.Path(__file__).parent.parent.resolve()
+
+
+@pytest.fixture
+def config(monkeypatch):
+    monkeypatch.chdir(root_dir)
+    saved_hparams = dict(hparams)
+
+    def load(path, **overrides):
+        set_hparams(config=path, print_hparams=False)
+        hparams.update(overrides)
+
+    yield load
+    hparams.clear()
+    hparams.update(saved_hparams)
+
+
+def make_dataset(cls, sizes, **attrs):
+    # the collaters only need the sizes and the flags set in __init__, not the binary data
+    dataset = cls.__new__(cls)
+    dataset.sizes = sizes
+    for k, v in attrs.items():
+        setattr(dataset, k, v)
+    return dataset
+
+
+def make_acoustic_sample(idx, num_tokens, num_frames):
+    return {
+        '_idx': idx,
+        'tokens': torch.randint(1, 10, (num_tokens,)),
+        'mel2ph': torch.arange(num_frames) * num_tokens // num_frames + 1,
+        'mel': torch.randn(num_frames, 16),
+        'f0': torch.rand(num_frames) * 400 + 100,
+    }
+
+
+def make_variance_sample(idx, num_words, phones_per_word):
+    num_tokens = num_words * phones_per_word
+    return {
+        '_idx': idx,
+        'tokens': torch.randint(1, 10, (num_tokens,)),
+        'ph_dur': torch.randint(1, 20, (num_tokens,)),
+        'ph2word': torch.arange(num_tokens) // phones_per_word + 1,
+        'midi': torch.randint(40, 80, (num_tokens,)),
+    }
+
+
+def test_packed_encoder_matches_unpacked(config):
+    config(
+        'configs/acoustic.yaml', hidden_size=32, enc_layers=2,
+        use_spk_id=False, use_key_shift_embed=False, use_speed_embed=False,
+        use_energy_embed=False, use_breathiness_embed=False, use_voicing_embed=False, use_tension_embed=False,
+    )
+    torch.manual_seed(0)
+    samples = [make_acoustic_sample(0, 5, 24), make_acoustic_sample(1, 7, 30), make_acoustic_sample(2, 8, 48)]
+    dataset = make_dataset(
+        AcousticDataset, [24, 30, 48], packing_frames=64, required_variances={},
+        need_key_shift=False, need_speed=False, need_spk_id=False
+    )
+    packed = dataset.collater([[samples[0], samples[1]], [samples[2]]])
+    assert packed['row_bounds'].tolist() == [0, 2, 3]
+    dataset.packing_frames = 0
+    unpacked = dataset.collater(samples)
+
+    encoder = FastSpeech2Acoustic(vocab_size=10).eval()
+    with torch.no_grad():
+        packed_out = encoder(packed['tokens'], packed['mel2ph'], packed['f0'], ph_seg=packed['ph_seg'])
+        unpacked_out = encoder(unpacked['tokens'], unpacked['mel2ph'], unpacked['f0'])
+    for (row, start), i in zip([(0, 0), (0, 24), (1, 0)], range(3)):
+        length = dataset.sizes[i]
+        torch.testing.assert_close(
+            packed_out[row, start: start + length], unpacked_out[i, :length], rtol=1e-5, atol=1e-5
+        )
+
+
+def test_packed_duration_loss_matches_unpacked(config):
+    config('configs/variance.yaml', use_spk_id=False, predict_dur=True, predict_pitch=False,
+           predict_energy=False, predict_breathiness=False, predict_voicing=False, predict_tension=False)
+    torch.manual_seed(0)
+    # the same number of phonemes and words in each item, so that the padded shapes have the same size
+    samples = [make_variance_sample(i, 3, 2) for i in range(4)]
+    dataset = make_dataset(VarianceDataset, [6] * 4, packing_frames=12, predict_variances=False)
+    packed = dataset.collater([[samples[0], samples[1]], [samples[2], samples[3]]])
+    dataset.packing_frames = 0
+    unpacked = dataset.collater(samples)
+
+    dur_pred = torch.rand(4, 6) * 20
+    loss = DurationLoss(offset=1., loss_type='mse')
+    packed_loss = loss(dur_pred.reshape(2, 12), packed['ph_dur'], packed['ph2word'], segments=packed['ph_seg'])
+    unpacked_loss = loss(dur_pred, unpacked['ph_dur'], unpacked['ph2word'])
+    torch.testing.assert_close(packed_loss, unpacked_loss)
+
+
+def test_collater_rejects_rows_over_capacity():
+    samples = [make_acoustic_sample(0, 5, 24), make_acoustic_sample(1, 7, 30)]
+    dataset = make_dataset(AcousticDataset, [24, 30], packing_frames=48)
+    with pytest.raises(AssertionError):
+        dataset.unpack_rows([samples])
+    # a single item longer than the capacity takes a row on its own
+    assert dataset.unpack_rows([[samples[0]], [samples[1]]])[1] == [[0], [1]]
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import torch
+
+from modules.pe.rmvpe import RMVPE
+from modules.pe.rmvpe.model import E2E0
+
+
+@pytest.fixture(scope='module')
+def pe(tmp_path_factory):
+    torch.manual_seed(0)
+    model = E2E0(4, 1, (2, 2))
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            # so that the padding frames are not mapped to zeros by the normalization
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2.)
+    ckpt = tmp_path_factory.mktemp('rmvpe') / 'model.pt'
+    torch.save({'model': model.state_dict()}, ckpt)
+    return RMVPE(str(ckpt), batch_frames=4096)
+
+
+@pytest.fixture(scope='module')
+def waveforms():
+    rng = np.random.default_rng(0)
+    t = np.arange(16000) / 16000
+    return [
+        (0.3 * np.sin(2 * np.pi * rng.uniform(100, 400) * t[:n]) + 0.01 * rng.standard_normal(n)).astype(np.float32)
+        for n in [3000, 3100, 5160, 9000, 16000]
+    ]
+
+
+@pytest.mark.parametrize('use_viterbi', [False, True])
+def test_batched_f0_matches_single(pe, waveforms, use_viterbi):
+    batched = pe.infer_from_audio_batch(waveforms, use_viterbi=use_viterbi)
+    for waveform, f0 in zip(waveforms, batched):
+        f0_single = pe.infer_from_audio(waveform, use_viterbi=use_viterbi).reshape(-1)
+        assert f0.shape == f0_single.shape
+        np.testing.assert_allclose(f0, f0_single, rtol=1e-4, atol=1e-2)
+
+
+def test_batched_hidden_does_not_depend_on_batch(pe, waveforms):
+    mels = [pe.mel_extractor(torch.from_numpy(w)[None], center=True)[0] for w in waveforms]
+    hidden = pe.mel2hidden_batch(mels)
+    for i, mel in enumerate(mels):
+        torch.testing.assert_close(hidden[i, :mel.shape[-1]], pe.mel2hidden(mel[None])[0], rtol=1e-4, atol=1e-5)
+
+
+def test_prefetched_f0_is_reused(pe, waveforms, monkeypatch):
+    pe.f0_cache.clear()
+    pe.prefetch_pitch(waveforms, 16000, keys=['a', 'b', 'c', 'd', 'e'])
+
+    def fail(*args, **kwargs):
+        raise AssertionError('Prefetched f0 should not be extracted again.')
+
+    monkeypatch.setattr(pe, 'infer_from_audio_batch', fail)
+    f0, uv = pe.get_pitch(waveforms[1], 16000, 20, hop_size=160, speed=1.5, key='b')
+    assert f0.shape == (20,) and uv.shape == (20,)
+    assert len(pe.f0_cache) <= pe.cache_size
@@ -20,6 +20,8 @@ matplotlib.use('Agg')
 
 
 class AcousticDataset(BaseDataset):
+    supports_packing = True
+
     def __init__(self, prefix, preload=False):
         super(AcousticDataset, self).__init__(prefix, hparams['dataset_size_key'], preload)
         self.required_variances = {}  # key: variance name, value: padding value
@@ -37,29 +39,53 @@ class AcousticDataset(BaseDataset):
         self.need_spk_id = hparams['use_spk_id']
 
     def collater(self, samples):
-        batch = super().collater(samples)
+        rows = None
+        if self.packing_frames > 0:
+            # the sampler yields packed rows
+            samples, rows = self.unpack_rows(samples)
+        batch = super().collater(samples, rows=rows)
         if batch['size'] == 0:
             return batch
 
-        tokens = utils.collate_nd([s['tokens'] for s in samples], 0)
-        f0 = utils.collate_nd([s['f0'] for s in samples], 0.0)
-        mel2ph = utils.collate_nd([s['mel2ph'] for s in samples], 0)
-        mel = utils.collate_nd([s['mel'] for s in samples], 0.0)
-        batch.update({
-            'tokens': tokens,
-            'mel2ph': mel2ph,
-            'mel': mel,
-            'f0': f0,
-        })
+        arena = utils.CollateArena()
+        if rows is not None:
+            # concatenate the samples in each row
+            ph_lengths = [s['tokens'].shape[0] for s in samples]
+            mel_lengths = [s['mel'].shape[0] for s in samples]
+
+            def add(key, values, pad_value, index_lengths=None):
+                arena.add_packed(key, values, rows, pad_value, index_lengths=index_lengths)
+
+            def add_values(key, values, dtype):
+                # frame-level in packed rows
+                arena.add_packed_values(key, values, rows, mel_lengths, dtype)
+
+            arena.add_segment_ids('ph_seg', rows, ph_lengths)
+        else:
+            ph_lengths = None
+
+            def add(key, values, pad_value, index_lengths=None):
+                arena.add(key, values, pad_value)
+
+            add_values = arena.add_values
+
+        add('tokens', [s['tokens'] for s in samples], 0)
+        add('mel2ph', [s['mel2ph'] for s in samples], 0, index_lengths=ph_lengths)
+        add('mel', [s['mel'] for s in samples], 0.0)
+        add('f0', [s['f0'] for s in samples], 0.0)
         for v_name, v_pad in self.required_variances.items():
-            batch[v_name] = utils.collate_nd([s[v_name] for s in samples], v_pad)
+            add(v_name, [s[v_name] for s in samples], v_pad)
         if self.need_key_shift:
-            batch['key_shift'] = torch.FloatTensor([s['key_shift'] for s in samples])[:, None]
+            add_values('key_shift', [s['key_shift'] for s in samples], torch.float32)
         if self.need_speed:
-            batch['speed'] = torch.FloatTensor([s['speed'] for s in samples])[:, None]
+            add_values('speed', [s['speed'] for s in samples], torch.float32)
         if self.need_spk_id:
-            spk_ids = torch.LongTensor([s['spk_id'] for s in samples])
-            batch['spk_ids'] = spk_ids
+            add_values('spk_ids', [s['spk_id'] for s in samples], torch.long)
+        batch = arena.collate(batch)
+        if self.need_key_shift and self.packing_frames <= 0:
+            batch['key_shift'] = batch['key_shift'][:, None]
+        if self.need_speed and self.packing_frames <= 0:
+            batch['speed'] = batch['speed'][:, None]
         return batch
 
 
@@ -131,7 +157,7 @@ class AcousticTask(BaseTask):
         output: ShallowDiffusionOutput = self.model(
             txt_tokens, mel2ph=mel2ph, f0=f0, **variances,
             key_shift=key_shift, speed=speed, spk_embed_id=spk_embed_id,
-            gt_mel=target, infer=infer
+            gt_mel=target, infer=infer, ph_seg=sample.get('ph_seg')
         )
 
         if infer:
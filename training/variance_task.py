@@ -1,6 +1,7 @@
 import matplotlib
 import torch
 import torch.distributions
+import torch.nn.functional as F
 import torch.optim
 import torch.utils.data
 
@@ -19,6 +20,8 @@ matplotlib.use('Agg')
 
 
 class VarianceDataset(BaseDataset):
+    supports_packing = True
+
     def __init__(self, prefix, preload=False):
         super(VarianceDataset, self).__init__(prefix, hparams['dataset_size_key'], preload)
         need_energy = hparams['predict_energy']
@@ -28,51 +31,91 @@ class VarianceDataset(BaseDataset):
         self.predict_variances = need_energy or need_breathiness or need_voicing or need_tension
 
     def collater(self, samples):
-        batch = super().collater(samples)
+        rows = None
+        if self.packing_frames > 0:
+            # the sampler yields packed rows
+            samples, rows = self.unpack_rows(samples)
+        batch = super().collater(samples, rows=rows)
         if batch['size'] == 0:
             return batch
 
-        tokens = utils.collate_nd([s['tokens'] for s in samples], 0)
-        ph_dur = utils.collate_nd([s['ph_dur'] for s in samples], 0)
-        batch.update({
-            'tokens': tokens,
-            'ph_dur': ph_dur
-        })
+        arena = utils.CollateArena()
+        if rows is not None:
+            # concatenate the samples in each row
+            ph_lengths = [s['tokens'].shape[0] for s in samples]
+
+            def add(key, values, pad_value, index_lengths=None):
+                arena.add_packed(key, values, rows, pad_value, index_lengths=index_lengths)
+
+            def add_values(key, values, dtype):
+                # phoneme-level in packed rows
+                arena.add_packed_values(key, values, rows, ph_lengths, dtype)
+
+            arena.add_segment_ids('ph_seg', rows, ph_lengths)
+            if hparams['predict_pitch']:
+                arena.add_segment_ids('note_seg', rows, [s['note_midi'].shape[0] for s in samples])
+        else:
+            ph_lengths = None
+
+            def add(key, values, pad_value, index_lengths=None):
+                arena.add(key, values, pad_value)
+
+            add_values = arena.add_values
+
+        add('tokens', [s['tokens'] for s in samples], 0)
+        add('ph_dur', [s['ph_dur'] for s in samples], 0)
 
         if hparams['use_spk_id']:
-            batch['spk_ids'] = torch.LongTensor([s['spk_id'] for s in samples])
+            add_values('spk_ids', [s['spk_id'] for s in samples], torch.long)
         if hparams['predict_dur']:
-            batch['ph2word'] = utils.collate_nd([s['ph2word'] for s in samples], 0)
-            batch['midi'] = utils.collate_nd([s['midi'] for s in samples], 0)
+            add(
+                'ph2word', [s['ph2word'] for s in samples], 0,
+                index_lengths=None if ph_lengths is None else [int(s['ph2word'].max()) for s in samples]
+            )
+            add('midi', [s['midi'] for s in samples], 0)
         if hparams['predict_pitch']:
-            batch['note_midi'] = utils.collate_nd([s['note_midi'] for s in samples], -1)
-            batch['note_rest'] = utils.collate_nd([s['note_rest'] for s in samples], True)
-            batch['note_dur'] = utils.collate_nd([s['note_dur'] for s in samples], 0)
+            add('note_midi', [s['note_midi'] for s in samples], -1)
+            add('note_rest', [s['note_rest'] for s in samples], True)
+            add('note_dur', [s['note_dur'] for s in samples], 0)
             if hparams['use_glide_embed']:
-                batch['note_glide'] = utils.collate_nd([s['note_glide'] for s in samples], 0)
-            batch['mel2note'] = utils.collate_nd([s['mel2note'] for s in samples], 0)
-            batch['base_pitch'] = utils.collate_nd([s['base_pitch'] for s in samples], 0)
+                add('note_glide', [s['note_glide'] for s in samples], 0)
+            add(
+                'mel2note', [s['mel2note'] for s in samples], 0,
+                index_lengths=None if ph_lengths is None else [s['note_midi'].shape[0] for s in samples]
+            )
+            add('base_pitch', [s['base_pitch'] for s in samples], 0)
         if hparams['predict_pitch'] or self.predict_variances:
-            batch['mel2ph'] = utils.collate_nd([s['mel2ph'] for s in samples], 0)
-            batch['pitch'] = utils.collate_nd([s['pitch'] for s in samples], 0)
-            batch['uv'] = utils.collate_nd([s['uv'] for s in samples], True)
+            add('mel2ph', [s['mel2ph'] for s in samples], 0, index_lengths=ph_lengths)
+            add('pitch', [s['pitch'] for s in samples], 0)
+            add('uv', [s['uv'] for s in samples], True)
         if hparams['predict_energy']:
-            batch['energy'] = utils.collate_nd([s['energy'] for s in samples], 0)
+            add('energy', [s['energy'] for s in samples], 0)
         if hparams['predict_breathiness']:
-            batch['breathiness'] = utils.collate_nd([s['breathiness'] for s in samples], 0)
+            add('breathiness', [s['breathiness'] for s in samples], 0)
         if hparams['predict_voicing']:
-            batch['voicing'] = utils.collate_nd([s['voicing'] for s in samples], 0)
+            add('voicing', [s['voicing'] for s in samples], 0)
         if hparams['predict_tension']:
-            batch['tension'] = utils.collate_nd([s['tension'] for s in samples], 0)
+            add('tension', [s['tension'] for s in samples], 0)
 
-        return batch
+        return arena.collate(batch)
 
 
-def random_retake_masks(b, t, device):
-    # 1/4 segments are True in average
-    B_masks = torch.randint(low=0, high=4, size=(b, 1), dtype=torch.long, device=device) == 0
-    # 1/3 frames are True in average
-    T_masks = utils.random_continuous_masks(b, t, dim=1, device=device)
+def random_retake_masks(b, t, device, segments=None):
+    """
+    :param segments: [B, T], index of the utterance of each frame in packed rows (0 for padding);
+        if given, the masks are drawn for each utterance instead of each row
+    """
+    if segments is None:
+        # 1/4 segments are True in average
+        B_masks = torch.randint(low=0, high=4, size=(b, 1), dtype=torch.long, device=device) == 0
+        # 1/3 frames are True in average
+        T_masks = utils.random_continuous_masks(b, t, dim=1, device=device)
+    else:
+        B_masks = torch.randint(
+            low=0, high=4, size=(b, int(segments.max()) + 1), dtype=torch.long, device=device
+        ) == 0
+        B_masks = torch.gather(B_masks, 1, segments)
+        T_masks = utils.random_continuous_segment_masks(segments)
     # 1/4 segments and 1/2 frames are True in average (1/4 + 3/4 * 1/3 = 1/2)
     return B_masks | T_masks
 
@@ -153,12 +196,14 @@ class VarianceTask(BaseTask):
             self.register_validation_loss('var_loss')
 
     def run_model(self, sample, infer=False):
-        spk_ids = sample['spk_ids'] if self.use_spk_id else None  # [B,]
+        spk_ids = sample['spk_ids'] if self.use_spk_id else None  # [B,] or [B, T_ph] in packed rows
         txt_tokens = sample['tokens']  # [B, T_ph]
         ph_dur = sample['ph_dur']  # [B, T_ph]
         ph2word = sample.get('ph2word')  # [B, T_ph]
         midi = sample.get('midi')  # [B, T_ph]
         mel2ph = sample.get('mel2ph')  # [B, T_s]
+        ph_seg = sample.get('ph_seg')  # [B, T_ph], only in packed rows
+        note_seg = sample.get('note_seg')  # [B, T_n], only in packed rows
 
         note_midi = sample.get('note_midi')  # [B, T_n]
         note_rest = sample.get('note_rest')  # [B, T_n]
@@ -176,14 +221,14 @@ class VarianceTask(BaseTask):
         pitch_retake = variance_retake = None
         if (self.predict_pitch or self.predict_variances) and not infer:
             # randomly select continuous retaking regions
-            b = sample['size']
-            t = mel2ph.shape[1]
+            b, t = mel2ph.shape
             device = mel2ph.device
+            mel_seg = torch.gather(F.pad(ph_seg, [1, 0]), 1, mel2ph) if ph_seg is not None else None
             if self.predict_pitch:
-                pitch_retake = random_retake_masks(b, t, device)
+                pitch_retake = random_retake_masks(b, t, device, segments=mel_seg)
             if self.predict_variances:
                 variance_retake = {
-                    v_name: random_retake_masks(b, t, device)
+                    v_name: random_retake_masks(b, t, device, segments=mel_seg)
                     for v_name in self.variance_prediction_list
                 }
 
@@ -195,7 +240,7 @@ class VarianceTask(BaseTask):
             base_pitch=base_pitch, pitch=pitch,
             energy=energy, breathiness=breathiness, voicing=voicing, tension=tension,
             pitch_retake=pitch_retake, variance_retake=variance_retake,
-            spk_id=spk_ids, infer=infer
+            spk_id=spk_ids, infer=infer, ph_seg=ph_seg, note_seg=note_seg
         )
 
         dur_pred, pitch_pred, variances_pred = output
@@ -206,7 +251,9 @@ class VarianceTask(BaseTask):
         else:
             losses = {}
             if dur_pred is not None:
-                losses['dur_loss'] = self.lambda_dur_loss * self.dur_loss(dur_pred, ph_dur, ph2word=ph2word)
+                losses['dur_loss'] = self.lambda_dur_loss * self.dur_loss(
+                    dur_pred, ph_dur, ph2word=ph2word, segments=ph_seg
+                )
             non_padding = (mel2ph > 0).unsqueeze(-1) if mel2ph is not None else None
             if pitch_pred is not None:
                 if self.diffusion_type == 'ddpm':
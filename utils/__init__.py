@@ -38,6 +38,163 @@ def collate_nd(values, pad_value=0, max_len=None):
     return res
 
 
+class CollatedBatch(dict):
+    """
+    A batch whose tensors are views of one contiguous buffer (the arena). When pinned by
+    torch.utils.data.DataLoader, the whole arena is pinned with one allocation and one copy
+    instead of one per tensor.
+    """
+    arena: torch.Tensor = None
+
+    def pin_memory(self, device=None):
+        res = CollatedBatch()
+        if self.arena is not None:
+            res.arena = self.arena.pin_memory()
+            arena_ptr = self.arena.untyped_storage().data_ptr()
+        else:
+            arena_ptr = None
+        for k, v in self.items():
+            if isinstance(v, torch.Tensor):
+                if v.untyped_storage().data_ptr() == arena_ptr:
+                    v = torch.empty(0, dtype=v.dtype).set_(
+                        res.arena.untyped_storage(), v.storage_offset(), v.size(), v.stride()
+                    )
+                else:
+                    v = v.pin_memory()
+            res[k] = v
+        return res
+
+
+class CollateArena:
+    """
+    Collect the fields of a batch and allocate all of them from one contiguous buffer.
+    Usage:
+        arena = CollateArena()
+        arena.add('mel', [s['mel'] for s in samples], 0.0)  # pad and stack like collate_nd()
+        arena.add_values('spk_ids', [s['spk_id'] for s in samples], torch.long)  # 1d tensor of scalars
+        batch = arena.collate(batch)
+    The time spent from creating the arena to the end of collate() is stored in batch['collate_time'].
+    """
+    ALIGNMENT = 64
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.fields = []  # (key, values, pad_value, shape, dtype)
+
+    def add(self, key, values, pad_value=0, max_len=None):
+        shape = ((max(v.size(0) for v in values) if max_len is None else max_len), *values[0].shape[1:])
+        self.fields.append((key, values, pad_value, (len(values), *shape), values[0].dtype))
+
+    def add_values(self, key, values, dtype):
+        self.fields.append((key, values, None, (len(values),), dtype))
+
+    def add_packed(self, key, values, rows, pad_value=0, index_lengths=None):
+        """
+        Concatenate the values of the samples in each row (positions in values), then pad and stack them like add().
+        :param index_lengths: if given, the values are 1-based indices (0 for padding) into another sequence
+            of each sample (e.g. mel2ph into tokens), and these are the lengths of that sequence, so that
+            the indices of each sample are shifted to index the concatenated sequence.
+        """
+        packed = []
+        for row in rows:
+            if index_lengths is None:
+                packed.append(torch.cat([values[i] for i in row]))
+                continue
+            parts = []
+            offset = 0
+            for i in row:
+                parts.append(torch.where(values[i] > 0, values[i] + offset, values[i]))
+                offset += index_lengths[i]
+            packed.append(torch.cat(parts))
+        self.add(key, packed, pad_value)
+
+    def add_packed_values(self, key, values, rows, lengths, dtype, pad_value=0):
+        """
+        Repeat the scalar value of each sample over its length and concatenate them in each row.
+        """
+        self.add(key, [
+            torch.cat([torch.full((lengths[i],), values[i], dtype=dtype) for i in row])
+            for row in rows
+        ], pad_value)
+
+    def add_segment_ids(self, key, rows, lengths):
+        """
+        Add the 1-based index of the sample in its row at each position, and 0 for padding.
+        """
+        self.add(key, [
+            torch.cat([torch.full((lengths[i],), j + 1, dtype=torch.long) for j, i in enumerate(row)])
+            for row in rows
+        ], 0)
+
+    def collate(self, batch: dict = None) -> CollatedBatch:
+        offsets = []
+        total_bytes = 0
+        for _, _, _, shape, dtype in self.fields:
+            total_bytes += -total_bytes % self.ALIGNMENT
+            offsets.append(total_bytes)
+            total_bytes += int(np.prod(shape)) * torch.empty(0, dtype=dtype).element_size()
+
+        res = CollatedBatch() if batch is None else CollatedBatch(batch)
+        res.arena = torch.empty(total_bytes, dtype=torch.uint8)
+        for (key, values, pad_value, shape, dtype), offset in zip(self.fields, offsets):
+            nbytes = int(np.prod(shape)) * torch.empty(0, dtype=dtype).element_size()
+            out = res.arena[offset: offset + nbytes].view(dtype).view(shape)
+            if pad_value is None:
+                out.copy_(torch.as_tensor(values, dtype=dtype))
+            else:
+                for i, v in enumerate(values):
+                    out[i, :len(v), ...] = v
+                    out[i, len(v):, ...] = pad_value
+            res[key] = out
+        res['collate_time'] = time.perf_counter() - self.start_time
+        return res
+
+
+def pack_rows(lengths, capacity):
+    """
+    Pack consecutive samples into rows of at most capacity frames (next fit).
+    A sample longer than capacity takes a row on its own.
+    :param lengths: number of frames of each sample
+    :return: list of rows, each of which is a list of positions in lengths
+    """
+    rows = []
+    fill = 0
+    for i, length in enumerate(lengths):
+        if len(rows) > 0 and fill + length <= capacity:
+            rows[-1].append(i)
+            fill += length
+        else:
+            rows.append([i])
+            fill = length
+    return rows
+
+
+def segment_positions(segment_ids):
+    """
+    Positions inside the segments of packed rows.
+    :param segment_ids: [B, T], 1-based index of the segment at each position, 0 for padding
+    :return: 0-based positions from the start of the segment and to the end of the segment, [B, T] each
+    """
+    b, t = segment_ids.shape
+    idx = torch.arange(t, device=segment_ids.device)[None, :].expand(b, t)
+    starts = F.pad(segment_ids[:, 1:] != segment_ids[:, :-1], [1, 0], value=True)
+    ends = F.pad(segment_ids[:, :-1] != segment_ids[:, 1:], [0, 1], value=True)
+    start = torch.cummax(idx * starts, dim=1).values
+    end = torch.cummin(torch.where(ends, idx, t).flip(1), dim=1).values.flip(1)
+    non_padding = segment_ids > 0
+    return (idx - start) * non_padding, (end - idx) * non_padding
+
+
+def segment_attention_mask(segment_ids):
+    """
+    Attention mask that keeps attention inside the segments of packed rows.
+    Padding queries are not masked, so that they still have keys to attend to.
+    :param segment_ids: [B, T], 1-based index of the segment at each position, 0 for padding
+    :return: bool [B, T, T], True where query i (dim 1) may not attend to key j (dim 2)
+    """
+    return (segment_ids[:, :, None] != segment_ids[:, None, :]) & (segment_ids[:, :, None] > 0)
+
+
 def random_continuous_masks(*shape: int, dim: int, device: str | torch.device = 'cpu'):
     start, end = torch.sort(
         torch.randint(
@@ -51,6 +208,24 @@ def random_continuous_masks(*shape: int, dim: int, device: str | torch.device =
     return masks
 
 
+def random_continuous_segment_masks(segment_ids):
+    """
+    Like random_continuous_masks(), but select one random continuous region in each segment of packed rows.
+    :param segment_ids: [B, T], 1-based index of the segment at each position, 0 for padding
+    :return: bool [B, T]
+    """
+    b = segment_ids.shape[0]
+    k = int(segment_ids.max()) + 1
+    lengths = segment_ids.new_zeros(b, k).scatter_add(1, segment_ids, torch.ones_like(segment_ids))
+    bounds = torch.sort(
+        (torch.rand(b, k, 2, device=segment_ids.device) * (lengths[:, :, None] + 1)).long(), dim=2
+    )[0]
+    start = torch.gather(bounds[:, :, 0], 1, segment_ids)
+    end = torch.gather(bounds[:, :, 1], 1, segment_ids)
+    positions, _ = segment_positions(segment_ids)
+    return (positions >= start) & (positions < end) & (segment_ids > 0)
+
+
 def _is_batch_full(batch, num_frames, max_batch_frames, max_batch_size):
     if len(batch) == 0:
         return 0
@@ -115,6 +290,86 @@ def batch_by_size(
     return batches
 
 
+def batch_by_size_vectorized(sizes, max_batch_frames=80000, max_batch_size=48, min_padding_efficiency=0.):
+    """
+    Split a sequence of samples into consecutive mini-batches, as batch_by_size() does,
+    but working on an array of sizes with NumPy instead of calling a function on each index.
+    A batch is closed when adding the next sample would exceed max_batch_frames (counted
+    with padding), max_batch_size, or make the ratio of real frames to padded frames fall
+    below min_padding_efficiency. With min_padding_efficiency=0, the batches are the same
+    as those of batch_by_size().
+
+    Args:
+        sizes (np.ndarray): number of frames of each sample, in the order of batching
+        max_batch_frames (int, optional): max number of padded frames in each batch
+            (default: 80000).
+        max_batch_size (int, optional): max number of sentences in each
+            batch (default: 48).
+        min_padding_efficiency (float, optional): min ratio of real frames to padded
+            frames in each batch of more than one sample (default: 0).
+
+    Returns:
+        np.ndarray: boundaries of the batches; batch i is sizes[bounds[i]: bounds[i + 1]]
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    if len(sizes) > 0 and sizes.max() > max_batch_frames:
+        idx = int(sizes.argmax())
+        raise AssertionError(
+            "sentence at position {} of size {} exceeds max_batch_samples "
+            "limit of {}!".format(idx, sizes[idx], max_batch_frames)
+        )
+    counts = np.arange(1, max_batch_size + 1, dtype=np.int64)
+    bounds = [0]
+    start = 0
+    while start < len(sizes):
+        # the batch cannot be longer than this since each sample is padded to at least sizes[start]
+        window = sizes[start: start + min(max_batch_size, max_batch_frames // max(int(sizes[start]), 1))]
+        padded = counts[:len(window)] * np.maximum.accumulate(window)
+        fit = padded <= max_batch_frames
+        if min_padding_efficiency > 0:
+            fit &= np.cumsum(window) >= min_padding_efficiency * padded
+        fit = np.flatnonzero(fit)
+        start += int(fit[-1]) + 1 if len(fit) > 0 else 1
+        bounds.append(start)
+    return np.array(bounds, dtype=np.int64)
+
+
+def pack_by_size(sizes, capacity):
+    """
+    Pack samples into rows of at most capacity frames. Each row starts with the first remaining
+    sample and is filled up with the last remaining samples as long as they fit, so with sizes
+    sorted in descending order, long samples are packed together with short ones.
+    A sample longer than capacity takes a row on its own.
+    The samples of each row are laid out in one run, and with sizes in descending order,
+    pack_rows() on the reordered sizes gives the same rows.
+
+    Args:
+        sizes (np.ndarray): number of frames of each sample
+        capacity (int): max number of frames in each row
+
+    Returns:
+        (np.ndarray, np.ndarray): the new order of the samples and the boundaries of the rows;
+            row i is order[bounds[i]: bounds[i + 1]]
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    # negated suffix sums, non-decreasing: sum(sizes[k: hi]) = neg_suffix[hi] - neg_suffix[k]
+    neg_suffix = np.append(-np.cumsum(sizes[::-1])[::-1], 0)
+    order = []
+    bounds = [0]
+    lo, hi = 0, len(sizes)  # the remaining samples are sizes[lo: hi]
+    while lo < hi:
+        room = capacity - int(sizes[lo])
+        order.append(lo)
+        lo += 1
+        if room > 0:
+            # the smallest k such that sizes[k: hi] fits in the room
+            k = max(int(np.searchsorted(neg_suffix, neg_suffix[hi] - room, side='left')), lo)
+            order.extend(range(hi - 1, k - 1, -1))
+            hi = k
+        bounds.append(len(order))
+    return np.array(order, dtype=np.int64), np.array(bounds, dtype=np.int64)
+
+
 def make_positions(tensor, padding_idx):
     """Replace non-padding symbols with their position numbers.
 
@@ -1,4 +1,11 @@
-from typing import Union, Dict
+import hashlib
+import json
+import os
+import pathlib
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Union, Dict, List
 
 import librosa
 import numpy as np
@@ -8,9 +15,306 @@ import torch
 import torch.nn.functional as F
 
 from modules.nsf_hifigan.nvSTFT import STFT
+from utils.hparams import hparams
 from utils.pitch_utils import interp_f0
 
 
+stage_timings: Dict[str, float] = {}
+
+
+@contextmanager
+def timed_stage(name: str):
+    """
+    Add the time spent inside this context to the timings of the given stage in the current process.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_timings[name] = stage_timings.get(name, 0.) + time.perf_counter() - start
+
+
+def pop_stage_timings() -> Dict[str, float]:
+    """
+    Get and reset the stage timings collected in the current process since the last call.
+    """
+    timings = dict(stage_timings)
+    stage_timings.clear()
+    return timings
+
+
+class WaveformCache:
+    """
+    LRU cache of decoded and resampled mono waveforms, so that the original item and
+    all of its augmented copies only decode and resample the audio file once.
+    If cache_dir is given, decoded waveforms are also saved to it as .npy files and
+    memory-mapped (copy-on-write) on later loads, even across binarization runs.
+    """
+
+    def __init__(self, max_size=4, cache_dir=None):
+        self.max_size = max_size
+        self.cache_dir = pathlib.Path(cache_dir) if cache_dir is not None else None
+        self._cache = OrderedDict()
+
+    @staticmethod
+    def _decode(wav_fn: pathlib.Path, samplerate):
+        # the same as librosa.load(wav_fn, sr=samplerate, mono=True), with both stages timed
+        with timed_stage('decode'):
+            waveform, native_samplerate = librosa.load(wav_fn, sr=None, mono=True)
+        if native_samplerate != samplerate:
+            with timed_stage('resample'):
+                waveform = librosa.resample(waveform, orig_sr=native_samplerate, target_sr=samplerate)
+        return waveform
+
+    def _load_or_decode(self, wav_fn: pathlib.Path, samplerate, key):
+        if self.cache_dir is None:
+            return self._decode(wav_fn, samplerate)
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        scratch_path = self.cache_dir / f'{digest}.npy'
+        if not scratch_path.exists():
+            waveform = self._decode(wav_fn, samplerate)
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # write to a temporary file first so that concurrent workers never see partial files
+            tmp_path = scratch_path.with_name(f'{scratch_path.stem}.{os.getpid()}.tmp')
+            with open(tmp_path, 'wb') as f:
+                np.save(f, waveform.astype(np.float32))
+            os.replace(tmp_path, scratch_path)
+        return np.load(scratch_path, mmap_mode='c')
+
+    def load(self, wav_fn, samplerate):
+        """
+        :param wav_fn: path to the audio file
+        :param samplerate: target sampling rate
+        :return: waveform, float32 [T]
+        """
+        wav_fn = pathlib.Path(wav_fn).resolve()
+        stat = wav_fn.stat()
+        key = (str(wav_fn), stat.st_mtime_ns, stat.st_size, samplerate)
+        waveform = self._cache.get(key)
+        if waveform is not None:
+            self._cache.move_to_end(key)
+            return waveform
+        waveform = self._load_or_decode(wav_fn, samplerate, key)
+        if self.max_size > 0:
+            self._cache[key] = waveform
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return waveform
+
+
+waveform_cache: WaveformCache = None
+
+
+def load_waveform(wav_fn, samplerate):
+    """
+    Load a mono waveform through the waveform cache of the current process,
+    which is configured by binarization_args.wav_cache_size and binarization_args.wav_cache_dir.
+    The returned array is shared with other callers and should not be modified in place.
+    """
+    global waveform_cache
+    if waveform_cache is None:
+        binarization_args = hparams.get('binarization_args', {})
+        waveform_cache = WaveformCache(
+            # keep a whole bucket of prefetched items, so that their waveforms are not decoded twice
+            max_size=max(binarization_args.get('wav_cache_size', 4), binarization_args.get('pe_batch_size', 1)),
+            cache_dir=binarization_args.get('wav_cache_dir')
+        )
+    return waveform_cache.load(wav_fn, samplerate)
+
+
+class FeatureCache:
+    """
+    Content-addressed on-disk cache of features extracted from audio files.
+    Each entry is keyed on the hash of the audio content, the name of the feature and
+    the parameters it depends on. Re-binarizing after editing labels or unrelated
+    hyperparameters reuses the entries, while changing the audio or any of these
+    parameters computes the feature again.
+    """
+    VERSION = 1
+
+    def __init__(self, cache_dir):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self._wav_digests = {}
+        self.hits = 0
+        self.misses = 0
+
+    def wav_digest(self, wav_fn):
+        wav_fn = pathlib.Path(wav_fn).resolve()
+        stat = wav_fn.stat()
+        stat_key = (str(wav_fn), stat.st_mtime_ns, stat.st_size)
+        digest = self._wav_digests.get(stat_key)
+        if digest is None:
+            sha1 = hashlib.sha1()
+            with open(wav_fn, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha1.update(chunk)
+            digest = self._wav_digests[stat_key] = sha1.hexdigest()
+        return digest
+
+    def key(self, wav_fn, feature: str, params: dict):
+        key = (self.VERSION, self.wav_digest(wav_fn), feature, sorted(params.items()))
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def contains(self, wav_fn, feature: str, params: dict):
+        key = self.key(wav_fn, feature, params)
+        return (self.cache_dir / key[:2] / f'{key}.npz').exists()
+
+    def get_or_compute(self, wav_fn, feature: str, params: dict, compute_fn):
+        """
+        :param wav_fn: path to the audio file the feature is extracted from
+        :param feature: name of the feature
+        :param params: all parameters (except the audio) that the feature depends on
+        :param compute_fn: function that computes the feature, returning an array or a tuple of arrays
+        :return: cached or computed result of compute_fn
+        """
+        key = self.key(wav_fn, feature, params)
+        entry_path = self.cache_dir / key[:2] / f'{key}.npz'
+        if entry_path.exists():
+            try:
+                with np.load(entry_path) as entry:
+                    values = tuple(entry[f'arr_{i}'] for i in range(int(entry['num_arrays'])))
+                    is_tuple = bool(entry['is_tuple'])
+                self.hits += 1
+                return values if is_tuple else values[0]
+            except (OSError, ValueError, KeyError):
+                pass  # corrupted entry; compute it again
+        self.misses += 1
+        result = compute_fn()
+        is_tuple = isinstance(result, tuple)
+        values = result if is_tuple else (result,)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first so that concurrent workers never see partial files
+        tmp_path = entry_path.with_name(f'{key}.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, *values, num_arrays=len(values), is_tuple=is_tuple)
+        os.replace(tmp_path, entry_path)
+        return result
+
+
+feature_cache: FeatureCache = None
+
+
+def get_feature_cache():
+    """
+    Get the feature cache of the current process, which is enabled by
+    binarization_args.feature_cache_dir, or None if it is disabled.
+    """
+    global feature_cache
+    if feature_cache is None:
+        cache_dir = hparams.get('binarization_args', {}).get('feature_cache_dir')
+        if cache_dir is None:
+            return None
+        feature_cache = FeatureCache(cache_dir)
+    return feature_cache
+
+
+def cached_feature(wav_fn, feature: str, params: dict, compute_fn):
+    """
+    Get a feature through the feature cache of the current process.
+    If the cache is disabled, compute_fn is called directly.
+    The time spent is added to the stage named after the feature (see timed_stage()).
+    See FeatureCache.get_or_compute() for the arguments.
+    """
+    with timed_stage(feature):
+        cache = get_feature_cache()
+        if cache is None:
+            return compute_fn()
+        return cache.get_or_compute(wav_fn, feature, params, compute_fn)
+
+
+def feature_params(*keys, **extra):
+    """
+    Collect the hyperparameters a cached feature depends on, plus extra item-specific values.
+    """
+    return {**{k: hparams.get(k) for k in keys}, **extra}
+
+
+def array_digest(x: np.ndarray):
+    sha1 = hashlib.sha1(repr((x.dtype.str, x.shape)).encode('utf-8'))
+    sha1.update(np.ascontiguousarray(x).tobytes())
+    return sha1.hexdigest()
+
+
+class WorldArtifactCache:
+    """
+    On-disk cache of the WORLD analysis results (sp and ap) of decomposed waveforms and the
+    harmonic and aperiodic parts synthesized from them, keyed on the waveform, the f0 curve
+    and the analysis parameters. Arrays are saved as .npy files at their original dtype, so that
+    loading an artifact gives the same results as computing it, and memory-mapped on later loads. The time spent computing each artifact is recorded along with it,
+    so that loading it can be reported as saved time.
+    """
+    VERSION = 2
+
+    def __init__(self, cache_dir):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, waveform: np.ndarray, f0: np.ndarray, params: dict):
+        key = (self.VERSION, array_digest(waveform), array_digest(f0), sorted(params.items()))
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def load(self, key, name):
+        """
+        :return: (memory-mapped array, seconds spent computing it), or None if not cached
+        """
+        entry_path = self.cache_dir / key[:2] / f'{key}.{name}.npy'
+        meta_path = entry_path.with_suffix('.json')
+        if not entry_path.exists() or not meta_path.exists():
+            self.misses += 1
+            return None
+        try:
+            with open(meta_path, 'r', encoding='utf8') as f:
+                seconds = json.load(f)['seconds']
+            array = np.load(entry_path, mmap_mode='c')
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None  # corrupted entry; compute it again
+        self.hits += 1
+        return array, seconds
+
+    def load_seconds(self, key, name):
+        """
+        :return: seconds spent computing an artifact, or 0 if it is not cached
+        """
+        meta_path = self.cache_dir / key[:2] / f'{key}.{name}.json'
+        try:
+            with open(meta_path, 'r', encoding='utf8') as f:
+                return json.load(f)['seconds']
+        except (OSError, ValueError, KeyError):
+            return 0.
+
+    def save(self, key, name, array: np.ndarray, seconds):
+        entry_path = self.cache_dir / key[:2] / f'{key}.{name}.npy'
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        # write to temporary files first so that concurrent workers never see partial files;
+        # the array goes first because an entry only counts as cached when its metadata exists
+        tmp_path = entry_path.with_name(f'{key}.{name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, entry_path)
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump({'seconds': seconds}, f)
+        os.replace(tmp_path, entry_path.with_suffix('.json'))
+
+
+world_cache: WorldArtifactCache = None
+
+
+def get_world_cache():
+    """
+    Get the WORLD artifact cache of the current process, which is enabled by
+    binarization_args.world_cache_dir, or None if it is disabled.
+    """
+    global world_cache
+    if world_cache is None:
+        cache_dir = hparams.get('binarization_args', {}).get('world_cache_dir')
+        if cache_dir is None:
+            return None
+        world_cache = WorldArtifactCache(cache_dir)
+    return world_cache
+
+
 def get_mel_torch(
         waveform, samplerate,
         *,
@@ -84,6 +388,25 @@ def get_pitch_parselmouth(
     return f0, uv
 
 
+nuttall_windows: Dict[tuple, torch.Tensor] = {}
+
+
+def nuttall_window(win_size, device='cpu', dtype=torch.float32):
+    """
+    Get a (cached) Nuttall window, which is used to extract harmonics.
+    """
+    key = (win_size, str(device), dtype)
+    if key not in nuttall_windows:
+        phase = torch.arange(win_size, dtype=dtype, device=device) / win_size * 2 * np.pi
+        nuttall_windows[key] = (
+                0.355768
+                - 0.487396 * torch.cos(phase)
+                + 0.144232 * torch.cos(2 * phase)
+                - 0.012604 * torch.cos(3 * phase)
+        )
+    return nuttall_windows[key]
+
+
 class DecomposedWaveform:
     def __init__(
             self, waveform, samplerate, f0,  # basic parameters
@@ -103,9 +426,14 @@ class DecomposedWaveform:
         self._half_width = base_harmonic_radius
         self._device = ('cuda' if torch.cuda.is_available() else 'cpu') if device is None else device
         # intermediate variables
-        self._f0_world = None
+        self._f0_world = self._align_f0_to_waveform()
         self._sp = None
         self._ap = None
+        self._artifact_key = None
+        self._analysis_counted = False
+        # time spent on WORLD analysis and synthesis, and time saved by loading cached artifacts
+        self.world_seconds = 0.
+        self.world_saved_seconds = 0.
         # final components
         self._harmonic_part: np.ndarray = None
         self._aperiodic_part: np.ndarray = None
@@ -127,30 +455,72 @@ class DecomposedWaveform:
     def win_size(self):
         return self._win_size
 
+    def _align_f0_to_waveform(self):
+        f0 = self._f0.astype(np.double)
+        wav_frames = (self._waveform.shape[0] + self._hop_size - 1) // self._hop_size
+        f0_frames = f0.shape[0]
+        if f0_frames < wav_frames:
+            f0 = np.pad(f0, (0, wav_frames - f0_frames), mode='constant', constant_values=(f0[0], f0[-1]))
+        elif f0_frames > wav_frames:
+            f0 = f0[:wav_frames]
+        return f0
+
+    def _cached_artifact(self, name, compute_fn):
+        """
+        Load an artifact from the WORLD artifact cache, or compute (and save) it.
+        :param name: name of the artifact
+        :param compute_fn: function that returns the artifact as an array
+        """
+        cache = get_world_cache()
+        if cache is not None:
+            if self._artifact_key is None:
+                self._artifact_key = cache.key(self._waveform, self._f0, {
+                    'samplerate': self._samplerate, 'hop_size': self._hop_size, 'fft_size': self._fft_size
+                })
+            entry = cache.load(self._artifact_key, name)
+            if entry is not None:
+                array, seconds = entry
+                if name != 'sp_ap':
+                    self.world_saved_seconds += seconds
+                # loading any artifact also saves the analysis, which is only counted once
+                if not self._analysis_counted:
+                    self._analysis_counted = True
+                    self.world_saved_seconds += cache.load_seconds(self._artifact_key, 'sp_ap')
+                return array
+        world_seconds = self.world_seconds
+        start = time.perf_counter()
+        array = compute_fn()
+        # exclude the time of other artifacts computed by compute_fn
+        seconds = time.perf_counter() - start - (self.world_seconds - world_seconds)
+        self.world_seconds += seconds
+        if cache is not None:
+            cache.save(self._artifact_key, name, array, seconds)
+        return array
+
     def _world_extraction(self):
+        if self._sp is not None and self._ap is not None:
+            return
+        sp_ap = self._cached_artifact('sp_ap', self._world_analysis)
+        self._sp = sp_ap[0].astype(np.double, copy=False)
+        self._ap = sp_ap[1].astype(np.double, copy=False)
+
+    def _world_analysis(self):
         # Add a tiny noise to the signal to avoid NaN results of D4C in rare edge cases
         # References:
         #   - https://github.com/JeremyCCHsu/Python-Wrapper-for-World-Vocoder/issues/50
         #   - https://github.com/mmorise/World/issues/116
         x = self._waveform.astype(np.double) + np.random.randn(*self._waveform.shape) * 1e-5
         samplerate = self._samplerate
-        f0 = self._f0.astype(np.double)
+        f0 = self._f0_world
 
         hop_size = self._hop_size
         fft_size = self._fft_size
 
-        wav_frames = (x.shape[0] + hop_size - 1) // hop_size
-        f0_frames = f0.shape[0]
-        if f0_frames < wav_frames:
-            f0 = np.pad(f0, (0, wav_frames - f0_frames), mode='constant', constant_values=(f0[0], f0[-1]))
-        elif f0_frames > wav_frames:
-            f0 = f0[:wav_frames]
-
         time_step = hop_size / samplerate
-        t = np.arange(0, wav_frames) * time_step
-        self._f0_world = f0
-        self._sp = pw.cheaptrick(x, f0, t, samplerate, fft_size=fft_size)  # extract smoothed spectrogram
-        self._ap = pw.d4c(x, f0, t, samplerate, fft_size=fft_size)  # extract aperiodicity
+        t = np.arange(0, f0.shape[0]) * time_step
+        sp = pw.cheaptrick(x, f0, t, samplerate, fft_size=fft_size)  # extract smoothed spectrogram
+        ap = pw.d4c(x, f0, t, samplerate, fft_size=fft_size)  # extract aperiodicity
+        return np.stack([sp, ap])
 
     def _kth_harmonic(self, k: int) -> np.ndarray:
         """
@@ -158,59 +528,68 @@ class DecomposedWaveform:
         :param k: a non-negative integer
         :return: kth_harmonic float32[T]
         """
-        if k in self._harmonics:
-            return self._harmonics[k]
+        return self.harmonics([k])[0]
+
+    def harmonics(self, ks: List[int]) -> List[np.ndarray]:
+        """
+        Extract several harmonics from the waveform at once. The harmonic part is transformed
+        by one STFT, the masks of all harmonics are stacked along the batch dimension and
+        all harmonics are transformed back by one batched ISTFT.
+        :param ks: harmonic indices, starting from 0
+        :return: list of kth_harmonic float32[T], in the same order as ks
+        """
+        missing = [k for k in dict.fromkeys(ks) if k not in self._harmonics]
+        if len(missing) > 0:
+            for k, kth_harmonic in zip(missing, self._extract_harmonics(missing)):
+                self._harmonics[k] = kth_harmonic
+        return [self._harmonics[k] for k in ks]
 
+    def _extract_harmonics(self, ks: List[int]) -> np.ndarray:
         hop_size = self._hop_size
         win_size = self._win_size
         samplerate = self._samplerate
         half_width = self._half_width
         device = self._device
 
-        waveform = torch.from_numpy(self.harmonic()).unsqueeze(0).to(device)  # [B, n_samples]
+        waveform = torch.from_numpy(self.harmonic()).unsqueeze(0).to(device)  # [1, n_samples]
         n_samples = waveform.shape[1]
         pad_size = (int(n_samples // hop_size) - len(self._f0) + 1) // 2
-        f0 = self._f0[pad_size:] * (k + 1)
-        f0, _ = interp_f0(f0, uv=f0 == 0)
-        f0 = torch.from_numpy(f0).to(device)[None, :, None]  # [B, n_frames, 1]
+        f0s = []
+        for k in ks:
+            f0 = self._f0[pad_size:] * (k + 1)
+            f0, _ = interp_f0(f0, uv=f0 == 0)
+            f0s.append(f0)
+        f0 = torch.from_numpy(np.stack(f0s)).to(device)[:, :, None]  # [K, n_frames, 1]
         n_f0_frames = f0.shape[1]
 
-        phase = torch.arange(win_size, dtype=waveform.dtype, device=device) / win_size * 2 * np.pi
-        nuttall_window = (
-                0.355768
-                - 0.487396 * torch.cos(phase)
-                + 0.144232 * torch.cos(2 * phase)
-                - 0.012604 * torch.cos(3 * phase)
-        )
+        window = nuttall_window(win_size, device=device, dtype=waveform.dtype)
         spec = torch.stft(
             waveform,
             n_fft=win_size,
             win_length=win_size,
             hop_length=hop_size,
-            window=nuttall_window,
+            window=window,
             center=True,
             return_complex=True
-        ).permute(0, 2, 1)  # [B, n_frames, n_spec]
+        ).permute(0, 2, 1)  # [1, n_frames, n_spec]
         n_spec_frames, n_specs = spec.shape[1:]
         idx = torch.arange(n_specs).unsqueeze(0).unsqueeze(0).to(f0)  # [1, 1, n_spec]
         center = f0 * win_size / samplerate
         start = torch.clip(center - half_width, min=0)
         end = torch.clip(center + half_width, max=n_specs)
-        idx_mask = (center >= 1) & (idx >= start) & (idx < end)  # [B, n_frames, n_spec]
+        idx_mask = (center >= 1) & (idx >= start) & (idx < end)  # [K, n_frames, n_spec]
         if n_f0_frames < n_spec_frames:
             idx_mask = F.pad(idx_mask, [0, 0, 0, n_spec_frames - n_f0_frames])
-        spec = spec * idx_mask[:, :n_spec_frames, :]
-        self._harmonics[k] = torch.istft(
+        spec = spec * idx_mask[:, :n_spec_frames, :]  # [K, n_frames, n_spec]
+        return torch.istft(
             spec.permute(0, 2, 1),
             n_fft=win_size,
             win_length=win_size,
             hop_length=hop_size,
-            window=nuttall_window,
+            window=window,
             center=True,
             length=n_samples
-        ).squeeze(0).cpu().numpy()
-
-        return self._harmonics[k]
+        ).cpu().numpy()
 
     def harmonic(self, k: int = None) -> np.ndarray:
         """
@@ -222,15 +601,17 @@ class DecomposedWaveform:
             return self._kth_harmonic(k)
         if self._harmonic_part is not None:
             return self._harmonic_part
-        if self._sp is None or self._ap is None:
-            self._world_extraction()
-        self._harmonic_part = pw.synthesize(
+        self._harmonic_part = self._cached_artifact('harmonic', self._synthesize_harmonic)
+        return self._harmonic_part
+
+    def _synthesize_harmonic(self):
+        self._world_extraction()
+        return pw.synthesize(
             self._f0_world,
             np.clip(self._sp * (1 - self._ap * self._ap), a_min=1e-16, a_max=None),  # clip to avoid zeros
             np.zeros_like(self._ap),
             self._samplerate, frame_period=self._time_step * 1000
         ).astype(np.float32)  # synthesize the harmonic part using the parameters
-        return self._harmonic_part
 
     def aperiodic(self) -> np.ndarray:
         """
@@ -239,13 +620,15 @@ class DecomposedWaveform:
         """
         if self._aperiodic_part is not None:
             return self._aperiodic_part
-        if self._sp is None or self._ap is None:
-            self._world_extraction()
-        self._aperiodic_part = pw.synthesize(
+        self._aperiodic_part = self._cached_artifact('aperiodic', self._synthesize_aperiodic)
+        return self._aperiodic_part
+
+    def _synthesize_aperiodic(self):
+        self._world_extraction()
+        return pw.synthesize(
             self._f0_world, self._sp * self._ap * self._ap, np.ones_like(self._ap),
             self._samplerate, frame_period=self._time_step * 1000
         ).astype(np.float32)  # synthesize the aperiodic part using the parameters
-        return self._aperiodic_part
 
 
 def get_energy_librosa(waveform, length, *, hop_size, win_size, domain='db'):
@@ -393,3 +776,7 @@ class SinusoidalSmoothingConv1d(torch.nn.Conv1d):
         ))
         smooth_kernel /= smooth_kernel.sum()
         self.weight.data = smooth_kernel[None, None]
+
+    def forward(self, input):
+        with timed_stage('smoothing'):
+            return super().forward(input)
@@ -1,21 +1,85 @@
+import atexit
+import hashlib
+import os
 import pathlib
+import pickle
 import multiprocessing
-from collections import deque
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
 
 import h5py
 import torch
 import numpy as np
 
 
+class ItemCache:
+    """
+    LRU cache of dataset items keyed by index, with O(1) lookups and updates.
+    :param max_items: maximum number of cached items, 0 means unlimited
+    :param max_bytes: maximum total bytes of tensors in the cached items, 0 means unlimited
+    The cache is disabled if both limits are 0.
+    """
+    def __init__(self, max_items=0, max_bytes=0):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_items > 0 or self.max_bytes > 0
+
+    @staticmethod
+    def item_nbytes(item):
+        return sum(v.element_size() * v.nelement() for v in item.values() if isinstance(v, torch.Tensor))
+
+    def get(self, i):
+        entry = self.items.get(i)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items.move_to_end(i)
+        return entry[0]
+
+    def put(self, i, item):
+        nbytes = self.item_nbytes(item)
+        if 0 < self.max_bytes < nbytes:
+            return
+        if i in self.items:
+            self.nbytes -= self.items.pop(i)[1]
+        self.items[i] = (item, nbytes)
+        self.nbytes += nbytes
+        while (
+                0 < self.max_items < len(self.items)
+                or 0 < self.max_bytes < self.nbytes
+        ):
+            _, (_, evicted_nbytes) = self.items.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+
+    def info(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total > 0 else 0.,
+            'items': len(self.items),
+            'bytes': self.nbytes,
+        }
+
+
 class IndexedDataset:
-    def __init__(self, path, prefix, num_cache=0):
+    def __init__(self, path, prefix, num_cache=0, cache_bytes=0):
         super().__init__()
         self.path = pathlib.Path(path) / f'{prefix}.data'
         if not self.path.exists():
             raise FileNotFoundError(f'IndexedDataset not found: {self.path}')
         self.dset = None
-        self.cache = deque(maxlen=num_cache)
-        self.num_cache = num_cache
+        self.cache = ItemCache(max_items=num_cache, max_bytes=cache_bytes)
 
     def check_index(self, i):
         if i < 0 or i >= len(self.dset):
@@ -29,26 +93,249 @@ class IndexedDataset:
         if self.dset is None:
             self.dset = h5py.File(self.path, 'r')
         self.check_index(i)
-        if self.num_cache > 0:
-            for c in self.cache:
-                if c[0] == i:
-                    return c[1]
+        if self.cache.enabled:
+            item = self.cache.get(i)
+            if item is not None:
+                return item
         item = {k: v[()].item() if v.shape == () else torch.from_numpy(v[()]) for k, v in self.dset[str(i)].items()}
-        if self.num_cache > 0:
-            self.cache.appendleft((i, item))
+        if self.cache.enabled:
+            self.cache.put(i, item)
         return item
 
+    def cache_info(self):
+        return self.cache.info()
+
     def __len__(self):
         if self.dset is None:
             self.dset = h5py.File(self.path, 'r')
         return len(self.dset)
 
 
+class MemmapIndexedDataset:
+    """
+    Reader of the contiguous binary format. All arrays are packed into {prefix}.bin,
+    and {prefix}.idx stores the byte offset, shape and dtype of each array.
+    Items are zero-copy views of the memory-mapped file (mapped in copy-on-write mode).
+    """
+    def __init__(self, path, prefix, num_cache=0, cache_bytes=0):
+        super().__init__()
+        self.path = pathlib.Path(path) / f'{prefix}.bin'
+        self.index_path = pathlib.Path(path) / f'{prefix}.idx'
+        if not self.path.exists() or not self.index_path.exists():
+            raise FileNotFoundError(f'MemmapIndexedDataset not found: {self.path}')
+        with open(self.index_path, 'rb') as f:
+            self.index = pickle.load(f)
+        self.data = None
+        self.cache = ItemCache(max_items=num_cache, max_bytes=cache_bytes)
+
+    def __getstate__(self):
+        # do not pickle the mapped file; it is mapped again lazily in the new process
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def check_index(self, i):
+        if i < 0 or i >= len(self.index):
+            raise IndexError('index out of range')
+
+    def _open(self):
+        if self.path.stat().st_size == 0:
+            self.data = np.empty(0, dtype=np.uint8)
+        else:
+            self.data = np.memmap(self.path, dtype=np.uint8, mode='c')
+
+    def __getitem__(self, i):
+        if self.data is None:
+            self._open()
+        self.check_index(i)
+        if self.cache.enabled:
+            item = self.cache.get(i)
+            if item is not None:
+                return item
+        item = {}
+        for k, v in self.index[i].items():
+            if isinstance(v, tuple):
+                offset, shape, dtype = v
+                item[k] = torch.from_numpy(np.ndarray(shape, dtype=dtype, buffer=self.data, offset=offset))
+            else:
+                item[k] = v
+        if self.cache.enabled:
+            self.cache.put(i, item)
+        return item
+
+    def cache_info(self):
+        return self.cache.info()
+
+    def __len__(self):
+        return len(self.index)
+
+
+class SharedPreloadedDataset:
+    """
+    Preloads a whole indexed dataset into one contiguous array per attribute plus an offset table.
+    The arrays are written once into shared memory (/dev/shm if available) by the first process
+    that arrives, and all other DataLoader workers and DDP ranks on the same machine memory-map
+    the same files, so only one copy of the dataset is kept in physical memory.
+    """
+    def __init__(self, source, prefix, shm_dir=None):
+        super().__init__()
+        if shm_dir is None:
+            shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        source_stat = source.path.stat()
+        key = hashlib.sha1(
+            repr((str(source.path.resolve()), source_stat.st_mtime_ns, source_stat.st_size)).encode('utf-8')
+        ).hexdigest()[:16]
+        self.path = pathlib.Path(shm_dir) / f'diffsinger_{prefix}_{key}'
+        self._build_or_wait(source)
+        with open(self.path / 'index.pkl', 'rb') as f:
+            index = pickle.load(f)
+        self.length = index['length']
+        self.arrays = index['arrays']  # key: attribute name, value: (dtype, trailing_shape, offsets)
+        self.scalars = index['scalars']  # key: attribute name, value: list of values
+        self.data = None
+
+    def __getstate__(self):
+        # do not pickle the mapped files; they are mapped again lazily in the new process
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def _owner_is_dead(self):
+        owner_path = self.path / 'owner'
+        if os.name != 'posix' or not owner_path.exists():
+            return False
+        try:
+            os.kill(int(owner_path.read_text()), 0)
+        except (ValueError, ProcessLookupError):
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def _build_or_wait(self, source):
+        while True:
+            if (self.path / 'ready').exists():
+                if self._owner_is_dead():
+                    # left over by a previous run; take over the ownership so that it is removed at exit
+                    (self.path / 'owner').write_text(str(os.getpid()))
+                    atexit.register(shutil.rmtree, self.path, True)
+                return
+            try:
+                self.path.mkdir(parents=True)
+            except FileExistsError:
+                # another process is building the arrays
+                if self._owner_is_dead():
+                    # the owner died before finishing; clean up and try again
+                    shutil.rmtree(self.path, ignore_errors=True)
+                else:
+                    time.sleep(0.5)
+                continue
+            (self.path / 'owner').write_text(str(os.getpid()))
+            try:
+                self._build(source)
+            except BaseException:
+                shutil.rmtree(self.path, ignore_errors=True)
+                raise
+            atexit.register(shutil.rmtree, self.path, True)
+            (self.path / 'ready').touch()
+            return
+
+    def _build(self, source):
+        length = len(source)
+        files = {}
+        arrays = {}
+        scalars = {}
+        keys = None
+        try:
+            for i in range(length):
+                item = source[i]
+                if keys is None:
+                    keys = set(item.keys())
+                elif set(item.keys()) != keys:
+                    raise ValueError(
+                        f'Item {i} has different attributes from previous items, '
+                        f'which is not supported by shared preloading.'
+                    )
+                for k, v in item.items():
+                    if not isinstance(v, torch.Tensor):
+                        scalars.setdefault(k, []).append(v)
+                        continue
+                    v = v.numpy()
+                    if k not in arrays:
+                        files[k] = open(self.path / f'{k}.bin', 'wb')
+                        arrays[k] = (v.dtype.str, v.shape[1:], [0])
+                    dtype, trailing_shape, offsets = arrays[k]
+                    if v.dtype.str != dtype or v.shape[1:] != trailing_shape:
+                        raise ValueError(
+                            f'Attribute \'{k}\' of item {i} has inconsistent dtype or shape, '
+                            f'which is not supported by shared preloading.'
+                        )
+                    files[k].write(np.ascontiguousarray(v).tobytes())
+                    offsets.append(offsets[-1] + v.shape[0])
+        finally:
+            for f in files.values():
+                f.close()
+        with open(self.path / 'index.pkl', 'wb') as f:
+            # noinspection PyTypeChecker
+            pickle.dump({
+                'length': length,
+                'arrays': {
+                    k: (dtype, trailing_shape, np.array(offsets, dtype=np.int64))
+                    for k, (dtype, trailing_shape, offsets) in arrays.items()
+                },
+                'scalars': scalars,
+            }, f)
+
+    def _open(self):
+        self.data = {}
+        for k, (dtype, trailing_shape, offsets) in self.arrays.items():
+            if offsets[-1] * int(np.prod(trailing_shape)) == 0:
+                self.data[k] = np.empty((0, *trailing_shape), dtype=dtype)
+            else:
+                self.data[k] = np.memmap(
+                    self.path / f'{k}.bin', dtype=dtype, mode='c', shape=(int(offsets[-1]), *trailing_shape)
+                )
+
+    def __getitem__(self, i):
+        if self.data is None:
+            self._open()
+        if i < 0 or i >= self.length:
+            raise IndexError('index out of range')
+        item = {
+            k: torch.from_numpy(self.data[k][offsets[i]: offsets[i + 1]])
+            for k, (_, _, offsets) in self.arrays.items()
+        }
+        for k, values in self.scalars.items():
+            item[k] = values[i]
+        return item
+
+    def __len__(self):
+        return self.length
+
+
 class IndexedDatasetBuilder:
-    def __init__(self, path, prefix, allowed_attr=None, auto_increment=True):
-        self.path = pathlib.Path(path) / f'{prefix}.data'
+    """
+    Builder of binarized datasets.
+    :param data_format: 'hdf5' for the HDF5 format read by IndexedDataset,
+        or 'memmap' for the contiguous binary format read by MemmapIndexedDataset
+    """
+    MEMMAP_ALIGNMENT = 64
+
+    def __init__(self, path, prefix, allowed_attr=None, auto_increment=True, data_format='hdf5'):
+        self.data_format = data_format
         self.prefix = prefix
-        self.dset = h5py.File(self.path, 'w')
+        if data_format == 'hdf5':
+            self.path = pathlib.Path(path) / f'{prefix}.data'
+            self.dset = h5py.File(self.path, 'w')
+            self.stale_paths = [pathlib.Path(path) / f'{prefix}.bin', pathlib.Path(path) / f'{prefix}.idx']
+        elif data_format == 'memmap':
+            self.path = pathlib.Path(path) / f'{prefix}.bin'
+            self.index_path = pathlib.Path(path) / f'{prefix}.idx'
+            self.dset = open(self.path, 'wb')
+            self.index = {}
+            self.stale_paths = [pathlib.Path(path) / f'{prefix}.data']
+        else:
+            raise ValueError(f'Unknown data format: {data_format}')
         self.counter = 0
         self.auto_increment = auto_increment
         if allowed_attr is not None:
@@ -68,14 +355,47 @@ class IndexedDatasetBuilder:
         if self.auto_increment:
             item_no = self.counter
             self.counter += 1
+        if self.data_format == 'memmap':
+            self._add_item_memmap(item, item_no)
+            return item_no
         for k, v in item.items():
             if v is None:
                 continue
             self.dset.create_dataset(f'{item_no}/{k}', data=v)
         return item_no
 
+    def _add_item_memmap(self, item, item_no):
+        if item_no in self.index:
+            raise ValueError(f'Item {item_no} already exists.')
+        entry = {}
+        for k, v in item.items():
+            if v is None:
+                continue
+            v = np.asarray(v)
+            if v.ndim == 0:
+                entry[k] = v.item()
+                continue
+            v = np.ascontiguousarray(v)
+            offset = self.dset.tell()
+            padding = -offset % self.MEMMAP_ALIGNMENT
+            if padding > 0:
+                self.dset.write(bytes(padding))
+                offset += padding
+            self.dset.write(v.data)
+            entry[k] = (offset, v.shape, v.dtype.str)
+        self.index[item_no] = entry
+
     def finalize(self):
         self.dset.close()
+        if self.data_format == 'memmap':
+            assert set(self.index) == set(range(len(self.index))), 'Item numbering is not consecutive.'
+            with open(self.index_path, 'wb') as f:
+                # noinspection PyTypeChecker
+                pickle.dump([self.index[i] for i in range(len(self.index))], f)
+        # remove files of the other format so that readers will not load outdated data
+        for stale_path in self.stale_paths:
+            if stale_path.exists():
+                stale_path.unlink()
 
 
 if __name__ == "__main__":
@@ -94,3 +414,12 @@ if __name__ == "__main__":
     for i in tqdm(range(10000)):
         idx = random.randint(0, size - 1)
         assert (ds[idx]['a'] == items[idx]['a']).all()
+
+    builder = IndexedDatasetBuilder(ds_path, 'example_memmap', data_format='memmap')
+    for i in tqdm(range(size)):
+        builder.add_item(items[i])
+    builder.finalize()
+    ds = MemmapIndexedDataset(ds_path, 'example_memmap')
+    for i in tqdm(range(10000)):
+        idx = random.randint(0, size - 1)
+        assert (ds[idx]['a'] == items[idx]['a']).all()
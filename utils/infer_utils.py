@@ -1,4 +1,7 @@
+import pathlib
 import re
+import wave
+from contextlib import contextmanager
 
 import librosa
 import numpy as np
@@ -96,6 +99,110 @@ def cross_fade(a: np.ndarray, b: np.ndarray, idx: int):
     return result
 
 
+class WaveformAssembler:
+    """
+    Assemble segment waveforms into a song in linear time. Each segment is placed at its
+    offset after a gap of silence, or cross-faded into the previous audio when they overlap,
+    giving the same result as successive cross_fade() calls.
+    If a path is given, audio before the start of the latest segment is final and is streamed
+    to a 16-bit WAV file, so memory stays bounded by the longest segment instead of the song.
+    Streaming requires segments to be added in the order of their offsets.
+    """
+
+    def __init__(self, sample_rate: int, path=None, capacity: int = 0):
+        self.sample_rate = sample_rate
+        self.buffer = np.zeros(capacity, dtype=np.float32)
+        self.length = 0  # end of the assembled audio, in samples
+        self.flushed = 0  # samples already written to the file, i.e. the position of buffer[0]
+        self.writer = None
+        if path is not None:
+            self.writer = wave.open(str(path), 'wb')
+            self.writer.setnchannels(1)
+            self.writer.setsampwidth(2)
+            self.writer.setframerate(sample_rate)
+
+    def _reserve(self, size):
+        if size > self.buffer.shape[0]:
+            buffer = np.zeros(max(size, 2 * self.buffer.shape[0]), dtype=np.float32)
+            buffer[:self.length - self.flushed] = self.buffer[:self.length - self.flushed]
+            self.buffer = buffer
+
+    def _flush(self, end):
+        n = end - self.flushed
+        if n <= 0:
+            return
+        self.writer.writeframes((self.buffer[:n] * 32767).astype('<i2').tobytes())
+        remaining = self.length - end
+        self.buffer[:remaining] = self.buffer[n: n + remaining]
+        self.flushed = end
+
+    def add(self, offset: float, waveform: np.ndarray):
+        """
+        :param offset: start time of the segment in seconds
+        :param waveform: audio samples of the segment
+        """
+        start = round(offset * self.sample_rate)
+        if start < self.flushed:
+            raise ValueError(
+                f'Segment at offset {offset} starts before audio that has already been written. '
+                f'Segments must be added in the order of their offsets.'
+            )
+        end = start + waveform.shape[0]
+        self._reserve(max(end, self.length) - self.flushed)
+        base = self.flushed
+        if start >= self.length:
+            self.buffer[self.length - base: start - base] = 0.
+            self.buffer[start - base: end - base] = waveform
+        else:
+            fade_len = self.length - start
+            overlap = min(fade_len, waveform.shape[0])
+            k = np.linspace(0, 1.0, num=fade_len, endpoint=True, dtype=np.float32)[:overlap]
+            faded = self.buffer[start - base: start - base + overlap]
+            faded *= 1 - k
+            faded += k * waveform[:overlap]
+            self.buffer[start - base + overlap: end - base] = waveform[overlap:]
+        self.length = end
+        if self.writer is not None:
+            self._flush(start)
+
+    def finish(self):
+        """
+        :return: the assembled waveform, or None if it has been streamed to a file
+        """
+        if self.writer is None:
+            return self.buffer[:self.length]
+        self._flush(self.length)
+        self.writer.close()
+        self.writer = None
+        return None
+
+
+@contextmanager
+def profile_inference(dirpath: pathlib.Path, name: str, row_limit=30):
+    """
+    Profile the inference inside the context. The trace (Chrome trace format, readable by the PyTorch profiler
+    plugin of TensorBoard) and a table of the top *row_limit* operators are saved to *dirpath*.
+    """
+    import torch
+    from torch.profiler import profile, ProfilerActivity, tensorboard_trace_handler
+
+    dirpath.mkdir(parents=True, exist_ok=True)
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    with profile(
+            activities=activities, record_shapes=True, profile_memory=True,
+            on_trace_ready=tensorboard_trace_handler(str(dirpath), worker_name=name)
+    ) as prof:
+        yield prof
+    sort_by = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+    table = prof.key_averages().table(sort_by=sort_by, row_limit=row_limit)
+    print(table)
+    with open(dirpath / f'{name}.txt', 'w', encoding='utf8') as f:
+        f.write(table)
+    print(f'| save profiling results to \'{dirpath}\'')
+
+
 def save_wav(wav, path, sr, norm=False):
     if norm:
         wav = wav / np.abs(wav).max()
@@ -1,8 +1,13 @@
+import os
 import platform
+import queue
 import re
+import shutil
+import tempfile
 import traceback
 
-from torch.multiprocessing import Manager, Process, current_process, get_context
+import numpy as np
+from torch.multiprocessing import current_process, get_context
 
 is_main_process = not bool(re.match(r'((.*Process)|(SyncManager)|(.*PoolWorker))-\d+', current_process().name))
 
@@ -12,41 +17,238 @@ def main_process_print(self, *args, sep=' ', end='\n', file=None):
         print(self, *args, sep=sep, end=end, file=file)
 
 
-def chunked_worker_run(map_func, args, results_queue=None):
-    for a in args:
+class SharedArray:
+    """
+    Placeholder of an array stored in the file of a SharedResult.
+    """
+    def __init__(self, offset, shape, dtype):
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+
+
+class SharedResult:
+    """
+    Result of a worker whose arrays are written into one file in shared memory (/dev/shm),
+    so that only this small object is pickled and sent to the main process.
+    """
+    ALIGNMENT = 64
+
+    def __init__(self, path, obj):
+        self.path = path
+        self.obj = obj
+
+    @classmethod
+    def share(cls, obj, path):
+        """
+        Move all arrays in obj (nested in dicts, lists and tuples) into a new file.
+        :return: a SharedResult, or obj itself if it contains no arrays to share
+        """
+        arrays = []
+        size = 0
+
+        def replace(x):
+            nonlocal size
+            if isinstance(x, dict):
+                return {k: replace(v) for k, v in x.items()}
+            if isinstance(x, (list, tuple)):
+                return type(x)(replace(v) for v in x)
+            if isinstance(x, np.ndarray) and x.ndim > 0 and x.nbytes > 0 and not x.dtype.hasobject:
+                arrays.append(x)
+                ref = SharedArray(size, x.shape, x.dtype)
+                size += x.nbytes + -x.nbytes % cls.ALIGNMENT
+                return ref
+            return x
+
+        obj = replace(obj)
+        if len(arrays) == 0:
+            return obj
+        try:
+            with open(path, 'wb') as f:
+                for a in arrays:
+                    f.write(np.ascontiguousarray(a).data)
+                    padding = -a.nbytes % cls.ALIGNMENT
+                    if padding > 0:
+                        f.write(bytes(padding))
+        except BaseException:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        return cls(path, obj)
+
+    def load(self):
+        """
+        Map the file into memory and remove it, so that it is freed as soon as the arrays are released.
+        :return: the original object, whose arrays are copy-on-write views of the mapped file
+        """
+        buffer = np.memmap(self.path, dtype=np.uint8, mode='c')
+        os.remove(self.path)
+
+        def restore(x):
+            if isinstance(x, dict):
+                return {k: restore(v) for k, v in x.items()}
+            if isinstance(x, (list, tuple)):
+                return type(x)(restore(v) for v in x)
+            if isinstance(x, SharedArray):
+                nbytes = int(np.prod(x.shape)) * x.dtype.itemsize
+                return buffer[x.offset: x.offset + nbytes].view(x.dtype).reshape(x.shape)
+            return x
+
+        return restore(self.obj)
+
+
+class WorkerError:
+    """
+    Sent by a worker that stops before finishing its tasks (its init_func raised or it was interrupted),
+    so that the main process fails with the cause instead of waiting for results.
+    """
+    def __init__(self, message, interrupted=False):
+        self.message = message
+        self.interrupted = interrupted
+
+
+def chunked_worker_run(map_func, task_queue, results_queue, init_func=None, shm_dir=None):
+    if init_func is not None:
+        # noinspection PyBroadException
+        try:
+            init_func()
+        except Exception:
+            traceback.print_exc()
+            results_queue.put((None, WorkerError(f'Failed to initialize a worker process:\n{traceback.format_exc()}')))
+            return
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        idx, a = task
         # noinspection PyBroadException
         try:
             res = map_func(*a)
-            results_queue.put(res)
         except KeyboardInterrupt:
+            results_queue.put((idx, WorkerError(f'Worker process {os.getpid()} was interrupted.', interrupted=True)))
             break
         except Exception:
             traceback.print_exc()
-            results_queue.put(None)
+            res = None
+        if shm_dir is not None and res is not None:
+            try:
+                res = SharedResult.share(res, os.path.join(shm_dir, f'{os.getpid()}_{idx}.bin'))
+            except OSError:
+                # e.g. the shared memory is full; fall back to sending the arrays through the queue
+                traceback.print_exc()
+        results_queue.put((idx, res))
 
 
-def chunked_multiprocess_run(map_func, args, num_workers, q_max_size=1000):
+def chunked_multiprocess_run(
+        map_func, args, num_workers, q_max_size=1000, task_order=None, init_func=None, shared_memory=False
+):
+    """
+    Run map_func on each element of args with a pool of worker processes. Tasks are dispatched
+    through a shared queue, so that a worker takes the next task as soon as it becomes idle.
+    :param map_func: function to run
+    :param args: list of argument lists of map_func
+    :param num_workers: number of worker processes
+    :param q_max_size: maximum number of tasks dispatched but not yet yielded
+    :param task_order: order in which the tasks are dispatched, e.g. longest first; defaults to the order of args
+    :param init_func: function to run once in each worker before its first task, e.g. to load models
+    :param shared_memory: pass the arrays in the results through files in shared memory instead of
+        pickling them through the queue (POSIX only), see SharedResult
+    :return: generator of (index in args, result) in the order of completion
+    """
     num_jobs = len(args)
     if num_jobs < num_workers:
         num_workers = num_jobs
+    task_order = iter(range(num_jobs) if task_order is None else task_order)
 
-    queues = [Manager().Queue(maxsize=q_max_size // num_workers) for _ in range(num_workers)]
     if platform.system().lower() != 'windows':
-        process_creation_func = get_context('spawn').Process
+        ctx = get_context('spawn')
     else:
-        process_creation_func = Process
+        ctx = get_context()
+    task_queue = ctx.Queue()
+    results_queue = ctx.Queue()
+    if shared_memory and os.name == 'posix':
+        # removed at the end, together with any result that is not consumed
+        shm_dir = tempfile.mkdtemp(
+            prefix='diffsinger_mp_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None
+        )
+    else:
+        shm_dir = None
 
     workers = []
     for i in range(num_workers):
-        worker = process_creation_func(
-            target=chunked_worker_run, args=(map_func, args[i::num_workers], queues[i]), daemon=True
+        worker = ctx.Process(
+            target=chunked_worker_run, args=(map_func, task_queue, results_queue, init_func, shm_dir), daemon=True
         )
         workers.append(worker)
         worker.start()
 
-    for i in range(num_jobs):
-        yield queues[i % num_workers].get()
+    num_dispatched = 0
+
+    def dispatch():
+        nonlocal num_dispatched
+        if num_dispatched < num_jobs:
+            idx = next(task_order)
+            task_queue.put((idx, args[idx]))
+        elif num_dispatched == num_jobs:
+            for _ in range(num_workers):
+                task_queue.put(None)  # no more tasks; stop the workers
+        else:
+            return
+        num_dispatched += 1
+
+    def get_result():
+        while True:
+            try:
+                idx_, res_ = results_queue.get(timeout=5)
+            except queue.Empty:
+                # a worker may die without reporting anything, e.g. killed by the OS
+                if any(w.exitcode not in (None, 0) for w in workers) or all(not w.is_alive() for w in workers):
+                    raise RuntimeError(
+                        'Worker processes exited unexpectedly: exit codes '
+                        f'{[w.exitcode for w in workers]}.'
+                    )
+                continue
+            if isinstance(res_, WorkerError):
+                if res_.interrupted:
+                    raise KeyboardInterrupt(res_.message)
+                raise RuntimeError(res_.message)
+            return idx_, res_
+
+    try:
+        for _ in range(min(q_max_size, num_jobs + 1)):
+            dispatch()
+        for _ in range(num_jobs):
+            idx, res = get_result()
+            if isinstance(res, SharedResult):
+                res = res.load()
+            dispatch()
+            yield idx, res
+
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+            worker.close()
+        if shm_dir is not None:
+            shutil.rmtree(shm_dir, ignore_errors=True)
+
 
-    for worker in workers:
-        worker.join()
-        worker.close()
+def ordered_results(results, order):
+    """
+    Re-order (index, result) pairs yielded in the order of completion into the given order,
+    buffering only the results that arrive early.
+    :param results: iterable of (index, result)
+    :param order: the expected order of the indices
+    :return: generator of results
+    """
+    rank = {idx: r for r, idx in enumerate(order)}
+    pending = {}
+    next_rank = 0
+    for idx, res in results:
+        pending[rank[idx]] = res
+        while next_rank in pending:
+            yield pending.pop(next_rank)
+            next_rank += 1
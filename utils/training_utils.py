@@ -1,6 +1,6 @@
 import math
 import re
-from copy import deepcopy
+import time
 from pathlib import Path
 from typing import Dict
 
@@ -76,10 +76,13 @@ class DsBatchSampler(Sampler):
                  num_replicas=None, rank=None,
                  required_batch_count_multiple=1, batch_by_size=True, sort_by_similar_size=True,
                  size_reversed=False, shuffle_sample=False, shuffle_batch=False,
-                 disallow_empty_batch=True, pad_batch_assignment=True, seed=0, drop_last=False) -> None:
+                 disallow_empty_batch=True, pad_batch_assignment=True, seed=0, drop_last=False,
+                 min_padding_efficiency=0., rank_assignment='ordered', packing_frames=0) -> None:
         if rank >= num_replicas or rank < 0:
             raise ValueError(
                 f"Invalid rank {rank}, rank should be in the interval [0, {num_replicas - 1}]")
+        if rank_assignment not in ('ordered', 'balanced'):
+            raise ValueError(f"Invalid rank assignment mode: {rank_assignment}")
         self.dataset = dataset
         self.max_batch_frames = max_batch_frames
         self.max_batch_size = max_batch_size
@@ -96,14 +99,23 @@ class DsBatchSampler(Sampler):
         self.pad_batch_assignment = pad_batch_assignment
         self.seed = seed
         self.drop_last = drop_last
+        self.min_padding_efficiency = min_padding_efficiency
+        self.rank_assignment = rank_assignment
+        self.packing_frames = packing_frames
         self.epoch = 0
+        self.sizes = np.array(dataset.sizes, dtype=np.int64)
         self.batches = None
         self.formed = None
+        # statistics of the batches of the current epoch
+        self.padding_ratio = None  # padded frames / all frames in the batches of this rank
+        self.frame_imbalance = None  # max / mean of the frames assigned to each rank
+        self.step_frame_imbalance = None  # average of max / mean of the frames of each rank in each step
 
     def __form_batches(self):
-        if self.formed == self.epoch + self.seed:
+        if self.formed == (self.seed, self.epoch):
             return
-        rng = np.random.default_rng()
+        # all ranks must form the same batches, so the generator is seeded
+        rng = np.random.default_rng((self.seed, self.epoch))
         # Create indices
         if self.shuffle_sample:
             if self.sub_indices is not None:
@@ -115,54 +127,107 @@ class DsBatchSampler(Sampler):
             if self.sort_by_similar_size:
                 grid = int(hparams['sampler_frame_count_grid'])
                 assert grid > 0
-                sizes = (np.round(np.array(self.dataset.sizes)[indices] / grid) * grid).clip(grid, None)
+                sizes = (np.round(self.sizes[indices] / grid) * grid).clip(grid, None)
                 sizes *= (-1 if self.size_reversed else 1)
                 indices = indices[np.argsort(sizes, kind='mergesort')]
-
-            indices = indices.tolist()
         else:
-            indices = self.sub_indices if self.sub_indices is not None else list(range(len(self.dataset)))
+            indices = np.array(self.sub_indices if self.sub_indices is not None else range(len(self.dataset)))
+        indices = indices.astype(np.int64)
 
         # Batching
-        if self.batch_by_size:
-            batches = utils.batch_by_size(
-                indices, self.dataset.num_frames,
+        sizes = self.sizes[indices]
+        rows = None
+        if self.batch_by_size and self.packing_frames > 0 and len(indices) > 0:
+            # Pack the items into rows of at most packing_frames frames, and batch the rows by size.
+            # Each row is yielded as a tuple of indices, so that the collater gets exactly these rows.
+            descending = np.argsort(-sizes, kind='stable')
+            order, row_bounds = utils.pack_by_size(sizes[descending], self.packing_frames)
+            indices = indices[descending][order]
+            sizes = sizes[descending][order]
+            row_sizes = np.add.reduceat(sizes, row_bounds[:-1])
+            row_batch_bounds = utils.batch_by_size_vectorized(
+                row_sizes,
+                max_batch_frames=self.max_batch_frames,
+                max_batch_size=self.max_batch_size,
+                min_padding_efficiency=self.min_padding_efficiency
+            )
+            bounds = row_bounds[row_batch_bounds]
+            padded_frames = np.maximum.reduceat(row_sizes, row_batch_bounds[:-1]) * np.diff(row_batch_bounds)
+            rows = [tuple(row.tolist()) for row in np.split(indices, row_bounds[1:-1])]
+            batches = [rows[start: end] for start, end in zip(row_batch_bounds[:-1], row_batch_bounds[1:])]
+        elif self.batch_by_size:
+            bounds = utils.batch_by_size_vectorized(
+                sizes,
                 max_batch_frames=self.max_batch_frames,
-                max_batch_size=self.max_batch_size
+                max_batch_size=self.max_batch_size,
+                min_padding_efficiency=self.min_padding_efficiency
             )
+            padded_frames = np.maximum.reduceat(sizes, bounds[:-1]) * np.diff(bounds)
         else:
-            batches = [indices[i:i + self.max_batch_size] for i in range(0, len(indices), self.max_batch_size)]
+            bounds = np.append(np.arange(0, len(indices), self.max_batch_size), len(indices))
+            padded_frames = np.maximum.reduceat(sizes, bounds[:-1]) * np.diff(bounds)
+        if rows is None:
+            batches = [batch.tolist() for batch in np.split(indices, bounds[1:-1])] if len(indices) > 0 else []
+        # real frames and frames after padding of each batch
+        real_frames = np.add.reduceat(sizes, bounds[:-1])
         if len(batches) < self.num_replicas and self.disallow_empty_batch:
             raise RuntimeError("There is not enough batch to assign to each node.")
 
+        # Order of the batches to be grouped into steps of num_replicas batches.
+        if self.rank_assignment == 'balanced':
+            # batches with similar numbers of frames run in the same step, so that no rank waits for the others
+            order = np.argsort(-padded_frames, kind='stable')
+        else:
+            order = np.arange(len(batches))
+
         # Either drop_last or separate the leftovers.
         floored_total_batch_count = (len(batches) // self.num_replicas) * self.num_replicas
         if self.drop_last and len(batches) > floored_total_batch_count:
-            batches = batches[:floored_total_batch_count]
             leftovers = []
-            if len(batches) == 0:
+            if floored_total_batch_count == 0:
                 raise RuntimeError("There is no batch left after dropping the last batch.")
         elif self.shuffle_batch:
-            leftovers = (rng.permutation(len(batches) - floored_total_batch_count) + floored_total_batch_count).tolist()
+            leftovers = order[floored_total_batch_count:][
+                rng.permutation(len(batches) - floored_total_batch_count)
+            ].tolist()
         else:
-            leftovers = list(range(floored_total_batch_count, len(batches)))
+            leftovers = order[floored_total_batch_count:].tolist()
 
         # Initial batch assignment to current rank.
-        batch_assignment = np.arange(floored_total_batch_count).reshape(-1, self.num_replicas).transpose()
+        # Each row holds the batches of one step. They are dealt to the ranks so that the rank with the
+        # fewest frames so far gets the largest batch, which balances the number of frames (not only the
+        # number of batches) each rank processes in an epoch.
+        batch_assignment = order[:floored_total_batch_count].reshape(-1, self.num_replicas)
         if self.shuffle_batch:
-            batch_assignment = rng.permuted(batch_assignment, axis=0)[self.rank].tolist()
+            batch_assignment = rng.permuted(batch_assignment, axis=1)
+        rank_frames = np.zeros(self.num_replicas, dtype=np.int64)
+        for row in batch_assignment:
+            if self.num_replicas > 1:
+                row[np.argsort(rank_frames, kind='stable')] = row[np.argsort(-padded_frames[row], kind='stable')]
+            rank_frames += padded_frames[row]
+        if len(batch_assignment) > 0:
+            step_frames = padded_frames[batch_assignment]
+            self.step_frame_imbalance = (step_frames.max(axis=1) / step_frames.mean(axis=1).clip(1, None)).mean()
         else:
-            batch_assignment = batch_assignment[self.rank].tolist()
+            self.step_frame_imbalance = 1.
+        batch_assignment = batch_assignment[:, self.rank].tolist()
 
-        # Assign leftovers or pad the batch assignment.
+        # Assign leftovers (to the ranks with the fewest frames) or pad the batch assignment.
         floored_batch_count = len(batch_assignment)
-        if self.rank < len(leftovers):
-            batch_assignment.append(leftovers[self.rank])
+        rank_order = np.argsort(rank_frames, kind='stable')
+        rank_frames[rank_order[:len(leftovers)]] += padded_frames[leftovers]
+        rank_position = int(np.flatnonzero(rank_order == self.rank)[0])
+        if rank_position < len(leftovers):
+            batch_assignment.append(leftovers[rank_position])
             floored_batch_count += 1
         elif len(leftovers) > 0 and self.pad_batch_assignment:
             if not batch_assignment:
                 raise RuntimeError("Cannot pad empty batch assignment.")
-            batch_assignment.append(batch_assignment[self.epoch % floored_batch_count])
+            if self.rank_assignment == 'balanced':
+                # the leftovers are the smallest batches, so the smallest batch of this rank is the closest
+                batch_assignment.append(batch_assignment[-1])
+            else:
+                batch_assignment.append(batch_assignment[self.epoch % floored_batch_count])
         # Ensure the batch count is multiple of required_batch_count_multiple.
         if self.required_batch_count_multiple > 1 and len(batch_assignment) % self.required_batch_count_multiple != 0:
             ceiled_batch_count = math.ceil(
@@ -173,10 +238,13 @@ class DsBatchSampler(Sampler):
                     batch_assignment[(i + self.epoch * self.required_batch_count_multiple) % floored_batch_count])
 
         if batch_assignment:
-            self.batches = [deepcopy(batches[i]) for i in batch_assignment]
+            self.batches = [batches[i] for i in batch_assignment]
+            self.padding_ratio = 1. - real_frames[batch_assignment].sum() / padded_frames[batch_assignment].sum()
         else:
             self.batches = [[]]
-        self.formed = self.epoch + self.seed
+            self.padding_ratio = 0.
+        self.frame_imbalance = rank_frames.max() / rank_frames.mean() if rank_frames.sum() > 0 else 1.
+        self.formed = (self.seed, self.epoch)
 
         del indices
         del batches
@@ -364,6 +432,206 @@ class DsTensorBoardLogger(TensorBoardLogger):
             del state["_all_rank_experiment"]
         return state
 
+
+class DsThroughputMonitor(pl.Callback):
+    """
+    Measures where the time of training goes, to tell whether training is input-bound or compute-bound.
+    The time of each batch is split into:
+        1. *data*: waiting for the DataLoader and moving the batch to the device;
+        2. *forward*: from the start of the batch to the backward pass;
+        3. *backward*: the backward pass;
+        4. *optimizer*: gradient clipping, optimizer and scheduler steps and the other hooks after the backward pass.
+    Real frames (without padding) and frames with padding of each batch are counted with the sizes of the dataset.
+    The averages are logged every *log_interval* batches, and a summary is printed at each validation.
+
+    CUDA is synchronized at the boundaries of the stages so that asynchronous kernels are accounted
+    to the stage that launched them, which slightly slows down training.
+    """
+    STAGES = ('data', 'forward', 'backward', 'optimizer')
+    INPUT_BOUND_RATIO = 0.1  # training is considered input-bound above this ratio of data time
+
+    def __init__(self, log_interval=100):
+        super().__init__()
+        self.log_interval = log_interval
+        self.interval_stats = self._new_stats()
+        self.summary_stats = self._new_stats()
+        self._last_time = None
+        self._stage_start = None
+
+    def _new_stats(self):
+        return {
+            'batches': 0, 'samples': 0, 'real_frames': 0, 'padded_frames': 0, 'max_memory': 0,
+            **{stage: 0. for stage in self.STAGES}
+        }
+
+    @staticmethod
+    def _now(pl_module):
+        if pl_module.device.type == 'cuda':
+            torch.cuda.synchronize(pl_module.device)
+        return time.perf_counter()
+
+    @staticmethod
+    def _count_frames(dataset, indices, row_bounds=None):
+        sizes = np.asarray(dataset.sizes)[indices]
+        if row_bounds is not None:
+            row_sizes = np.add.reduceat(sizes, row_bounds[:-1])
+        else:
+            row_sizes = sizes
+        return int(sizes.sum()), int(max(row_sizes)) * len(row_sizes)
+
+    def _add(self, key, value):
+        self.interval_stats[key] += value
+        self.summary_stats[key] += value
+
+    def _update_memory(self, pl_module):
+        if pl_module.device.type != 'cuda':
+            return
+        max_memory = torch.cuda.max_memory_allocated(pl_module.device)
+        torch.cuda.reset_peak_memory_stats(pl_module.device)
+        self.interval_stats['max_memory'] = max(self.interval_stats['max_memory'], max_memory)
+        self.summary_stats['max_memory'] = max(self.summary_stats['max_memory'], max_memory)
+
+    def _compute(self, stats):
+        total_time = max(sum(stats[stage] for stage in self.STAGES), 1e-8)
+        res = {f'{stage}_time': stats[stage] / stats['batches'] for stage in self.STAGES}
+        res['data_time_ratio'] = stats['data'] / total_time
+        res['samples_per_second'] = stats['samples'] / total_time
+        res['frames_per_second'] = stats['real_frames'] / total_time
+        res['real_frames'] = stats['real_frames'] / stats['batches']
+        res['padded_frames'] = stats['padded_frames'] / stats['batches']
+        res['padding_ratio'] = 1 - stats['real_frames'] / max(stats['padded_frames'], 1)
+        if stats['max_memory'] > 0:
+            res['max_memory_allocated'] = stats['max_memory'] / 2 ** 30  # GiB
+        return res
+
+    def on_train_start(self, trainer, pl_module):
+        if pl_module.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(pl_module.device)
+        self._last_time = self._now(pl_module)
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        now = self._now(pl_module)
+        if self._last_time is not None:  # not the first batch after validation
+            self._add('data', now - self._last_time)
+        self._stage_start = now
+        self._add('samples', batch['size'])
+        real_frames, padded_frames = self._count_frames(
+            pl_module.train_dataset, batch['indices'].cpu().numpy(),
+            row_bounds=batch['row_bounds'].cpu().numpy() if 'row_bounds' in batch else None
+        )
+        self._add('real_frames', real_frames)
+        self._add('padded_frames', padded_frames)
+
+    def on_before_backward(self, trainer, pl_module, loss):
+        now = self._now(pl_module)
+        self._add('forward', now - self._stage_start)
+        self._stage_start = now
+
+    def on_after_backward(self, trainer, pl_module):
+        now = self._now(pl_module)
+        self._add('backward', now - self._stage_start)
+        self._stage_start = now
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        now = self._now(pl_module)
+        self._add('optimizer', now - self._stage_start)
+        self._add('batches', 1)
+        self._last_time = now
+        if self.interval_stats['batches'] >= self.log_interval:
+            self._update_memory(pl_module)
+            trainer.logger.log_metrics({
+                f'throughput/{k}': v for k, v in self._compute(self.interval_stats).items()
+            }, step=trainer.global_step)
+            self.interval_stats = self._new_stats()
+
+    def on_validation_start(self, trainer, pl_module):
+        # the time of validation and checkpointing is not data time
+        self._last_time = None
+        if trainer.sanity_checking or self.summary_stats['batches'] == 0:
+            return
+        self._update_memory(pl_module)
+        stats = self._compute(self.summary_stats)
+        info = (
+            f'| throughput of the last {self.summary_stats["batches"]} batches: '
+            + ', '.join(f'{stage} {stats[f"{stage}_time"] * 1000:.1f} ms' for stage in self.STAGES)
+            + f' per batch; {stats["samples_per_second"]:.1f} samples/s, {stats["frames_per_second"]:.0f} frames/s, '
+              f'padding ratio {stats["padding_ratio"]:.2%}'
+        )
+        if 'max_memory_allocated' in stats:
+            info += f', max memory allocated {stats["max_memory_allocated"]:.2f} GiB'
+        rank_zero_info(info)
+        if stats['data_time_ratio'] > self.INPUT_BOUND_RATIO:
+            rank_zero_info(
+                f'| training is input-bound: {stats["data_time_ratio"]:.1%} of the time is spent waiting for data. '
+                f'Consider increasing ds_workers or enabling dataset_preload.'
+            )
+        else:
+            rank_zero_info(
+                f'| training is compute-bound: {stats["data_time_ratio"]:.1%} of the time is spent waiting for data.'
+            )
+        self.summary_stats = self._new_stats()
+
+
+class DsTrainingProfiler(pl.Callback):
+    """
+    Records *active_steps* training batches with the PyTorch profiler after *wait_steps* batches
+    and one warm-up batch. The trace (Chrome trace format, readable by the PyTorch profiler plugin
+    of TensorBoard) and a table of the top *row_limit* operators of each rank are saved to *dirpath*.
+    """
+
+    def __init__(self, dirpath, wait_steps, active_steps, row_limit=30):
+        super().__init__()
+        self.dirpath = Path(dirpath)
+        self.wait_steps = wait_steps
+        self.active_steps = active_steps
+        self.row_limit = row_limit
+        self.profiler = None
+        self.worker_name = None
+
+    def on_train_start(self, trainer, pl_module):
+        self.dirpath.mkdir(parents=True, exist_ok=True)
+        self.worker_name = f'train_rank{trainer.global_rank}'
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if pl_module.device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(
+                skip_first=self.wait_steps, wait=0, warmup=1, active=self.active_steps, repeat=1
+            ),
+            on_trace_ready=self._on_trace_ready,
+            record_shapes=True,
+            profile_memory=True
+        )
+        self.profiler.start()
+        rank_zero_info(
+            f'| profiling {self.active_steps} training steps after {self.wait_steps + 1} steps to \'{self.dirpath}\''
+        )
+
+    def _on_trace_ready(self, prof):
+        torch.profiler.tensorboard_trace_handler(str(self.dirpath), worker_name=self.worker_name)(prof)
+        sort_by = 'self_cuda_time_total' if torch.profiler.ProfilerActivity.CUDA in prof.activities \
+            else 'self_cpu_time_total'
+        table = prof.key_averages().table(sort_by=sort_by, row_limit=self.row_limit)
+        with open(self.dirpath / f'{self.worker_name}.txt', 'w', encoding='utf8') as f:
+            f.write(table)
+        rank_zero_info(table)
+        rank_zero_info(f'| save profiling results to \'{self.dirpath}\'')
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        if self.profiler is None:
+            return
+        self.profiler.step()
+        if self.profiler.step_num >= self.wait_steps + 1 + self.active_steps:
+            self.profiler.stop()
+            self.profiler = None
+
+    def on_train_end(self, trainer, pl_module):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+
 def get_strategy(
     devices="auto",
     num_nodes=1,